@@ -0,0 +1,59 @@
+import time
+
+# Replies for clients that are turned away, kept short so refusing costs less than serving
+BUSY = "Error: Server busy, try again later."
+IDLE = "Idle for too long, disconnecting."
+INPUT_FULL = "Error: Command too long."
+
+
+# Token bucket for one connection: rate commands per second on average, bursts of up to burst at once
+# Only the connection's own thread (or event loop) uses it, so it has no lock
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Is there a token for one more command
+    def ready(self):
+        if self.tokens < 1:
+            self.refill()
+        return self.tokens >= 1
+
+    # Use a token, after ready() said there was one
+    def take(self):
+        self.tokens -= 1
+
+    # Seconds until the next token, 0 if there is one now
+    def delay(self):
+        self.refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+# What a server allows its clients, None turns a limit off and every limit is off unless asked for
+#   rate, burst     - commands per second per connection (token bucket), commands over it are left unread until
+#                     the connection has tokens again, so TCP slows the client down and it costs the server nothing
+#                     burst defaults to one second's worth of commands
+#   max_connections - connections served at once, any more get BUSY straight away and are closed
+#   idle_timeout    - seconds without a command before a connection is closed
+#   max_input       - bytes of an incomplete command a connection may leave buffered
+class Limits:
+    def __init__(self, rate=None, burst=None, max_connections=None, idle_timeout=None, max_input=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.max_input = max_input
+
+    # New bucket for a connection, or None without a rate limit
+    def bucket(self):
+        return TokenBucket(self.rate, self.burst or max(1, int(self.rate))) if self.rate else None
+
+# No limits at all, what the servers did before admission control
+UNLIMITED = Limits()
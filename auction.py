@@ -0,0 +1,170 @@
+import heapq
+import itertools
+import threading
+
+# How a sale session with an order book sells its stock
+#   "batch"      - bids are collected until the deadline, then the book is cleared in one go: the highest bids win
+#                  and every winner pays the same price, the lowest winning bid (uniform price call auction)
+#   "continuous" - a bid at or above the seller's asking price is filled straight away at that price,
+#                  lower bids wait in the book and are filled (best first) if the seller lowers the price
+MODES = ("batch", "continuous")
+
+
+# One buyer's bid: up to quantity units at no more than price each
+class Bid:
+    __slots__ = ("id", "owner", "price", "quantity", "filled", "paid", "cancelled")
+
+    def __init__(self, bid_id, owner, price, quantity):
+        self.id = bid_id
+        self.owner = owner # Whoever placed it (the seller passes the buyer's session)
+        self.price = price
+        self.quantity = quantity
+        self.filled = 0 # Units bought so far
+        self.paid = None # Price per unit the fills were at
+        self.cancelled = False
+
+    @property
+    def open(self):
+        return not self.cancelled and self.filled < self.quantity
+
+
+# Bids for one item kept in price-time priority: the highest price first, the earliest bid first at the same price
+# Bids are in a heap of (-price, sequence number, Bid), placing one is O(log n) whatever the size of the book
+# Withdrawn and filled bids are left in the heap and skipped when they come up
+# take(quantity) is called to get stock from the seller's inventory, it returns how many units it could take
+class OrderBook:
+    def __init__(self, item, take, mode="batch", ask=0, ids=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown auction mode: {mode}")
+
+        self.item = item
+        self.take = take
+        self.mode = mode
+        self.ask = ask # Lowest price the seller accepts (the reserve price in "batch" mode)
+        self.heap = []
+        self.bids = {} # bid id -> Bid, while the bid is open
+        self.sequence = itertools.count() # Time priority
+        self.ids = ids or itertools.count(1) # Pass one counter to several books to keep bid ids unique between them
+        self.lock = threading.Lock() # Protects the heap and the bids, taken before the inventory's item lock
+        self.placed = 0
+        self.closed = False
+
+    # Add a bid, returns it with any units it was filled straight away ("continuous" mode)
+    def place(self, owner, price, quantity):
+        with self.lock:
+            if self.closed:
+                raise ValueError(f"Bidding for {self.item} is over.")
+            bid = Bid(next(self.ids), owner, price, quantity)
+            self.placed += 1
+            if self.mode == "continuous" and price >= self.ask:
+                self.fill(bid, bid.quantity, self.ask)
+                if not bid.open:
+                    return bid
+            self.bids[bid.id] = bid
+            heapq.heappush(self.heap, (-price, next(self.sequence), bid))
+            return bid
+
+    # Take stock for a bid, caller holds the lock, returns the units filled
+    def fill(self, bid, quantity, price):
+        got = self.take(quantity)
+        if got:
+            bid.filled += got
+            bid.paid = price
+        return got
+
+    # Withdraw an open bid, only its owner can
+    def cancel(self, bid_id, owner):
+        with self.lock:
+            bid = self.bids.get(bid_id)
+            if bid is None or bid.owner is not owner:
+                return None
+            bid.cancelled = True
+            del self.bids[bid_id]
+            return bid
+
+    # Withdraw every open bid of an owner (e.g. a buyer that disconnected)
+    def cancel_all(self, owner):
+        with self.lock:
+            mine = [bid for bid in self.bids.values() if bid.owner is owner]
+            for bid in mine:
+                bid.cancelled = True
+                del self.bids[bid.id]
+            return mine
+
+    # Highest open bid, or None
+    def best(self):
+        with self.lock:
+            self.skip_closed()
+            return self.heap[0][2] if self.heap else None
+
+    # Drop withdrawn and filled bids from the top of the heap, caller holds the lock
+    def skip_closed(self):
+        while self.heap and not self.heap[0][2].open:
+            heapq.heappop(self.heap)
+
+    # Lower (or raise) the asking price in "continuous" mode, waiting bids at or above it are filled best first
+    # Returns the bids that got units
+    def set_ask(self, price):
+        with self.lock:
+            self.ask = price
+            if self.mode != "continuous":
+                return []
+            filled = []
+            while True:
+                self.skip_closed()
+                if not self.heap or self.heap[0][2].price < price:
+                    break
+                bid = self.heap[0][2]
+                if not self.fill(bid, bid.quantity - bid.filled, price):
+                    break # Sold out
+                filled.append(bid)
+                if not bid.open:
+                    del self.bids[bid.id]
+            return filled
+
+    # Close the book ("batch" mode: clear it), returns (bids that won units, bids left open, price)
+    # The best bids are filled until stock runs out, at one price for all: the lowest price that won anything
+    # stock is how much can be sold, the units are then taken with a single take() call
+    def clear(self, stock):
+        with self.lock:
+            self.closed = True
+            winners, price, left = [], None, stock
+            if self.mode == "batch":
+                while left > 0 and self.heap:
+                    bid = heapq.heappop(self.heap)[2]
+                    if not bid.open or bid.price < self.ask:
+                        if bid.open:
+                            break # Every bid left is below the reserve price
+                        continue
+                    units = min(left, bid.quantity - bid.filled)
+                    winners.append((bid, units))
+                    left -= units
+                    price = bid.price
+
+                sold = self.take(stock - left) if winners else 0
+                if sold < stock - left:
+                    winners = self.shrink(winners, sold) # Stock went down since stock was read
+                    price = winners[-1][0].price if winners else None # The lowest price still winning
+                for bid, units in winners:
+                    bid.filled += units
+                    bid.paid = price
+
+            winners = [bid for bid, _ in winners]
+            won = set(winners)
+            losers = [bid for bid in self.bids.values() if bid.open and bid not in won] # Not filled, or only in part
+            self.bids.clear()
+            self.heap.clear()
+            return winners, losers, price
+
+    # Keep the first winners that fit in sold units, the last one may get fewer
+    def shrink(self, winners, sold):
+        kept = []
+        for bid, units in winners:
+            if sold <= 0:
+                break
+            kept.append((bid, min(units, sold)))
+            sold -= units
+        return kept
+
+    def __len__(self):
+        return len(self.bids)
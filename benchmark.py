@@ -0,0 +1,1286 @@
+import asyncio # Simulated buyers are coroutines so one process can open thousands of connections
+import contextlib
+import heapq
+import io
+import json
+import random
+import multiprocessing
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import admission
+import auction
+import catalog
+import cluster
+import codec
+import control
+import crowd
+import inventory
+import market
+import metrics
+import replication
+from buyer import AsyncBuyerClient, SellerPool
+import store
+import wal
+from seller import Seller, AsyncSeller, WRITES
+
+
+# Ask the OS for a free port on localhost
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Return the value at the given percentile (0-100) of a list of numbers
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+# Start a seller of the given engine with a sale already running, so no input() is needed
+def start_bench_seller(engine, backlog, items=None, **options):
+    seller = engine(1, "127.0.0.1", 0, items or {"sugar": 10**9}, backlog=backlog, **options)
+    seller.start_server()
+    seller.start_sale("sugar", duration=3600)
+    return seller
+
+
+# A simulated buyer connection, replies are queued so the caller can wait for them
+class BenchBuyer:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.replies = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                if not line.startswith(b"Notification|"):
+                    await self.replies.put(line) # Notifications are read and thrown away
+        except (ConnectionError, OSError):
+            pass
+
+    async def request(self, command):
+        self.writer.write(command)
+        await self.writer.drain()
+        return await self.replies.get()
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+
+# Open the connections, register an ID on each, then time BUY commands on a subset of them
+async def run_buyers(port, connections, buys):
+    async def connect(n):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        buyer = BenchBuyer(reader, writer)
+        await buyer.replies.get() # Connected| welcome message
+        await buyer.request(f"ID {n}\n".encode())
+        return buyer
+
+    start = time.perf_counter()
+    buyers = await asyncio.gather(*(connect(n) for n in range(connections)))
+    connect_time = time.perf_counter() - start
+
+    latencies = []
+    for i in range(buys):
+        buyer = buyers[i % len(buyers)]
+        t = time.perf_counter()
+        await buyer.request(b"BUY 1\n")
+        latencies.append((time.perf_counter() - t) * 1000)
+
+    for buyer in buyers:
+        buyer.close()
+    await asyncio.sleep(0.1) # Let the seller notice the disconnects
+
+    return connect_time, latencies
+
+# Compare the threaded Seller with AsyncSeller: connections/sec and BUY latency
+def bench_seller_engines(connections=2000, buys=500, backlog=1024):
+    results = {}
+
+    for engine in (Seller, AsyncSeller):
+        with contextlib.redirect_stdout(io.StringIO()): # Hide the seller's per-buyer prints
+            seller = start_bench_seller(engine, backlog)
+            connect_time, latencies = asyncio.run(run_buyers(seller.port, connections, buys))
+
+        results[engine.__name__] = {
+            "connections_per_sec": connections / connect_time,
+            "buy_p50_ms": percentile(latencies, 50),
+            "buy_p99_ms": percentile(latencies, 99),
+        }
+
+    print(f"Seller engines, {connections} buyers, {buys} BUY commands")
+    for name, r in results.items():
+        print(f"  {name:12} {r['connections_per_sec']:10.0f} conn/s   BUY p50={r['buy_p50_ms']:.3f}ms p99={r['buy_p99_ms']:.3f}ms")
+    return results
+
+
+# Encode/decode throughput of the text and binary codecs, for a pipelined batch of commands
+def bench_codec(commands=200000, batch=100):
+    sample = ["ID 4821", "LIST", "CURRENT", "BUY 3", "BUY sugar:2", "QUIT"]
+    results = {}
+
+    for name, codec_class in codec.CODECS.items():
+        encoder = codec_class()
+        lines = [sample[i % len(sample)] for i in range(batch)]
+
+        start = time.perf_counter()
+        for _ in range(commands // batch):
+            data = codec.encode_batch(encoder, lines)
+        encode_rate = commands / (time.perf_counter() - start)
+
+        decoder = codec_class()
+        start = time.perf_counter()
+        for _ in range(commands // batch):
+            decoder.feed(data)
+            while decoder.next_command() is not None:
+                pass
+        decode_rate = commands / (time.perf_counter() - start)
+
+        reply = encoder.encode_message(codec.REPLY, "Purchase OK: bought 3.")
+        results[name] = {"encode_per_sec": encode_rate, "decode_per_sec": decode_rate, "command_bytes": len(data) / batch, "reply_bytes": len(reply)}
+
+    print(f"Codecs, {commands} commands in batches of {batch}")
+    for name, r in results.items():
+        print(f"  {name:5} encode {r['encode_per_sec']:10.0f}/s   decode {r['decode_per_sec']:10.0f}/s   {r['command_bytes']:.1f} bytes/command")
+    return results
+
+
+# BUY latency with some buyers that never read their notifications, for each broadcast policy
+def bench_broadcast(buyers=50, slow=10, buys=20000):
+    results = {}
+
+    for policy in ("coalesce", "disconnect"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            seller = start_bench_seller(Seller, 1024, max_queue=64, broadcast_policy=policy)
+
+            # Slow buyers connect, then never read anything
+            stalled = []
+            for _ in range(slow):
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+                s.connect(("127.0.0.1", seller.port))
+                stalled.append(s)
+
+            # Loopback send buffers grow to megabytes and would take every notification of the run, so the seller's
+            # end of each stalled connection gets a small one: it fills after a few hundred and the queue takes over
+            addresses = {s.getsockname() for s in stalled}
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                ends = [sock for sock in list(seller.clients) if sock.getpeername() in addresses]
+                if len(ends) == slow:
+                    break
+                time.sleep(0.01)
+            for sock in ends:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+            connect_time, latencies = asyncio.run(run_buyers(seller.port, buyers, buys))
+            metrics = seller.broadcast_metrics()
+
+        for s in stalled:
+            s.close()
+
+        results[policy] = {
+            "buy_p50_ms": percentile(latencies, 50),
+            "buy_p99_ms": percentile(latencies, 99),
+            **metrics,
+        }
+
+    print(f"Broadcast, {buyers} buyers + {slow} stalled buyers, {buys} BUY commands")
+    for policy, r in results.items():
+        print(f"  {policy:10} BUY p50={r['buy_p50_ms']:.3f}ms p99={r['buy_p99_ms']:.3f}ms   "
+              f"fan-out avg={r['fanout_avg_ms']:.3f}ms   delivery avg={r['latency_avg_ms']:.3f}ms max={r['latency_max_ms']:.1f}ms   "
+              f"coalesced={r['coalesced']} disconnected={r['disconnected']} max queue={r['queue_depth_max']}")
+    return results
+
+
+# Many threads buying one hot item, old single lock held across the reply vs the per-item inventory
+def bench_inventory(threads=16, buys=5000):
+    results = {}
+
+    # Replies go to a real socket that another thread drains, like a buyer connection
+    reply_sink, drain = socket.socketpair()
+    threading.Thread(target=lambda: [None for _ in iter(lambda: drain.recv(65536), b"")], daemon=True).start()
+
+    # The old BUY path: one lock for all stock, held while the reply is written
+    def old_buy(items, lock, item):
+        with lock:
+            if items[item] >= 1:
+                items[item] -= 1
+                reply_sink.sendall("Reply|Purchase OK: bought 1.\n".encode())
+
+    # The new path: lock only the item for the update, reply afterwards
+    def new_buy(stock, item):
+        ok, _ = stock.buy(item, 1)
+        if ok:
+            reply_sink.sendall(b"Reply|Purchase OK: bought 1.\n")
+
+    def hammer(target):
+        workers = [threading.Thread(target=lambda: [target() for _ in range(buys)]) for _ in range(threads)]
+        start = time.perf_counter()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return threads * buys / (time.perf_counter() - start)
+
+    items, lock = {"sugar": 10**9, "oil": 10**9}, threading.Lock()
+    results["single lock, hot item"] = hammer(lambda: old_buy(items, lock, "sugar"))
+
+    stock = inventory.Inventory({"sugar": 10**9, "oil": 10**9})
+    results["per-item lock, hot item"] = hammer(lambda: new_buy(stock, "sugar"))
+    results["multi-item orders"] = hammer(lambda: stock.buy_many({"sugar": 1, "oil": 1}))
+    results["reserve + commit"] = hammer(lambda: stock.commit(stock.reserve({"sugar": 1})[0]))
+
+    reply_sink.close()
+    drain.close()
+
+    print(f"Inventory contention, {threads} threads x {buys} operations")
+    for name, rate in results.items():
+        print(f"  {name:24} {rate:12.0f} ops/s")
+    return results
+
+
+# BUY throughput with the stock in a write-ahead log, for each durability mode
+# Buyers send their BUYs at the same time, so group commit can put many purchases in one fsync
+def bench_durability(buyers=32, buys=100):
+    async def buy_all(port):
+        async def connect(n):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            buyer = BenchBuyer(reader, writer)
+            await buyer.replies.get()
+            await buyer.request(f"ID {n}\n".encode())
+            return buyer
+
+        async def buy(buyer):
+            for _ in range(buys):
+                await buyer.request(b"BUY 1\n")
+
+        connected = await asyncio.gather(*(connect(n) for n in range(buyers)))
+        start = time.perf_counter()
+        await asyncio.gather(*(buy(buyer) for buyer in connected))
+        elapsed = time.perf_counter() - start
+        for buyer in connected:
+            buyer.close()
+        return buyers * buys / elapsed
+
+    results = {}
+    directory = tempfile.mkdtemp(prefix="bench-wal-")
+    for mode in ("none",) + wal.MODES:
+        journal = None if mode == "none" else wal.WriteAheadLog(os.path.join(directory, f"{mode}.wal"), mode)
+        with contextlib.redirect_stdout(io.StringIO()):
+            seller = start_bench_seller(Seller, 1024, journal=journal)
+            rate = asyncio.run(buy_all(seller.port))
+
+        results[mode] = {"buys_per_sec": rate}
+        if journal:
+            # Recovery time: rebuild the stock from what the run left behind
+            journal.flush()
+            start = time.perf_counter()
+            recovered = inventory.Inventory({"sugar": 10**9}, wal.WriteAheadLog(journal.path, mode))
+            results[mode]["recovery_ms"] = (time.perf_counter() - start) * 1000
+            results[mode]["recovered_ok"] = recovered["sugar"] == seller.items["sugar"]
+
+    print(f"Durability, {buyers} buyers x {buys} BUY commands")
+    for mode, r in results.items():
+        recovery = f"   recovery {r['recovery_ms']:.1f}ms ({'ok' if r['recovered_ok'] else 'MISMATCH'})" if "recovery_ms" in r else ""
+        print(f"  {mode:6} {r['buys_per_sec']:10.0f} BUY/s{recovery}")
+    return results
+
+
+# Registration and lookup cost as the registry grows, old JSON read-modify-write vs the sqlite store
+def bench_registry(sellers=100000, buyers=100000, json_entries=2000, sample=1000):
+    results = {}
+    directory = tempfile.mkdtemp(prefix="bench-registry-")
+
+    # The old way: every registration reads and rewrites the whole file
+    path = os.path.join(directory, "sellers.json")
+    times = []
+    for n in range(json_entries):
+        start = time.perf_counter()
+        entries = store.read_json(path)
+        entries[str(n)] = {"host": "127.0.0.1", "port": 10000 + n, "items": ["sugar"]}
+        with open(path, "w") as f:
+            json.dump(entries, f, indent=4)
+        times.append(time.perf_counter() - start)
+    results["json sellers"] = {"first_us": sum(times[:sample]) / sample * 1e6, "last_us": sum(times[-sample:]) / sample * 1e6, "count": json_entries}
+
+    # The market registry on sqlite
+    registry = market.SellerRegistry(os.path.join(directory, "market.db"))
+    times = []
+    for n in range(sellers):
+        start = time.perf_counter()
+        registry.register(str(n), "127.0.0.1", 10000 + n, ["sugar", f"item{n % 100}"])
+        times.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    for n in range(0, sellers, sellers // sample):
+        registry.lookup(str(n))
+    lookup = (time.perf_counter() - start) / sample
+    results["sqlite sellers"] = {"first_us": sum(times[:sample]) / sample * 1e6, "last_us": sum(times[-sample:]) / sample * 1e6, "count": sellers, "lookup_us": lookup * 1e6}
+
+    # Buyers write to the store directly
+    buyer_store = store.Store(os.path.join(directory, "market.db"))
+    times = []
+    for n in range(buyers):
+        start = time.perf_counter()
+        buyer_store.add_buyer(str(n))
+        times.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    for n in range(0, buyers, buyers // sample):
+        buyer_store.set_connected(str(n), True)
+        buyer_store.buyer(str(n))
+    update = (time.perf_counter() - start) / sample
+    results["sqlite buyers"] = {"first_us": sum(times[:sample]) / sample * 1e6, "last_us": sum(times[-sample:]) / sample * 1e6, "count": buyers, "lookup_us": update * 1e6}
+
+    print("Registry, average time per registration")
+    for name, r in results.items():
+        lookup = f"   lookup/update {r['lookup_us']:.1f}us" if "lookup_us" in r else ""
+        print(f"  {name:15} first {sample}: {r['first_us']:8.1f}us   last {sample} of {r['count']}: {r['last_us']:8.1f}us{lookup}")
+    return results
+
+
+# BUY throughput of a cluster as it goes from 1 worker process to one per core
+# Load comes from several client processes, so the clients aren't held back by a single GIL either
+def bench_cluster(max_workers=None, clients=4, connections=16, seconds=3.0):
+    context = multiprocessing.get_context("fork")
+
+    def client(port, counts):
+        async def buy_until(buyer, deadline):
+            count = 0
+            while time.monotonic() < deadline:
+                await buyer.request(b"BUY 1\n")
+                count += 1
+            return count
+
+        async def run():
+            buyers = []
+            for n in range(connections):
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                buyer = BenchBuyer(reader, writer)
+                await buyer.replies.get()
+                await buyer.request(f"ID {n}\n".encode())
+                buyers.append(buyer)
+            deadline = time.monotonic() + seconds
+            total = sum(await asyncio.gather(*(buy_until(buyer, deadline) for buyer in buyers)))
+            for buyer in buyers:
+                buyer.close()
+            return total
+
+        counts.put(asyncio.run(run()))
+
+    max_workers = max_workers or max(2, os.cpu_count())
+    sizes = sorted({2 ** n for n in range(max_workers.bit_length()) if 2 ** n <= max_workers} | {max_workers})
+    results = {}
+
+    for workers in sizes:
+        with contextlib.redirect_stdout(io.StringIO()):
+            seller = cluster.SellerCluster(1, "127.0.0.1", 0, {"sugar": 10**9}, workers)
+            seller.start_server()
+            seller.start_sale("sugar", duration=3600)
+
+            counts = context.Queue()
+            processes = [context.Process(target=client, args=(seller.port, counts)) for _ in range(clients)]
+            for process in processes:
+                process.start()
+            total = sum(counts.get() for _ in processes)
+            for process in processes:
+                process.join()
+            seller.stop()
+
+        results[workers] = {"buys_per_sec": total / seconds, "sold": 10**9 - seller.items["sugar"]}
+
+    print(f"Cluster, {clients} client processes x {connections} buyers, {os.cpu_count()} cores")
+    base = results[sizes[0]]["buys_per_sec"]
+    for workers, r in results.items():
+        print(f"  {workers:3} workers {r['buys_per_sec']:10.0f} BUY/s   x{r['buys_per_sec'] / base:.2f}   stock sold {r['sold']}")
+    return results
+
+
+# LIST across many sellers: one at a time with a new connection each (the old way) vs SellerPool scatter-gather
+def bench_pool(sellers=100, rounds=20):
+    market_port = free_port()
+    registry = market.SellerRegistry(os.path.join(tempfile.mkdtemp(prefix="bench-pool-"), "market.db"))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        threading.Thread(target=market.start_market, args=("127.0.0.1", market_port, registry), daemon=True).start()
+        for n in range(sellers):
+            seller = start_bench_seller(Seller, 128, items={"sugar": 1000 + n, "oil": 500})
+            registry.register(str(n + 1), "127.0.0.1", seller.port, ["sugar", "oil"])
+
+        async def one_by_one():
+            for sid in market.parse_listing(market.send_command("LIST", "127.0.0.1", market_port)):
+                host, port = market.send_command(f"LOOKUP {sid}", "127.0.0.1", market_port).split()
+                client = AsyncBuyerClient(1)
+                await client.connect(host, int(port))
+                await client.list()
+                await client.quit()
+
+        async def pooled():
+            pool = SellerPool(1, market_address=("127.0.0.1", market_port))
+            times = []
+            for _ in range(rounds + 1):
+                start = time.perf_counter()
+                stock, errors = await pool.list_all()
+                times.append(time.perf_counter() - start)
+            await pool.close()
+            return times[0], times[1:], len(stock["sugar"]), len(errors)
+
+        sequential = []
+        for _ in range(3):
+            start = time.perf_counter()
+            asyncio.run(one_by_one())
+            sequential.append(time.perf_counter() - start)
+        cold, warm, answered, failed = asyncio.run(pooled())
+
+    results = {
+        "one_by_one_ms": percentile(sequential, 50) * 1000,
+        "pool_cold_ms": cold * 1000,
+        "pool_warm_p50_ms": percentile(warm, 50) * 1000,
+        "pool_warm_p99_ms": percentile(warm, 99) * 1000,
+        "sellers_answered": answered,
+        "sellers_failed": failed,
+    }
+    print(f"LIST across {sellers} sellers")
+    print(f"  new connection per seller  {results['one_by_one_ms']:8.1f}ms")
+    print(f"  pool, first (connects)     {results['pool_cold_ms']:8.1f}ms")
+    print(f"  pool, kept connections     {results['pool_warm_p50_ms']:8.1f}ms p50  {results['pool_warm_p99_ms']:.1f}ms p99   ({answered} answered, {failed} failed)")
+    return results
+
+
+# How much a buyer has to download to keep its seller list current, polling LIST vs a pushed directory
+# and how long a change takes to reach every subscribed directory
+def bench_directory(sellers=200, subscribers=20, changes=200):
+    market_port = free_port()
+    registry = market.SellerRegistry(os.path.join(tempfile.mkdtemp(prefix="bench-directory-"), "market.db"))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        threading.Thread(target=market.start_market, args=("127.0.0.1", market_port, registry), daemon=True).start()
+        for n in range(sellers):
+            registry.register(str(n), "127.0.0.1", 20000 + n, ["sugar", "oil"])
+
+        seen = threading.Condition()
+        counts = [0] * subscribers
+        def counter(index):
+            def on_change(*_):
+                with seen:
+                    counts[index] += 1
+                    seen.notify_all()
+            return on_change
+        directories = [market.Directory("127.0.0.1", market_port, on_change=counter(i)).start() for i in range(subscribers)]
+        for directory in directories:
+            directory.synced.wait(10)
+        synced_bytes = sum(directory.received for directory in directories) / subscribers
+
+        poll_bytes = len(market.send_command("LIST", "127.0.0.1", market_port).encode())
+        latencies = []
+        for n in range(changes):
+            start = time.perf_counter()
+            registry.update(str(n % sellers), ["sugar", "oil", f"item{n}"])
+            with seen:
+                seen.wait_for(lambda: min(counts) > n, timeout=10)
+            latencies.append(time.perf_counter() - start)
+        delta_bytes = (sum(directory.received for directory in directories) / subscribers - synced_bytes) / changes
+
+    results = {
+        "list_poll_bytes": poll_bytes,
+        "initial_sync_bytes": synced_bytes,
+        "bytes_per_change": delta_bytes,
+        "propagation_p50_ms": percentile(latencies, 50) * 1000,
+        "propagation_p99_ms": percentile(latencies, 99) * 1000,
+    }
+    print(f"Market directory, {sellers} sellers, {subscribers} subscribers")
+    print(f"  LIST poll                  {poll_bytes:8d} bytes every poll")
+    print(f"  directory first sync       {synced_bytes:8.0f} bytes once")
+    print(f"  directory per change       {delta_bytes:8.1f} bytes")
+    print(f"  change reaches everyone    {results['propagation_p50_ms']:8.2f}ms p50  {results['propagation_p99_ms']:.2f}ms p99")
+    return results
+
+
+# What the instrumentation costs on the hot path: one metric update, a timed lock, and whole commands through handle_batch
+def bench_metrics(operations=200000, commands=50000):
+    registry = metrics.Registry()
+    counter, histogram = registry.counter("bench"), registry.histogram("bench")
+    plain, timed = threading.Lock(), registry.timed_lock("bench", threading.Lock())
+
+    def cost(fn):
+        start = time.perf_counter()
+        for _ in range(operations):
+            fn()
+        return (time.perf_counter() - start) / operations * 1e9
+
+    def hold(lock):
+        with lock:
+            pass
+
+    results = {
+        "counter_add_ns": cost(counter.add),
+        "histogram_record_ns": cost(lambda: histogram.record(0.000123)),
+        "lock_ns": cost(lambda: hold(plain)),
+        "timed_lock_ns": cost(lambda: hold(timed)),
+    }
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        seller = Seller(1, "127.0.0.1", 0, {"sugar": 10**9})
+        seller.start_sale("sugar", duration=3600)
+    session = seller.new_session()
+    data = codec.encode_batch(session["codec"], ["ID 1"] + ["BUY 1", "LIST", "CURRENT"] * (commands // 3))
+    start = time.perf_counter()
+    session["codec"].feed(data)
+    seller.handle_batch(session, lambda data: None)
+    results["commands_per_sec"] = commands / (time.perf_counter() - start)
+    results["buy_p99_us"] = seller.metrics.histogram("command.BUY").percentile(99)
+
+    print("Metrics overhead")
+    print(f"  counter add        {results['counter_add_ns']:8.0f}ns")
+    print(f"  histogram record   {results['histogram_record_ns']:8.0f}ns")
+    print(f"  lock / timed lock  {results['lock_ns']:8.0f}ns / {results['timed_lock_ns']:.0f}ns")
+    print(f"  handle_batch       {results['commands_per_sec']:8.0f} commands/s instrumented, BUY p99 {results['buy_p99_us']}us")
+    return results
+
+
+# Read-heavy load (mostly LIST and CURRENT, a few BUY) on a seller with many items, with and without the reply caches
+# Caching is turned off by giving the caches a key that never matches, so both runs go through the same code
+def bench_replies(items=100, commands=60000, buy_every=20):
+    stock = {f"item{n}": 10**9 for n in range(items)}
+    mix = ["LIST" if n % 2 else "CURRENT" for n in range(buy_every - 1)] + ["BUY 1"]
+    lines = ["ID 1"] + [mix[n % len(mix)] for n in range(commands)]
+    results = {}
+
+    for name in ("rebuilt", "cached"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            seller = Seller(1, "127.0.0.1", 0, stock)
+            for n in range(3):
+                seller.start_sale(f"item{n}", duration=3600)
+        if name == "rebuilt":
+            seller.list_reply.key = seller.current_reply.key = object # A new object every time, never equal to the last key
+
+        rates = []
+        for _ in range(3):
+            session = seller.new_session()
+            session["codec"].feed(codec.encode_batch(session["codec"], lines))
+            start = time.perf_counter()
+            seller.handle_batch(session, lambda data: None)
+            rates.append(commands / (time.perf_counter() - start))
+        results[name] = {"commands_per_sec": max(rates), "list_p50_us": seller.metrics.histogram("command.LIST").percentile(50)}
+
+    # What a buyer polling with versions gets back when nothing changed
+    session = seller.new_session()
+    replies = []
+    seller.handle_command(session, "LIST", replies.append)
+    seller.handle_command(session, f"LIST {seller.list_reply.get()[2]}", replies.append)
+    results["list_bytes"] = len(replies[0].encode())
+    results["not_modified_bytes"] = len(replies[1].encode())
+
+    print(f"LIST/CURRENT heavy load, {items} items, 1 BUY every {buy_every} commands")
+    for name in ("rebuilt", "cached"):
+        r = results[name]
+        print(f"  {name:8} {r['commands_per_sec']:10.0f} commands/s   LIST p50 {r['list_p50_us']}us")
+    print(f"  speedup  x{results['cached']['commands_per_sec'] / results['rebuilt']['commands_per_sec']:.2f}")
+    print(f"  LIST reply {results['list_bytes']} bytes, not modified {results['not_modified_bytes']} bytes")
+    return results
+
+
+# Orders/sec into an order book and how long clearing takes, for the book alone and for BID commands through a seller
+def bench_auction(orders=200000, stock=10000, commands=100000):
+    rng = random.Random(1)
+    prices = [rng.randint(1, 1000) for _ in range(orders)]
+    results = {}
+
+    book = auction.OrderBook("sugar", lambda quantity: quantity) # Unlimited stock, clear() decides how much is sold
+    owner = object()
+    start = time.perf_counter()
+    for price in prices:
+        book.place(owner, price, 1 + price % 5)
+    placed = time.perf_counter() - start
+    start = time.perf_counter()
+    winners, losers, price = book.clear(stock)
+    results["book"] = {"orders_per_sec": orders / placed, "clear_ms": (time.perf_counter() - start) * 1000,
+                       "orders": orders, "winners": len(winners), "price": price}
+
+    # The same through the protocol: a pipelined batch of BID commands, then the sale ends and the book is cleared
+    with contextlib.redirect_stdout(io.StringIO()):
+        seller = Seller(1, "127.0.0.1", 0, {"sugar": stock})
+        seller.start_sale("sugar", duration=3600, bidding="batch")
+    session = seller.new_session()
+    lines = ["ID 1"] + [f"BID sugar {1 + price % 5} {price}" for price in prices[:commands]]
+    session["codec"].feed(codec.encode_batch(session["codec"], lines))
+    start = time.perf_counter()
+    seller.handle_batch(session, lambda data: None)
+    placed = time.perf_counter() - start
+    start = time.perf_counter()
+    seller.end_sale("sugar")
+    results["seller"] = {"orders_per_sec": commands / placed, "clear_ms": (time.perf_counter() - start) * 1000,
+                         "orders": commands, "sold": stock - seller.items["sugar"]}
+
+    print(f"Auction, clearing {stock} units")
+    for name, r in results.items():
+        print(f"  {name:7} {r['orders']:8} orders   {r['orders_per_sec']:10.0f} orders/s   clear {r['clear_ms']:8.1f}ms")
+    return results
+
+
+# A buyer script gone wrong: pipelines LIST as fast as the seller takes it, from its own process
+def flood_seller(port, seconds):
+    sock = socket.create_connection(("127.0.0.1", port))
+    threading.Thread(target=lambda: all(iter(lambda: sock.recv(65536), b"")), daemon=True).start() # Read and drop the replies
+    threading.Timer(seconds, sock.shutdown, (socket.SHUT_WR,)).start() # Also wakes up a sendall() the seller isn't reading
+    batch = b"LIST\n" * 100
+    try:
+        while True:
+            sock.sendall(batch)
+    except OSError:
+        pass # Time is up, or disconnected by the seller
+    sock.close()
+
+# BUY latency of well-behaved buyers (one BUY every interval seconds each) while abusers flood the seller,
+# with no limits and with a per-buyer rate limit
+def bench_admission(buyers=20, abusers=2, seconds=3.0, interval=0.02, rate=200.0, burst=50):
+    context = multiprocessing.get_context("fork")
+
+    async def polite(port):
+        async def buy_every(buyer, latencies, deadline):
+            while time.monotonic() < deadline:
+                t = time.perf_counter()
+                await buyer.request(b"BUY 1\n")
+                latencies.append((time.perf_counter() - t) * 1000)
+                await asyncio.sleep(interval)
+
+        connections = []
+        for n in range(buyers):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            buyer = BenchBuyer(reader, writer)
+            await buyer.replies.get()
+            await buyer.request(f"ID {n}\n".encode())
+            connections.append(buyer)
+        latencies = []
+        deadline = time.monotonic() + seconds
+        await asyncio.gather(*(buy_every(buyer, latencies, deadline) for buyer in connections))
+        for buyer in connections:
+            buyer.close()
+        return latencies
+
+    phases = [
+        ("alone", 0, admission.Limits()),
+        ("unlimited", abusers, admission.UNLIMITED),
+        ("limited", abusers, admission.Limits(rate=rate, burst=burst)),
+    ]
+    results = {}
+    for name, flooders, limits in phases:
+        with contextlib.redirect_stdout(io.StringIO()):
+            seller = start_bench_seller(Seller, 128, limits=limits)
+            processes = [context.Process(target=flood_seller, args=(seller.port, seconds + 0.5)) for _ in range(flooders)]
+            for process in processes:
+                process.start()
+            time.sleep(0.2) # Let the flood get going
+            latencies = asyncio.run(polite(seller.port))
+            for process in processes:
+                process.join()
+        results[name] = {
+            "p50_ms": percentile(latencies, 50),
+            "p99_ms": percentile(latencies, 99),
+            "buys": len(latencies),
+            "rate_limited": seller.rejected["rate_limited"].value,
+        }
+
+    # Connection cap: connections over max_connections are refused straight away instead of getting a thread
+    with contextlib.redirect_stdout(io.StringIO()):
+        seller = start_bench_seller(Seller, 1024, limits=admission.Limits(max_connections=buyers))
+        kept = [socket.create_connection(("127.0.0.1", seller.port)) for _ in range(buyers)]
+        refused = []
+        for _ in range(200):
+            start = time.perf_counter()
+            with socket.create_connection(("127.0.0.1", seller.port)) as sock:
+                reply = sock.recv(4096)
+            refused.append((time.perf_counter() - start) * 1000)
+        for sock in kept:
+            sock.close()
+    results["busy"] = {"p50_ms": percentile(refused, 50), "reply": reply.decode().strip()}
+
+    print(f"BUY latency of {buyers} buyers (1 BUY every {interval * 1000:.0f}ms each) with {abusers} buyers flooding LIST")
+    for name, _, _ in phases:
+        r = results[name]
+        print(f"  {name:9} p50 {r['p50_ms']:7.2f}ms  p99 {r['p99_ms']:7.2f}ms   {r['buys']:6} BUYs   flooders held back {r['rate_limited']} times")
+    print(f"  over the connection limit: \"{results['busy']['reply']}\" in {results['busy']['p50_ms']:.2f}ms p50")
+    return results
+
+
+# Runs in a forked process, so the leader can be killed like a crashed seller
+def run_leader(seller_id, port, replication_port, market_port, mode, ready):
+    seller = Seller(seller_id, "127.0.0.1", port, {"sugar": 10**6})
+    seller.start_server()
+    seller.start_replication("127.0.0.1", replication_port, mode)
+    market.send_command(f"REGISTER {seller_id} 127.0.0.1 {port} sugar", "127.0.0.1", market_port)
+    seller.start_sale("sugar", duration=3600)
+    ready.put(True)
+    threading.Event().wait()
+
+# How long a purchase takes to reach a follower and what it costs the buyer, for each replication mode,
+# then how long the followers take to replace a leader killed under load, and how many acknowledged purchases were lost
+def bench_replication(buys=1000, followers=2, connections=8, load_seconds=1.0):
+    context = multiprocessing.get_context("fork")
+    market_port = free_port()
+    registry = market.SellerRegistry(os.path.join(tempfile.mkdtemp(prefix="bench-replication-"), "market.db"))
+    results = {}
+
+    async def timed_buys(port, replica):
+        client = AsyncBuyerClient(1)
+        await client.connect("127.0.0.1", port)
+        buy_times, propagation = [], []
+        for _ in range(buys):
+            expected = replica.items["sugar"] - 1
+            start = time.perf_counter()
+            await client.request("BUY 1")
+            buy_times.append((time.perf_counter() - start) * 1000)
+            while replica.items["sugar"] > expected:
+                time.sleep(0.00005) # The follower's thread applies it
+            propagation.append((time.perf_counter() - start) * 1000)
+        await client.quit()
+        return buy_times, propagation
+
+    async def load(port, acked):
+        async def buy_forever(n):
+            client = AsyncBuyerClient(n)
+            await client.connect("127.0.0.1", port)
+            try:
+                while True:
+                    if (await client.request("BUY 1")).startswith("Purchase OK"):
+                        acked[0] += 1
+            except (ConnectionError, OSError, asyncio.TimeoutError):
+                pass # The leader is gone
+            finally:
+                await client.close()
+        await asyncio.gather(*(buy_forever(n) for n in range(connections)))
+
+    async def buy_once(port):
+        client = AsyncBuyerClient(1)
+        await client.connect("127.0.0.1", port)
+        reply = await client.request("BUY 1")
+        await client.quit()
+        return reply
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        threading.Thread(target=market.start_market, args=("127.0.0.1", market_port, registry), daemon=True).start()
+        time.sleep(0.2)
+
+        for n, mode in enumerate(replication.MODES, start=1):
+            seller_id, port, replication_port = str(n), free_port(), free_port()
+            ready = context.Queue()
+            leader = context.Process(target=run_leader, args=(seller_id, port, replication_port, market_port, mode, ready))
+            leader.start()
+            ready.get()
+
+            copies = []
+            for _ in range(followers):
+                copy = Seller(0, "127.0.0.1", 0, {})
+                copy.start_server()
+                copy.follow(("127.0.0.1", replication_port), market_address=("127.0.0.1", market_port))
+                copies.append(copy)
+            while any("sugar" not in copy.items for copy in copies):
+                time.sleep(0.01)
+
+            buy_times, propagation = asyncio.run(timed_buys(port, copies[0]))
+
+            # Kill the leader in the middle of a BUY load, then wait for a follower to be selling in its place
+            acked = [0]
+            threading.Timer(load_seconds, os.kill, (leader.pid, signal.SIGKILL)).start()
+            killed = time.perf_counter() + load_seconds
+            asyncio.run(load(port, acked))
+            leader.join()
+            while True:
+                host, new_port = market.send_command(f"LOOKUP {seller_id}", "127.0.0.1", market_port).split()
+                if int(new_port) != port:
+                    try:
+                        if asyncio.run(buy_once(int(new_port))).startswith("Purchase OK"):
+                            break
+                    except (ConnectionError, OSError):
+                        pass
+                time.sleep(0.005)
+            failover = time.perf_counter() - killed
+
+            new_leader = next(copy for copy in copies if copy.port == int(new_port))
+            recorded = 10**6 - new_leader.items["sugar"] - buys - 1 # Purchases of the load that survived
+            results[mode] = {
+                "buy_p50_ms": percentile(buy_times, 50),
+                "buy_p99_ms": percentile(buy_times, 99),
+                "propagation_p50_ms": percentile(propagation, 50),
+                "propagation_p99_ms": percentile(propagation, 99),
+                "failover_ms": failover * 1000,
+                "acked": acked[0],
+                "lost": max(0, acked[0] - recorded), # Acknowledged but missing on the new leader
+                "unanswered": max(0, recorded - acked[0]), # Kept, but the leader died before replying
+            }
+
+    print(f"Replication to {followers} followers, {buys} BUYs, then the leader is killed under a load of {connections} buyers")
+    for mode, r in results.items():
+        print(f"  {mode:5} BUY p50 {r['buy_p50_ms']:6.3f}ms p99 {r['buy_p99_ms']:6.3f}ms   on the follower p50 {r['propagation_p50_ms']:6.3f}ms "
+              f"p99 {r['propagation_p99_ms']:6.3f}ms   failover {r['failover_ms']:6.1f}ms   {r['lost']} of {r['acked']} acknowledged BUYs lost, {r['unanswered']} kept unanswered")
+    return results
+
+
+# Starting sellers and buyers with random IDs and ports (the old way) vs IDs from the market and ports from the OS
+# Registrations straight on the registry show how each scales, then real sellers and buyers time their start over TCP
+def bench_startup(sellers=20000, buyers=8000, started=200, sample=1000):
+    directory = tempfile.mkdtemp(prefix="bench-startup-")
+    results = {}
+
+    def summary(times, refused, attempts):
+        return {"first_us": sum(times[:sample]) / sample * 1e6, "last_us": sum(times[-sample:]) / sample * 1e6,
+                "count": len(times), "refused": refused, "attempts_per_node": attempts / len(times)}
+
+    # The old way: seller IDs 1-1000 and ports 1024-65535 picked at random, the seller gives up if either is taken
+    registry = market.SellerRegistry(os.path.join(directory, "random.db"))
+    times, refused = [], 0
+    for _ in range(sellers):
+        start = time.perf_counter()
+        refused += not registry.register(str(random.randint(1, 1000)), "127.0.0.1", random.randint(1024, 65535), ["sugar"])
+        times.append(time.perf_counter() - start)
+    results["random sellers"] = summary(times, refused, sellers)
+
+    # Buyer IDs 1000-9999 picked at random until the store takes one, slower and slower as they fill up
+    buyer_store = store.Store(os.path.join(directory, "random.db"))
+    times, attempts = [], 0
+    for _ in range(buyers):
+        start = time.perf_counter()
+        while True:
+            attempts += 1
+            if buyer_store.add_buyer(str(random.randint(1000, 9999))):
+                break
+        times.append(time.perf_counter() - start)
+    results["random buyers"] = summary(times, 0, attempts)
+
+    # IDs from the market's counter, every seller has its own port (the OS never gives out one that is in use)
+    registry = market.SellerRegistry(os.path.join(directory, "allocated.db"))
+    times, refused = [], 0
+    for n in range(sellers):
+        start = time.perf_counter()
+        refused += registry.join("127.0.0.1", 10000 + n, ["sugar"]) is None
+        times.append(time.perf_counter() - start)
+    results["JOIN sellers"] = summary(times, refused, sellers)
+
+    times = []
+    for _ in range(buyers):
+        start = time.perf_counter()
+        registry.new_buyer()
+        times.append(time.perf_counter() - start)
+    results["NEWBUYER buyers"] = summary(times, 0, buyers)
+
+    # Whole start of real sellers (bind port 0, JOIN) and buyers (NEWBUYER) against a running market
+    market_port = free_port()
+    with contextlib.redirect_stdout(io.StringIO()):
+        threading.Thread(target=market.start_market, args=("127.0.0.1", market_port, registry), daemon=True).start()
+        time.sleep(0.2)
+        seller_times, buyer_times, running = [], [], []
+        for _ in range(started):
+            start = time.perf_counter()
+            seller = Seller(None, "127.0.0.1", 0, {"sugar": 10})
+            seller.node_id = market.join("127.0.0.1", seller.port, ["sugar"], ("127.0.0.1", market_port))
+            seller_times.append((time.perf_counter() - start) * 1000)
+            running.append(seller)
+
+            start = time.perf_counter()
+            market.new_buyer_id(("127.0.0.1", market_port))
+            buyer_times.append((time.perf_counter() - start) * 1000)
+        for seller in running:
+            seller.sock.close()
+    results["start over TCP"] = {"seller_p50_ms": percentile(seller_times, 50), "seller_p99_ms": percentile(seller_times, 99),
+                                 "buyer_p50_ms": percentile(buyer_times, 50), "buyer_p99_ms": percentile(buyer_times, 99)}
+
+    print(f"Startup of {sellers} sellers and {buyers} buyers, average time per node")
+    for name in ("random sellers", "random buyers", "JOIN sellers", "NEWBUYER buyers"):
+        r = results[name]
+        print(f"  {name:16} first {sample}: {r['first_us']:8.1f}us   last {sample} of {r['count']}: {r['last_us']:8.1f}us   "
+              f"{r['attempts_per_node']:5.2f} attempts per node   {r['refused']} refused")
+    r = results["start over TCP"]
+    print(f"  {started} sellers bind port 0 and JOIN  p50 {r['seller_p50_ms']:.3f}ms  p99 {r['seller_p99_ms']:.3f}ms   "
+          f"NEWBUYER p50 {r['buyer_p50_ms']:.3f}ms  p99 {r['buyer_p99_ms']:.3f}ms")
+    return results
+
+
+# Start sellers as headless processes, the way a capacity test spins up a fleet, then drive them through their admin sockets
+def bench_fleet(sellers=20):
+    directory = tempfile.mkdtemp(prefix="bench-fleet-")
+    stock_path = os.path.join(directory, "stock.json")
+    with open(stock_path, "w") as f:
+        json.dump({"sugar": 1000, "oil": 500}, f)
+    market_port = free_port()
+    registry = market.SellerRegistry(os.path.join(directory, "market.db"))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        threading.Thread(target=market.start_market, args=("127.0.0.1", market_port, registry), daemon=True).start()
+        time.sleep(0.2)
+
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "seller.py"), "--headless", "--stock", stock_path,
+               "--sell", "sugar", "--duration", "3600", "--control", "0", "--market", f"127.0.0.1:{market_port}"]
+    processes, clients, startup, reported = [], [], [], []
+    try:
+        for _ in range(sellers):
+            start = time.perf_counter()
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+            processes.append(process)
+            line = next(line for line in process.stdout if line.startswith("Ready:"))
+            startup.append((time.perf_counter() - start) * 1000)
+            threading.Thread(target=process.stdout.read, daemon=True).start() # Keep reading so the seller never blocks on a full pipe
+
+            fields = dict(field.split("=") for field in line.split()[1:])
+            reported.append(float(fields["startup"].rstrip("ms")))
+            clients.append(control.ControlClient(("127.0.0.1", int(fields["control"]))))
+        listed = len(market.parse_listing(market.send_command("LIST", "127.0.0.1", market_port)))
+
+        command_times = {}
+        for admin in ("RESTOCK sugar 10", "SALE oil 3600", "STOCK", "END oil"):
+            times = command_times[admin.split()[0]] = []
+            for client in clients:
+                start = time.perf_counter()
+                reply = client.request(admin)
+                times.append((time.perf_counter() - start) * 1000)
+                if not reply.startswith("OK"):
+                    raise RuntimeError(f"{admin}: {reply}")
+    finally:
+        for client in clients:
+            client.close()
+        for process in processes:
+            process.terminate() # Deregisters, like Ctrl+C
+        for process in processes:
+            process.wait()
+    left = len(market.parse_listing(market.send_command("LIST", "127.0.0.1", market_port)))
+
+    results = {
+        "startup_p50_ms": percentile(startup, 50),
+        "startup_p99_ms": percentile(startup, 99),
+        "in_process_p50_ms": percentile(reported, 50), # From the seller's __main__ to serving, without starting Python
+        "registered": listed,
+        "registered_after_stop": left,
+        "commands": {name: {"p50_ms": percentile(times, 50), "p99_ms": percentile(times, 99)} for name, times in command_times.items()},
+    }
+    print(f"Fleet of {sellers} headless sellers ({listed} registered, {left} left after stopping them)")
+    print(f"  process start to serving  p50 {results['startup_p50_ms']:7.1f}ms  p99 {results['startup_p99_ms']:7.1f}ms   "
+          f"({results['in_process_p50_ms']:.1f}ms p50 of it after the imports)")
+    for name, r in results["commands"].items():
+        print(f"  {name:8} p50 {r['p50_ms']:6.3f}ms  p99 {r['p99_ms']:6.3f}ms")
+    return results
+
+
+# Simulated buyers that only send LIST and CURRENT, as fast as the seller answers, for each way of hosting them
+def hammer(session):
+    while True:
+        yield "LIST"
+        yield "CURRENT"
+
+# The old way: a thread and a blocking socket per buyer, like BuyerClient with its listener
+def thread_buyers(port, buyers, seconds, latencies, ready):
+    stop = time.monotonic() + seconds
+    def buyer():
+        sock = socket.create_connection(("127.0.0.1", port))
+        decoder = codec.TextCodec()
+        def reply():
+            while True:
+                frame = decoder.next_message()
+                if frame:
+                    return frame
+                decoder.feed(sock.recv(65536))
+        reply() # Connected|
+        sock.sendall(b"ID 1\n")
+        reply()
+        ready.release()
+        while time.monotonic() < stop:
+            for command in (b"LIST\n", b"CURRENT\n"):
+                start = time.monotonic()
+                sock.sendall(command)
+                reply()
+                latencies.add(time.monotonic() - start)
+        sock.close()
+    threads = [threading.Thread(target=buyer, daemon=True) for _ in range(buyers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+# Runs in a forked process, so each runtime's memory and CPU time are its own
+def crowd_worker(runtime, port, buyers, seconds, results):
+    latencies = metrics.Histogram()
+    threads = 1
+    if runtime == "threads":
+        ready = threading.Semaphore(0)
+        threading.Thread(target=thread_buyers, args=(port, buyers, seconds, latencies, ready), daemon=True).start()
+        for _ in range(buyers):
+            ready.acquire()
+        threads = threading.active_count()
+        time.sleep(seconds)
+        count = latencies.snapshot()["count"]
+    elif runtime == "asyncio":
+        async def one(deadline):
+            client = AsyncBuyerClient(1)
+            await client.connect("127.0.0.1", port)
+            while time.monotonic() < deadline:
+                for command in ("LIST", "CURRENT"):
+                    sent = time.monotonic()
+                    await client.request(command)
+                    latencies.add(time.monotonic() - sent)
+            await client.close()
+        async def all_buyers():
+            await asyncio.gather(*(one(time.monotonic() + seconds) for _ in range(buyers)))
+        asyncio.run(all_buyers())
+        count = latencies.snapshot()["count"]
+    else:
+        runtime_crowd = crowd.Crowd()
+        for _ in range(buyers):
+            runtime_crowd.add(("127.0.0.1", port), hammer)
+        runtime_crowd.run(seconds)
+        report = runtime_crowd.report(seconds)
+        latencies = metrics.Histogram()
+        for name in ("LIST", "CURRENT"):
+            latencies.counts = [a + b for a, b in zip(latencies.counts, runtime_crowd.histogram(name).counts)]
+            latencies.max = max(latencies.max, runtime_crowd.histogram(name).max)
+        count = sum(report["commands"][name]["count"] for name in ("LIST", "CURRENT"))
+        runtime_crowd.close()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results.put({
+        "commands_per_sec": count / seconds,
+        "p50_ms": latencies.percentile(50) / 1000,
+        "p99_ms": latencies.percentile(99) / 1000,
+        "cpu_us_per_command": (usage.ru_utime + usage.ru_stime) / max(1, count) * 1e6,
+        "max_rss_mb": usage.ru_maxrss / 1024,
+        "threads": threads,
+    })
+
+# How many buyers one process can simulate: a thread per buyer, asyncio tasks, and the single-threaded selector crowd (crowd.py)
+# The seller is the event-loop engine in this process, every runtime gets its own forked process
+def bench_crowd(buyers=2000, seconds=3.0):
+    context = multiprocessing.get_context("fork")
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        seller = start_bench_seller(AsyncSeller, 4096)
+        for runtime in ("threads", "asyncio", "selectors"):
+            queue = context.Queue()
+            process = context.Process(target=crowd_worker, args=(runtime, seller.port, buyers, seconds, queue))
+            process.start()
+            results[runtime] = queue.get()
+            process.join()
+
+    print(f"{buyers} simulated buyers in one process, LIST and CURRENT for {seconds:g}s")
+    for runtime, r in results.items():
+        print(f"  {runtime:10} {r['commands_per_sec']:8.0f} commands/s   p50 {r['p50_ms']:7.2f}ms  p99 {r['p99_ms']:7.2f}ms   "
+              f"{r['cpu_us_per_command']:6.1f}us CPU per command   peak RSS {r['max_rss_mb']:6.1f}MB   {r['threads']} threads")
+    return results
+
+
+# The receive path before the per-connection buffer and the handler table, kept so bench_parser can compare:
+# every recv makes a bytes object that is appended to the buffer, every command is sliced and deleted off its front
+class OldTextCodec(codec.TextCodec):
+    def __init__(self, data=b""):
+        self.buffer = bytearray(data)
+
+    def receive(self, sock):
+        data = sock.recv(4096)
+        self.buffer += data
+        return len(data)
+
+    def next_line(self):
+        while True:
+            end = self.buffer.find(b"\n")
+            if end < 0:
+                if len(self.buffer) > codec.MAX_FRAME:
+                    raise codec.ProtocolError("Line too long")
+                return None
+            line = self.buffer[:end].decode().strip()
+            del self.buffer[:end + 1]
+            if line:
+                return line
+
+
+class OldBinaryCodec(codec.BinaryCodec):
+    def __init__(self, data=b""):
+        self.buffer = bytearray(data)
+
+    receive = OldTextCodec.receive
+
+    def next_frame(self):
+        if len(self.buffer) < codec.LENGTH.size:
+            return None
+        (length,) = codec.LENGTH.unpack_from(self.buffer)
+        if length < codec.HEADER.size or length > codec.MAX_FRAME:
+            raise codec.ProtocolError("Bad frame length")
+        end = codec.LENGTH.size + length
+        if len(self.buffer) < end:
+            return None
+        code, rid = codec.HEADER.unpack_from(self.buffer, codec.LENGTH.size)
+        text = bytes(self.buffer[codec.LENGTH.size + codec.HEADER.size:end]).decode()
+        del self.buffer[:end]
+        return code, rid, text
+
+
+# The old if/elif chain's order, each branch upper()ed the first word again before comparing
+OLD_CHAIN = ("PROTO", "ID", "LIST", "CURRENT", "BUY", "BID", "WITHDRAW", "RESERVE", "CONFIRM", "CANCEL", "QUIT", "PING", "REPLICAS", "STATS")
+
+# The old handle_batch: tagged commands skipped the reply cache, and every command got its own reply function
+# that framed the text with encode_message (the handlers' constant bytes replies are turned back into text for it)
+def old_handle_batch(seller, session, send):
+    replies = []
+    keep_open = True
+    while keep_open:
+        conn_codec = session["codec"]
+        frame = conn_codec.next_command()
+        if frame is None:
+            break
+        rid, command = frame
+
+        start = time.perf_counter()
+        cached = None if rid else seller.cached_replies.get(command)
+        if cached:
+            replies.append(cached.encoded(conn_codec))
+        else:
+            def reply(text, conn_codec=conn_codec, rid=rid):
+                replies.append(conn_codec.encode_message(codec.REPLY, text if type(text) is str else text.decode(), rid))
+            words = command.split()
+            handler = None
+            for name in OLD_CHAIN:
+                if words[0].upper() == name:
+                    handler = seller.handlers[name]
+                    break
+                if name == "ID" and seller.follower and words[0].upper() in WRITES:
+                    break
+            if handler:
+                keep_open = handler(session, words, reply)
+            else:
+                reply("Unknown command.")
+        name = command.partition(" ")[0].upper()
+        seller.command_times.get(name, seller.command_times["OTHER"]).record(time.perf_counter() - start)
+    if replies:
+        send(b"".join(replies))
+    return keep_open
+
+
+# Commands per second through one buyer connection's whole receive path, on one core: read from the socket into the
+# connection's buffer, decode, dispatch, build and frame the replies (the buyer side's write is counted too)
+# Every batch is a pipelined mix of cached reads, pings and rejected buys, so the stock never changes and what is
+# measured is the per-command work of the connection rather than the inventory, in each wire format
+# "before" is the same connection through OldTextCodec/OldBinaryCodec and old_handle_batch, "after" the seller's own path
+def bench_parser(commands=60000, batch=16, rounds=3):
+    mix = ["LIST", "PING", "CURRENT", "ID 1", "LIST 1", "BUY 0", "ping", "CURRENT 1", "BUY x:1", "STOP"]
+    lines = [mix[n % len(mix)] for n in range(batch)]
+    paths = {
+        "before": ({"TEXT": OldTextCodec, "BIN": OldBinaryCodec}, old_handle_batch),
+        "after": (codec.CODECS, lambda seller, session, send: seller.handle_batch(session, send)),
+    }
+    results = {}
+
+    for protocol, tagged in (("TEXT", False), ("TEXT", True), ("BIN", True)):
+        chunk = codec.encode_batch(codec.CODECS[protocol](), [(line, n + 1) if tagged else line for n, line in enumerate(lines)])
+        rates = {path: [] for path in paths}
+        for _ in range(rounds): # Alternate the two paths so both see the same machine noise
+            for path, (codecs, handle_batch) in paths.items():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    seller = Seller(1, "127.0.0.1", 0, {"sugar": 10**9, "oil": 10**9})
+                    seller.start_sale("sugar", duration=3600)
+                session = seller.new_session()
+                session["buyer_id"] = "1"
+                session["codec"] = codecs[protocol]()
+                buyer, sock = socket.socketpair()
+                start = time.process_time()
+                for _ in range(commands // batch):
+                    buyer.sendall(chunk)
+                    session["codec"].receive(sock)
+                    handle_batch(seller, session, lambda data: None)
+                rates[path].append(commands // batch * batch / (time.process_time() - start))
+                buyer.close()
+                sock.close()
+        name = f"{protocol.lower()}_{'tagged' if tagged else 'untagged'}"
+        results[name] = {path: max(rates[path]) for path in paths}
+
+    print(f"Buyer commands through recv, decode, dispatch and reply, {batch} per read")
+    for name, r in results.items():
+        print(f"  {name.replace('_', ' '):15} before {r['before']:10.0f}   after {r['after']:10.0f} commands/s per core   x{r['after'] / r['before']:.2f}")
+    return results
+
+
+# SEARCH on a market with 10k sellers publishing stock and sales (CATALOG): query latency, and how fast the index takes updates
+# "scan" ranks the same matches by going through every seller's entries per query, as a registry without the index would
+def bench_catalog(sellers=10000, items_per_seller=8, updates=100000, queries=2000):
+    nouns = ["sugar", "oil", "flower", "potato", "rice", "salt", "tea", "coffee", "milk", "flour"]
+    kinds = ["brown", "organic", "white", "large", "small", "fresh", "dried", "sweet", "red", "green"]
+    vocabulary = nouns + [f"{kind}_{noun}" for kind in kinds for noun in nouns]
+    rng = random.Random(1)
+    registry = market.SellerRegistry(os.path.join(tempfile.mkdtemp(prefix="bench-catalog-"), "market.db"))
+    for n in range(sellers):
+        registry.register(str(n), "127.0.0.1", 10000 + n, rng.sample(vocabulary, items_per_seller))
+    catalog_of = {sid: list(info["items"]) for sid, info in registry.sellers.items()}
+
+    # Every seller publishes its whole catalog once, then stock and sales change one item at a time
+    start = time.perf_counter()
+    for sid, items in catalog_of.items():
+        registry.publish(sid, [(item, rng.randrange(1000), rng.random() < 0.2) for item in items])
+    full_rate = sellers * items_per_seller / (time.perf_counter() - start)
+    changes = [(sid, [(rng.choice(catalog_of[sid]), rng.randrange(1000), rng.random() < 0.2)]) for sid in (str(rng.randrange(sellers)) for _ in range(updates))]
+    start = time.perf_counter()
+    for sid, entries in changes:
+        registry.publish(sid, entries)
+    update_rate = updates / (time.perf_counter() - start)
+
+    def scan(query):
+        found = registry.catalog.matching(query)
+        rows = [(item.lower() != query, catalog.rank(sid, *entries[item]), item) for sid, entries in registry.catalog.sellers.items() for item in entries if item in found]
+        return heapq.nsmallest(market.SEARCH_RESULTS, rows)
+
+    results = {"sellers": sellers, "entries": len(registry.catalog), "publish_full_per_sec": full_rate, "updates_per_sec": update_rate}
+    for query in ("sugar", "organic tea", "brown_rice", "caviar"):
+        matched = sum(len(registry.catalog.ranked[item]) for item in registry.catalog.matching(query))
+        for name, run, count in (("index", registry.search, queries), ("scan", scan, max(1, queries // 100))):
+            histogram = metrics.Histogram()
+            for _ in range(count):
+                start = time.perf_counter()
+                run(query)
+                histogram.record(time.perf_counter() - start)
+            results[f"{name} {query}"] = {"matched": matched, "p50_us": histogram.percentile(50), "p99_us": histogram.percentile(99)}
+
+    print(f"Catalog search, {sellers} sellers, {results['entries']} entries")
+    print(f"  publish whole catalogs {full_rate:10.0f} entries/s")
+    print(f"  incremental updates    {update_rate:10.0f} updates/s")
+    for name, r in results.items():
+        if isinstance(r, dict):
+            print(f"  {name:18} {r['matched']:6} matching entries   p50 {r['p50_us']:7}us   p99 {r['p99_us']:7}us")
+    return results
+
+
+BENCHMARKS = {
+    "engines": bench_seller_engines,
+    "codec": bench_codec,
+    "broadcast": bench_broadcast,
+    "inventory": bench_inventory,
+    "durability": bench_durability,
+    "registry": bench_registry,
+    "cluster": bench_cluster,
+    "pool": bench_pool,
+    "directory": bench_directory,
+    "metrics": bench_metrics,
+    "replies": bench_replies,
+    "auction": bench_auction,
+    "admission": bench_admission,
+    "replication": bench_replication,
+    "startup": bench_startup,
+    "fleet": bench_fleet,
+    "crowd": bench_crowd,
+    "parser": bench_parser,
+    "catalog": bench_catalog,
+}
+
+# python benchmark.py [name ...] runs the named benchmarks, or all of them
+if __name__ == "__main__":
+    metrics.set_log_level("WARNING") # No per-connection messages from the servers being measured
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,229 @@
+import collections
+import selectors # Lets one writer thread wait on many sockets at once
+import socket
+import threading
+import time
+
+POLICIES = ("coalesce", "disconnect")
+
+
+# Outbound queue for one buyer
+class Channel:
+    def __init__(self, sock, session):
+        self.sock = sock
+        self.session = session # The seller's per-connection state, passed to the encode function
+        self.queue = collections.deque() # Entries waiting to be written: [data, key, time queued]
+        self.keyed = {} # key -> queued entry, so a newer update with the same key can replace it
+        self.out = None # memoryview of the entry currently being written
+        self.out_queued = 0 # When the entry being written was queued
+        self.watching = False # True while the writer waits for this socket to become writable
+        self.closed = False
+        self.drained = threading.Event() # Set whenever everything queued has been written
+        self.drained.set()
+
+
+# Sends replies and notifications to buyers without ever blocking the caller
+# Every buyer has a bounded queue that a single writer thread drains with non-blocking sends
+# policy decides what happens to a buyer whose queue is full:
+#   "coalesce"   - queued updates with the same key are replaced by the latest one, disconnect only if still full
+#   "disconnect" - the buyer is disconnected
+class Broadcaster:
+    def __init__(self, max_queue=256, policy="coalesce"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy: {policy}")
+
+        self.max_queue = max_queue
+        self.policy = policy
+        self.channels = {} # socket -> Channel
+        self.ready = [] # Channels that got new data since the writer last looked
+        self.lock = threading.Lock() # Protects the queues, held only for short appends and pops
+        self.watch_lock = threading.Lock() # Protects the selector registrations
+
+        self.selector = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair() # Used to wake the writer thread up
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+
+        # Numbers reported by metrics()
+        self.published = 0
+        self.coalesced = 0
+        self.disconnected = 0
+        self.fanout_total = 0.0
+        self.fanout_max = 0.0
+        self.written = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Start managing a buyer's socket, from now on all writes to it must go through the broadcaster
+    def add(self, sock, session):
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Writes are already batched, don't let Nagle hold replies back
+        with self.lock:
+            self.channels[sock] = Channel(sock, session)
+
+    # Stop managing a buyer's socket, must be called before the socket is closed
+    # wait gives the writer that many seconds to finish sending what is queued (e.g. the reply to QUIT)
+    def remove(self, sock, wait=0):
+        channel = self.channels.get(sock)
+        if channel and wait:
+            channel.drained.wait(wait)
+
+        with self.lock:
+            channel = self.channels.pop(sock, None)
+            if channel:
+                channel.closed = True
+        if channel:
+            self.watch(channel, False) # Writer thread stops watching it
+
+    # Queue data for one buyer, e.g. a reply to a command
+    def send(self, sock, data, key=None):
+        with self.lock:
+            channel = self.channels.get(sock)
+            if channel:
+                self.enqueue(channel, data, key, time.perf_counter())
+        self.wake()
+
+    # Queue a notification for every buyer
+    # encode(session) returns the bytes for a buyer, so the caller can encode once per protocol
+    def publish(self, encode, key=None):
+        start = time.perf_counter()
+        with self.lock:
+            for channel in list(self.channels.values()):
+                self.enqueue(channel, encode(channel.session), key, start)
+            self.published += 1
+
+        fanout = time.perf_counter() - start
+        self.fanout_total += fanout
+        self.fanout_max = max(self.fanout_max, fanout)
+        self.wake()
+
+    # Add an entry to a channel's queue applying the policy, caller holds the lock
+    def enqueue(self, channel, data, key, queued):
+        if channel.closed:
+            return
+
+        # The buyer hasn't read the previous update for this key yet, replace it with the new one
+        if key is not None and self.policy == "coalesce" and key in channel.keyed:
+            channel.keyed[key][0] = data
+            self.coalesced += 1
+            return
+
+        if len(channel.queue) >= self.max_queue:
+            self.drop(channel) # Too far behind
+            return
+
+        entry = [data, key, queued]
+        channel.queue.append(entry)
+        channel.drained.clear()
+        if key is not None:
+            channel.keyed[key] = entry
+        if len(channel.queue) == 1:
+            self.ready.append(channel)
+
+    # Disconnect a buyer, caller holds the lock
+    # shutdown (not close) so the buyer's handler sees the end of the connection and calls remove
+    def drop(self, channel):
+        if channel.closed:
+            return
+        channel.closed = True
+        channel.queue.clear()
+        channel.keyed.clear()
+        channel.drained.set()
+        self.ready.append(channel)
+        self.disconnected += 1
+        try:
+            channel.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def wake(self):
+        try:
+            self.wake_w.send(b"x")
+        except BlockingIOError:
+            pass # Already woken up
+
+    # Writer thread: write to every channel that has data and whose socket can take it
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wake_r:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.flush(key.data)
+
+            with self.lock:
+                ready, self.ready = self.ready, []
+            for channel in ready:
+                self.flush(channel)
+
+    # Write as much of a channel's queue as the socket accepts right now
+    def flush(self, channel):
+        while not channel.closed:
+            if channel.out is None:
+                with self.lock:
+                    if not channel.queue:
+                        channel.drained.set()
+                        break
+                    entry = channel.queue.popleft()
+                    if entry[1] is not None and channel.keyed.get(entry[1]) is entry:
+                        del channel.keyed[entry[1]] # Being written now, later updates queue behind it
+                channel.out = memoryview(entry[0])
+                channel.out_queued = entry[2]
+
+            try:
+                sent = channel.sock.send(channel.out)
+            except (BlockingIOError, InterruptedError):
+                self.watch(channel, True) # Socket buffer is full, try again once it is writable
+                return
+            except OSError:
+                with self.lock:
+                    self.drop(channel)
+                break
+
+            channel.out = channel.out[sent:]
+            if not channel.out:
+                channel.out = None
+                latency = time.perf_counter() - channel.out_queued
+                self.written += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+        self.watch(channel, False)
+
+    # Start or stop waiting for a channel's socket to become writable
+    def watch(self, channel, writable):
+        with self.watch_lock:
+            if writable and not channel.watching and not channel.closed:
+                self.selector.register(channel.sock, selectors.EVENT_WRITE, channel)
+                channel.watching = True
+            elif not writable and channel.watching:
+                try:
+                    self.selector.unregister(channel.sock)
+                except (KeyError, ValueError):
+                    pass
+                channel.watching = False
+
+    # Broadcast latency and queue depth numbers
+    def metrics(self):
+        with self.lock:
+            depths = [len(channel.queue) for channel in self.channels.values() if not channel.closed]
+        return {
+            "clients": len(depths),
+            "published": self.published,
+            "written": self.written,
+            "coalesced": self.coalesced,
+            "disconnected": self.disconnected,
+            "queue_depth_max": max(depths, default=0),
+            "queue_depth_total": sum(depths),
+            "fanout_avg_ms": self.fanout_total / self.published * 1000 if self.published else 0.0,
+            "fanout_max_ms": self.fanout_max * 1000,
+            "latency_avg_ms": self.latency_total / self.written * 1000 if self.written else 0.0,
+            "latency_max_ms": self.latency_max * 1000,
+        }
@@ -1,132 +1,220 @@
 import socket # Socket module for network communication
-import json # Used to read and write JSON data
 import threading # Used to handle concurrent connections (multithreading)
 import time
 import random
+import sys
+import itertools
+import asyncio # Used by AsyncBuyerClient for scripted buyers
+from concurrent.futures import Future # A reply that will arrive later
+import market # Used to query the market server
+import codec # Framing for the buyer/seller protocol
+import store # Buyer records in the shared sqlite store
 
 
 class BuyerClient:
-    def __init__(self):
+    def __init__(self, binary=False):
         # Initialize buyer object
         self.seller_sock = None # This will hold the socket to communicate with seller
-        self.last_reply = None  # used to store last reply from seller (from the server)
-
-        # Generate random id
-        self.buyer_id = str(random.randint(1000, 9999))
-
-        # Register buyer ID and save to JSON file
+        self.binary = binary # Ask the seller for the binary protocol when connecting
+        self.codec = codec.TextCodec() # Decodes the messages coming from the seller
+        self.timeout = 5.0 # Seconds to wait for a reply before giving up
+
+        # Every request gets an id, the seller tags its reply with the same id
+        # so many requests can be in flight at once on the one connection
+        self.rids = itertools.count(1)
+        self.pending = {} # request id -> Future for the reply
+        self.pending_lock = threading.Lock()
+        self.send_lock = threading.Lock() # Keeps writes from different threads whole
+        self.welcome = None # Future for the "Connected|" message
+        self.leaving = False # Set while leave_seller() closes the connection, so the listener doesn't report it
+        self.listening = False # True while a listener thread reads the connection, requests fail fast without one
+
+        self.directory = market.Directory(on_change=self.seller_changed).start() # Sellers joining and leaving are pushed by the market
+        self.pool = None # Connections to every seller, opened the first time all sellers are checked
+        self.pool_loop = None # Event loop thread the pool runs on
+
+        # Get a buyer ID from the market, it also adds the buyer to the store
+        self.store = store.Store()
         self.register_buyer_id()
 
-    # Register buyer ID and save in file
+    # The market hands out IDs from a counter, so there are no collisions to retry and no limit on the number of buyers
     def register_buyer_id(self):
-        try:
-            with open("buyers.json", "r") as f:
-                buyers = json.load(f)
-        except:
-            # If file doesnt exist, initialize empty dicionary
-            buyers = {}
-
-        # Save buyer uniquely, their ID as the key
-        buyers[self.buyer_id] = {"connected": False}
-
-        # Write updated buyers data back to the buyers.json file
-        with open("buyers.json", "w") as f:
-            json.dump(buyers, f, indent=4)
-
+        self.buyer_id = market.new_buyer_id()
         print(f"Your Buyer ID is {self.buyer_id}")
 
     def join_market(self):
-        # Create a new socket to connect to the market server
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(("127.0.0.1", 8888)) # Connect to the market server, on localhost on port 8888
-
         print("\nMARKET")
-        # Receive and print the welcome message from the market server
-        print(sock.recv(4096).decode())
-
-        # Close socket after receiving the message
-        sock.close()
+        # The directory already has the list the market pushed, only ask the market if it isn't connected
+        if self.directory.synced.is_set():
+            sellers = dict(self.directory.sellers)
+            if not sellers:
+                print("No sellers available.")
+            else:
+                print("Available Sellers:")
+                for sid, info in sellers.items():
+                    print(f"ID={sid}, Host={info['host']}, Port={info['port']}")
+        else:
+            print(market.send_command("LIST"))
+
+    # Called by the directory when the market pushes a change
+    def seller_changed(self, action, seller_id, info):
+        if action == "ADD":
+            print(f"\nSeller {seller_id} joined the market (items: {' '.join(info['items'])})")
+        elif action == "REMOVE":
+            print(f"\nSeller {seller_id} left the market")
+        else:
+            return
+        print("Menu choice: ", end="", flush=True)
 
     # Function (thread) to listen for live messages from the seller
     def start_listener(self):
+        sock = self.seller_sock # The connection this listener reads, leave_seller() may replace self.seller_sock
+        self.listening = True
+
         def listen():
             # This loop listens for messages from the seller while connected
-            while self.seller_sock:
+            while True:
                 try:
-                    message = self.seller_sock.recv(4096) # Receive up to 4096 bytes of data from seller
+                    message = sock.recv(4096) # Blocks until data arrives, the seller closes the connection, or it fails
 
-                    if not message: # If no data received, sleep for a short time and continue
-                        time.sleep(0.1)
-                        continue
+                    if not message: # The seller closed the connection, every recv from now on would return b"" straight away
+                        break
 
-                    decoded = message.decode().strip() # Decode message and remove space
+                    self.codec.feed(message)
 
-                    # this checks if the decoded message is to notify all
-                    if decoded.startswith("Notification|"):
-                        clean = decoded.replace("Notification|", "") # Remove notification
-                        print(f"\n{clean}")
-                        print("Menu choice: ", end="", flush=True) # Prompt user input after displaying notif
+                    # One recv can hold several messages, or only part of one
+                    while True:
+                        frame = self.codec.next_message()
+                        if frame is None:
+                            break
+                        self.handle_message(*frame)
 
-                    # Checks if message is a reply or connected
-                    elif decoded.startswith("Reply|") or decoded.startswith("Connected|"):
-                        # Save the reply message after the reply or connected message
-                        self.last_reply = decoded.split("|", 1)[1]
+                except (OSError, codec.ProtocolError):
+                    break # Connection reset, closed by leave_seller(), or the seller sent something that isn't the protocol
 
-                except (ConnectionResetError, OSError):
-                    break # Break loop if connection is reset or there is an OS level error
-                except:
-                    continue
+            if self.seller_sock is sock:
+                with self.pending_lock:
+                    self.listening = False # Taken under the lock, so no request can slip in after fail_pending
+            self.fail_pending(ConnectionError("Disconnected from seller."))
+            if self.seller_sock is sock and not self.leaving:
+                print("\nThe seller closed the connection, choose 3 to leave it.")
+                print("Menu choice: ", end="", flush=True)
 
         # Start listener in a new thread so it runs concurrently
         t = threading.Thread(target=listen, daemon=True)
         t.start()
 
+    # Handle one decoded message from the seller
+    def handle_message(self, kind, rid, text):
+        # this checks if the message is to notify all
+        if kind == codec.NOTIFICATION:
+            print(f"\n{text}")
+            print("Menu choice: ", end="", flush=True) # Prompt user input after displaying notif
+
+        elif kind == codec.CONNECTED:
+            if self.welcome and not self.welcome.done():
+                self.welcome.set_result(text)
+
+        # A seller at its connection limit answers with an untagged error reply instead of "Connected"
+        elif rid == 0 and text.startswith("Error") and self.welcome and not self.welcome.done():
+            self.leaving = True # The seller closes the connection next, connect_to_seller() reports why
+            self.welcome.set_result(text)
+
+        # Otherwise it is a reply, hand it to whoever is waiting for that request id
+        else:
+            if text == "PROTO BIN":
+                self.codec = codec.switch(self.codec, "BIN") # Everything after this reply is binary
+            with self.pending_lock:
+                future = self.pending.pop(rid, None)
+            if future:
+                future.set_result(text)
+
+    # Fail every request that is still waiting, e.g. when the connection is lost
+    def fail_pending(self, error):
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+    # Send commands to the seller in one write without waiting, returns one Future per command
+    # Raises ConnectionError straight away if the connection is already gone, nothing would ever answer
+    def request(self, *commands):
+        futures = []
+        tagged = []
+        with self.pending_lock:
+            if not self.listening:
+                raise ConnectionError("Disconnected from seller.")
+            for command in commands:
+                rid = next(self.rids)
+                future = Future()
+                self.pending[rid] = future
+                futures.append(future)
+                tagged.append((command, rid))
+
+        with self.send_lock:
+            self.seller_sock.sendall(codec.encode_batch(self.codec, tagged))
+        return futures
+
+    # Send one command and wait for its reply
+    # Raises TimeoutError if the seller doesn't answer in time, ConnectionError if the connection is lost
+    def call(self, command, timeout=None):
+        [future] = self.request(command)
+        try:
+            return future.result(timeout or self.timeout)
+        except TimeoutError:
+            with self.pending_lock:
+                for rid, waiting in list(self.pending.items()):
+                    if waiting is future:
+                        del self.pending[rid] # A late reply is simply dropped
+            raise TimeoutError("The seller did not answer in time.")
+
     # Connect buyer to the seller using seller's ID
     def connect_to_seller(self):
         # Prompt the buyer to enter the seller id they want to buy
         seller_id = input("Enter Seller ID: ")
 
-        # Open the sellers.json file and read the list of available sellers
-        with open("sellers.json", "r") as f:
-            sellers = json.load(f)
+        # Ask the market where this seller is listening, unless the directory already knows
+        address = self.directory.lookup(seller_id)
+        reply = list(address) if address else market.send_command(f"LOOKUP {seller_id}").split()
 
-        # Check if the entered ID exists in the list
-        if seller_id not in sellers:
+        # Check if the entered ID exists in the market
+        if len(reply) != 2:
             print("Invalid seller ID.")
             return
 
         # Retrieve sellers host and port
-        host = sellers[seller_id]["host"]
-        port = sellers[seller_id]["port"]
+        host = reply[0]
+        port = int(reply[1])
 
         # Create a new socket to connect to the seller
         self.seller_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Connect to the seller by using the retrieved host and port
-        self.seller_sock.connect((host, port))
-
-        self.last_reply = None # Reset the last reply variable
-        self.start_listener() # Start the listener thread to receive messages
-
-        # Wait for welcome message
-        while self.last_reply is None:
-            time.sleep(0.05) # This is used to avoid busy-waiting
+        try:
+            # Connect to the seller by using the retrieved host and port
+            self.seller_sock.connect((host, port))
+
+            self.codec = codec.TextCodec() # Every connection starts with the text protocol
+            self.welcome = Future()
+            self.start_listener() # Start the listener thread to receive messages
+
+            # Wait for welcome message
+            welcome = self.welcome.result(self.timeout)
+        except (TimeoutError, OSError):
+            self.drop_connection()
+            raise ConnectionError("Could not connect to the seller.")
+        if welcome.startswith("Error"):
+            self.drop_connection()
+            raise ConnectionError(welcome) # Turned away by the seller's connection limit
+
+        # Ask for length-prefixed binary frames, the seller answers before switching
+        if self.binary:
+            self.call("PROTO BIN")
 
         # Otherwise, send the buyer id to seller
-        self.seller_sock.sendall(f"ID {self.buyer_id}".encode())
-        time.sleep(0.1)
+        reply = self.call(f"ID {self.buyer_id}")
 
-        # Mark buyer as connected in buyers.json
-        try:
-            with open("buyers.json", "r") as f:
-                buyers = json.load(f)
-            buyers[self.buyer_id]["connected"] = True # Set buyers connected status to True
-            with open("buyers.json", "w") as f:
-                json.dump(buyers, f, indent=4) # Save the buyers info
-        except:
-            pass
+        self.store.set_connected(self.buyer_id, True) # Mark buyer as connected
 
-        print(self.last_reply) # Print the seller's reply to the console
-        self.last_reply = None # Reset the last reply for next interaction
+        print(reply) # Print the seller's reply to the console
 
     # Request and show the list of available items from the current seller
     def list_items(self):
@@ -135,15 +223,7 @@ class BuyerClient:
             print("Connect to a seller first.")
             return
 
-        # Reset the reply variable
-        self.last_reply = None
-        self.seller_sock.sendall(b"LIST") # Send the list command to the seller to request available items
-
-        while self.last_reply is None:
-            time.sleep(0.05)  # Avoid busy waiting
-
-        print(self.last_reply)  # Print the sellers response
-        self.last_reply = None  # Reset the last reply for the next interaction
+        print(self.call("LIST")) # Send the list command to the seller and print the sellers response
 
     def buy_item(self):
         # Check first if the buyer is connected to a seller
@@ -152,53 +232,68 @@ class BuyerClient:
             return
 
         # Ask seller what is currently selling
-        self.last_reply = None
-        self.seller_sock.sendall(b"CURRENT") # Send the current command using byte literal, to the seller to get current item details
-
-        while self.last_reply is None:
-            time.sleep(0.05)  # Avoid busy waiting
-
-        print(self.last_reply)  # Print the sellers response
-        self.last_reply = None  # Reset the last reply for the next interaction
+        print(self.call("CURRENT"))
 
         amount = input("Enter amount: ")
 
         # Send buy command to the seller
-        self.last_reply = None
-        self.seller_sock.sendall(f"BUY {amount}".encode())
+        print(self.call(f"BUY {amount}"))
 
-        while self.last_reply is None:
-            time.sleep(0.05)  # Avoid busy waiting
-
-        print(self.last_reply)  # Print the sellers response
-        self.last_reply = None  # Reset the last reply for the next interaction
+    # Close a connection that never got going, without the QUIT of leave_seller()
+    def drop_connection(self):
+        self.leaving = True
+        self.seller_sock.close()
+        self.seller_sock = None
+        self.leaving = False
 
     # Disconnect from the seller
     def leave_seller(self):
         if self.seller_sock:
-            self.last_reply = None
-            self.seller_sock.sendall(b"QUIT") # Send the quit command to disconnect from seller
-
-            # Wait for seller's reply
-            while self.last_reply is None:
-                time.sleep(0.05)  # Avoid busy waiting
-
-            print(self.last_reply)  # Print the sellers response
-            self.last_reply = None  # Reset the last reply for the next interaction
+            self.leaving = True
+            # Send the quit command to disconnect from seller and wait for seller's reply
+            try:
+                print(self.call("QUIT"))
+            except (TimeoutError, ConnectionError):
+                pass # Leaving anyway
 
             self.seller_sock.close() # Close socket to seller
             self.seller_sock = None
+            self.leaving = False
             print("Disconnected from seller.")
 
-            # Mark buyer as disconnected in buyers.json
-            try:
-                with open("buyers.json", "r") as f:
-                    buyers = json.load(f)
-                buyers[self.buyer_id]["connected"] = False
-                with open("buyers.json", "w") as f:
-                    json.dump(buyers, f, indent=4) # Save updated buyers data
-            except:
-                pass
+            self.store.set_connected(self.buyer_id, False) # Mark buyer as disconnected
+
+    # Show every seller's stock, asking all the sellers at the same time over pooled connections
+    def check_all_sellers(self):
+        if self.pool is None:
+            self.pool_loop = asyncio.new_event_loop()
+            threading.Thread(target=self.pool_loop.run_forever, daemon=True).start()
+            self.pool = SellerPool(self.buyer_id, self.binary, self.timeout)
+            self.pool_loop.call_soon_threadsafe(self.pool.start)
+
+        stock, errors = asyncio.run_coroutine_threadsafe(self.pool.list_all(), self.pool_loop).result()
+        if not stock and not errors:
+            print("No sellers available.")
+        for item, sellers in sorted(stock.items()):
+            print(f"{item}: " + ", ".join(f"Seller {sid} ({count})" for sid, count in sorted(sellers.items(), key=lambda s: -s[1])))
+        for sid, error in errors.items():
+            print(f"Seller {sid} did not answer: {error}")
+
+    # Ask the market which sellers have an item, best first, without connecting to any of them
+    def search_items(self):
+        query = input("Search for: ").strip()
+        if not query:
+            return
+        try:
+            matches = market.search(query)
+        except OSError as e:
+            print(f"Could not reach the market: {e}")
+            return
+        if not matches:
+            print("No sellers have this item.")
+        for match in matches:
+            stock = "unknown stock" if match["stock"] is None else f"{match['stock']} left"
+            print(f"Seller {match['id']} ({match['host']}:{match['port']}): {match['item']}, {stock}" + (", on sale" if match["sale"] else ""))
 
     def menu(self):
         while True:
@@ -209,27 +304,328 @@ class BuyerClient:
             print("4. List Items")
             print("5. Buy Item")
             print("6. Exit Market")
+            print("7. Check All Sellers")
+            print("8. Search Items")
 
 
             choice = input("Menu choice: ")
 
-            if choice == "1":
-                self.join_market() # Join market (connect to the market server)
-            elif choice == "2":
-                self.connect_to_seller() # Connect to a seller
-            elif choice == "3":
-                self.leave_seller() # Leave the seller, go back to market
-            elif choice == "4":
-                self.list_items() # List available items from seller
-            elif choice == "5":
-                self.buy_item() # Buy an item from seller
-            elif choice == "6":
-                self.leave_seller() # 
-                print("You have left the market") # Leave seller and break from program
-                break
+            # A seller that went away or stopped answering only ends the action, not the buyer
+            try:
+                if choice == "1":
+                    self.join_market() # Join market (connect to the market server)
+                elif choice == "2":
+                    self.connect_to_seller() # Connect to a seller
+                elif choice == "3":
+                    self.leave_seller() # Leave the seller, go back to market
+                elif choice == "4":
+                    self.list_items() # List available items from seller
+                elif choice == "5":
+                    self.buy_item() # Buy an item from seller
+                elif choice == "6":
+                    self.leave_seller() # 
+                    print("You have left the market") # Leave seller and break from program
+                    break
+                elif choice == "7":
+                    self.check_all_sellers() # Stock of every seller in the market
+                elif choice == "8":
+                    self.search_items() # Which sellers have an item, from the market's catalog
+                else:
+                    print("Invalid choice.")
+            except (TimeoutError, ConnectionError, OSError) as e:
+                print(f"Error: {e}")
+
+# Buyer for scripts, every command is a coroutine:
+#     client = AsyncBuyerClient("1234")
+#     await client.connect_to_seller("42")
+#     print(await client.buy("sugar", 2))
+# Requests are tagged with ids, so many of them can be awaited at the same time on one connection
+class AsyncBuyerClient:
+    def __init__(self, buyer_id, binary=False, timeout=5.0):
+        self.buyer_id = str(buyer_id)
+        self.binary = binary
+        self.timeout = timeout # Seconds to wait for each reply
+        self.codec = codec.TextCodec()
+        self.rids = itertools.count(1)
+        self.pending = {} # request id -> asyncio future for the reply
+        self.polled = {} # "LIST"/"CURRENT" -> (version, text) of the last reply, see poll()
+        self.notifications = asyncio.Queue() # Notifications from the seller, for the script to read
+        self.reader = None
+        self.writer = None
+        self.listener = None
+
+    # Ask the market where the seller is, then connect to it
+    async def connect_to_seller(self, seller_id):
+        reply = await asyncio.get_running_loop().run_in_executor(None, market.send_command, f"LOOKUP {seller_id}")
+        address = reply.split()
+        if len(address) != 2:
+            raise ValueError("Invalid seller ID.")
+        return await self.connect(address[0], int(address[1]))
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        welcome = asyncio.get_running_loop().create_future()
+        self.pending[0] = welcome # The untagged "Connected|" message
+        self.listener = asyncio.ensure_future(self.listen())
+        if (await asyncio.wait_for(welcome, self.timeout)).startswith("Error"):
+            await self.close()
+            raise ConnectionError("Seller busy.") # Turned away by the seller's connection limit
+
+        if self.binary:
+            await self.request("PROTO BIN")
+        return await self.request(f"ID {self.buyer_id}")
+
+    async def listen(self):
+        try:
+            while True:
+                data = await self.reader.read(4096)
+                if not data:
+                    break
+                self.codec.feed(data)
+                while True:
+                    frame = self.codec.next_message()
+                    if frame is None:
+                        break
+                    kind, rid, text = frame
+                    if kind == codec.NOTIFICATION:
+                        self.notifications.put_nowait(text)
+                        continue
+                    if text == "PROTO BIN":
+                        self.codec = codec.switch(self.codec, "BIN")
+                    future = self.pending.pop(rid, None)
+                    if future and not future.done():
+                        future.set_result(text)
+        except (ConnectionError, OSError):
+            pass
+
+        # Connection closed, nobody waiting will get a reply
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Disconnected from seller."))
+        self.pending.clear()
+
+    # Send one command and wait for its reply, raises asyncio.TimeoutError if the seller doesn't answer in time
+    async def request(self, command, timeout=None):
+        if self.listener is None or self.listener.done():
+            raise ConnectionError("Disconnected from seller.") # Nothing would ever answer
+        rid = next(self.rids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[rid] = future
+        self.writer.write(self.codec.encode_command(command, rid))
+        try:
+            return await asyncio.wait_for(future, timeout or self.timeout)
+        finally:
+            self.pending.pop(rid, None)
+
+    async def list(self):
+        return await self.request("LIST")
+
+    async def current(self):
+        return await self.request("CURRENT")
+
+    # LIST or CURRENT that only transfers the reply when it changed since the last poll, returns the reply text either way
+    async def poll(self, command):
+        version, text = self.polled.get(command, ("0", None))
+        reply = await self.request(f"{command} {version}")
+        if reply.startswith("Not modified.") and text is not None:
+            return text
+        if reply.startswith("Version="):
+            tag, _, text = reply.partition(" ")
+            self.polled[command] = (tag.removeprefix("Version="), text)
+            return text
+        return reply # A seller that doesn't version its replies
+
+    # Buy n of an item, or several items with buy_many({"sugar": 2, "oil": 1})
+    async def buy(self, item, n):
+        return await self.request(f"BUY {item}:{n}")
+
+    async def buy_many(self, order):
+        return await self.request("BUY " + " ".join(f"{item}:{n}" for item, n in order.items()))
+
+    # Buy n of whatever is on sale now
+    async def buy_current(self, n):
+        return await self.request(f"BUY {n}")
+
+    async def quit(self):
+        try:
+            return await self.request("QUIT")
+        finally:
+            await self.close()
+
+    # True until the seller closes the connection or close() is called
+    @property
+    def connected(self):
+        return self.listener is not None and not self.listener.done()
+
+    # Waits for the connection to close, so a reset from a seller that died is consumed here instead of being
+    # reported as a never retrieved exception, a seller that doesn't read what is left to send gets it aborted
+    async def close(self):
+        writer, self.writer = self.writer, None
+        if writer:
+            writer.close()
+            try:
+                await asyncio.wait_for(writer.wait_closed(), self.timeout)
+            except (ConnectionError, OSError):
+                pass # Already reset by the seller
+            except asyncio.TimeoutError:
+                writer.transport.abort()
+        if self.listener:
+            self.listener.cancel()
+            self.listener = None
+
+# Persistent connections to many sellers at once, keyed by seller id
+# Connections are opened on first use and kept open, a health check PINGs them and drops the dead ones,
+# and a seller that can't be reached is retried with exponential backoff instead of on every request
+# gather() sends a command to many sellers in parallel, so asking 100 sellers takes about one round trip
+class SellerPool:
+    def __init__(self, buyer_id, binary=False, timeout=5.0, health_interval=10.0, max_backoff=30.0,
+                 market_address=(market.MARKET_HOST, market.MARKET_PORT), on_notification=None):
+        self.buyer_id = str(buyer_id)
+        self.binary = binary
+        self.timeout = timeout
+        self.health_interval = health_interval # Seconds between health checks
+        self.max_backoff = max_backoff # Longest wait between reconnect attempts
+        self.market_address = market_address
+        self.on_notification = on_notification # Called with (seller id, text), notifications are dropped if None
+
+        self.addresses = {} # seller id -> (host, port), from the market
+        self.clients = {} # seller id -> connected AsyncBuyerClient
+        self.connecting = {} # seller id -> task, callers asking for the same seller share one attempt
+        self.failures = {} # seller id -> (failed attempts in a row, time.monotonic() before which we don't retry)
+        self.forwarders = {} # seller id -> task passing that connection's notifications on
+        self.health = None # Health check task
+
+    # Get every seller's address with one LIST to the market, returns the seller ids
+    async def discover(self):
+        reply = await asyncio.get_running_loop().run_in_executor(None, market.send_command, "LIST", *self.market_address)
+        self.addresses = market.parse_listing(reply)
+        return list(self.addresses)
+
+    # The connection to a seller, connecting if needed
+    # Raises ConnectionError if the seller can't be reached or is still in its backoff period
+    async def get(self, seller_id):
+        client = self.clients.get(seller_id)
+        if client and client.connected:
+            return client
+
+        task = self.connecting.get(seller_id)
+        if task is None:
+            _, retry_at = self.failures.get(seller_id, (0, 0))
+            if time.monotonic() < retry_at:
+                raise ConnectionError(f"Seller {seller_id} is unreachable, retrying in {retry_at - time.monotonic():.1f}s")
+            task = asyncio.ensure_future(self.connect(seller_id))
+            self.connecting[seller_id] = task
+            task.add_done_callback(lambda _: self.connecting.pop(seller_id, None))
+        return await asyncio.shield(task) # One caller timing out doesn't cancel the attempt for the others
+
+    async def connect(self, seller_id):
+        client = AsyncBuyerClient(self.buyer_id, self.binary, self.timeout)
+        try:
+            address = self.addresses.get(seller_id)
+            if address is None:
+                reply = await asyncio.get_running_loop().run_in_executor(None, market.send_command, f"LOOKUP {seller_id}", *self.market_address)
+                fields = reply.split()
+                if len(fields) != 2:
+                    raise ConnectionError(f"Seller {seller_id} is not in the market")
+                address = (fields[0], int(fields[1]))
+            await client.connect(*address)
+        except (OSError, asyncio.TimeoutError) as e: # ConnectionError is an OSError
+            await client.close()
+            self.addresses.pop(seller_id, None) # It may have moved, ask the market again next time
+            attempts = self.failures.get(seller_id, (0, 0))[0] + 1
+            backoff = min(self.max_backoff, 0.1 * 2 ** attempts) * random.uniform(0.5, 1.0) # Jitter so buyers don't retry in step
+            self.failures[seller_id] = (attempts, time.monotonic() + backoff)
+            raise ConnectionError(f"Could not connect to seller {seller_id}: {e}") from e
+
+        await self.drop(seller_id) # An old connection the seller closed
+        self.failures.pop(seller_id, None)
+        self.clients[seller_id] = client
+        self.forwarders[seller_id] = asyncio.ensure_future(self.forward_notifications(seller_id, client))
+        return client
+
+    # Read a connection's notifications so they don't pile up, and hand them to on_notification
+    async def forward_notifications(self, seller_id, client):
+        while True:
+            text = await client.notifications.get()
+            if self.on_notification:
+                self.on_notification(seller_id, text)
+
+    # Send one command to one seller, a connection that fails is dropped so the next request reconnects
+    # With poll the command is a LIST or CURRENT that is only sent in full when it changed (AsyncBuyerClient.poll)
+    async def request(self, seller_id, command, poll=False):
+        client = await self.get(seller_id)
+        try:
+            return await (client.poll(command) if poll else client.request(command))
+        except (OSError, asyncio.TimeoutError):
+            await self.drop(seller_id)
+            raise
+
+    async def drop(self, seller_id):
+        forwarder = self.forwarders.pop(seller_id, None)
+        if forwarder:
+            forwarder.cancel()
+        client = self.clients.pop(seller_id, None)
+        if client:
+            await client.close()
+
+    # Send a command to many sellers (every known seller by default) at the same time
+    # Returns ({seller id: reply}, {seller id: error}), sellers that fail don't hold up the others
+    async def gather(self, command, seller_ids=None, poll=False):
+        if seller_ids is None:
+            seller_ids = await self.discover()
+        results = await asyncio.gather(*(self.request(sid, command, poll) for sid in seller_ids), return_exceptions=True)
+
+        replies, errors = {}, {}
+        for sid, result in zip(seller_ids, results):
+            if isinstance(result, Exception):
+                errors[sid] = result
             else:
-                print("Invalid choice.")
+                replies[sid] = result
+        return replies, errors
+
+    # LIST from every seller merged into {item: {seller id: stock}}, plus the errors of the sellers that failed
+    async def list_all(self, seller_ids=None):
+        replies, errors = await self.gather("LIST", seller_ids, poll=True) # Sellers whose stock didn't move send a short reply
+        stock = {}
+        for sid, reply in replies.items():
+            for entry in reply.removeprefix("Items: ").split(", "):
+                item, _, count = entry.partition("(")
+                if count:
+                    stock.setdefault(item, {})[sid] = int(count.rstrip(")"))
+        return stock, errors
+
+    # Start the health checks, call from inside the event loop
+    def start(self):
+        if self.health is None:
+            self.health = asyncio.ensure_future(self.check_health())
+
+    # PING every open connection, drop the ones that don't answer and reconnect sellers whose backoff has passed
+    async def check_health(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            open_ids = list(self.clients)
+            results = await asyncio.gather(*(self.request(sid, "PING") for sid in open_ids), return_exceptions=True)
+            for sid, result in zip(open_ids, results):
+                if isinstance(result, Exception):
+                    await self.drop(sid)
+
+            now = time.monotonic()
+            retry = [sid for sid, (_, retry_at) in self.failures.items() if retry_at <= now and sid not in self.clients]
+            await asyncio.gather(*(self.get(sid) for sid in retry), return_exceptions=True)
+
+    async def close(self):
+        if self.health:
+            self.health.cancel()
+            self.health = None
+        for sid in list(self.clients):
+            await self.drop(sid)
+
 
 # Entry point top run buyer client
 if __name__ == "__main__":
-    BuyerClient().menu()
+    try:
+        client = BuyerClient(binary="--binary" in sys.argv) # python buyer.py --binary uses the binary protocol
+    except ConnectionError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    client.menu()
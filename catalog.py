@@ -0,0 +1,107 @@
+import bisect
+import heapq
+import itertools
+import re
+
+# Item names are split into search terms on anything that isn't a letter or a digit ("brown_sugar" -> brown, sugar)
+TERM_SPLIT = re.compile(r"[^a-z0-9]+")
+
+
+# Lowercase terms of an item name or a query, the whole name is a term too so "brown_sugar" finds it
+def terms(text):
+    text = text.lower()
+    words = {word for word in TERM_SPLIT.split(text) if word}
+    words.add(text)
+    return words
+
+
+# Sort key of one seller's entry for an item, smallest first: on sale, then most stock, then lowest seller id
+# Stock the seller hasn't published yet (None) ranks like sold out
+def rank(seller_id, stock, on_sale):
+    return (not on_sale, -(stock or 0), seller_id)
+
+
+# Inverted index of every seller's items, for finding who sells what without asking each seller
+#   terms:   term -> set of item names with that term
+#   ranked:  item -> sorted list of rank() keys, one per seller of the item
+#   sellers: seller id -> {item: (stock, on sale)}
+# Changing an entry is a bisect out and a bisect in of the item's list, so the best sellers are always at the front
+# and a search only reads the few it returns, however many sellers there are
+# Not thread safe, the market's registry lock covers it like its other indexes
+class Catalog:
+    def __init__(self):
+        self.terms = {}
+        self.ranked = {}
+        self.sellers = {}
+
+    # Number of (seller, item) entries
+    def __len__(self):
+        return sum(len(keys) for keys in self.ranked.values())
+
+    # Set a seller's stock of an item and whether it is on sale, adding the entry if it is new
+    def set(self, seller_id, item, stock, on_sale):
+        entries = self.sellers.setdefault(seller_id, {})
+        old = entries.get(item)
+        if old == (stock, on_sale):
+            return
+        keys = self.ranked.get(item)
+        if keys is None:
+            keys = self.ranked[item] = []
+            for term in terms(item):
+                self.terms.setdefault(term, set()).add(item)
+        if old is not None:
+            del keys[bisect.bisect_left(keys, rank(seller_id, *old))]
+        bisect.insort(keys, rank(seller_id, stock, on_sale))
+        entries[item] = (stock, on_sale)
+
+    # Take a seller's entry for an item out of the index
+    def discard(self, seller_id, item):
+        entries = self.sellers.get(seller_id)
+        old = entries.pop(item, None) if entries else None
+        if old is None:
+            return
+        keys = self.ranked[item]
+        del keys[bisect.bisect_left(keys, rank(seller_id, *old))]
+        if not keys: # Nobody sells it any more
+            del self.ranked[item]
+            for term in terms(item):
+                self.terms[term].discard(item)
+                if not self.terms[term]:
+                    del self.terms[term]
+        if not entries:
+            del self.sellers[seller_id]
+
+    # Make a seller's entries match the items it registered with, new items start with unknown stock
+    def retain(self, seller_id, items):
+        items = set(items)
+        for item in set(self.sellers.get(seller_id, ())) - items:
+            self.discard(seller_id, item)
+        for item in items - set(self.sellers.get(seller_id, ())):
+            self.set(seller_id, item, None, False)
+
+    # Take every entry of a seller out of the index
+    def remove(self, seller_id):
+        for item in list(self.sellers.get(seller_id, ())):
+            self.discard(seller_id, item)
+
+    # Items whose terms include every word of the query, or named exactly like it
+    def matching(self, query):
+        words = [word for word in TERM_SPLIT.split(query.lower()) if word]
+        found = set.intersection(*(self.terms.get(word, set()) for word in words)) if words else set()
+        return found | self.terms.get(query.lower(), set())
+
+    # The sellers of an item, best first, as sort keys across items
+    def ranking(self, item, inexact):
+        for key in self.ranked[item]:
+            yield inexact, key, item
+
+    # The best limit entries for a query, as (seller id, item, stock, on sale)
+    # Items named exactly like the query come first, then the ranking of rank() across every matching item
+    def search(self, query, limit=20):
+        exact = query.lower()
+        lists = [self.ranking(item, item.lower() != exact) for item in self.matching(query)]
+        results = []
+        for _, (_, _, seller_id), item in itertools.islice(heapq.merge(*lists), limit):
+            stock, on_sale = self.sellers[seller_id][item]
+            results.append((seller_id, item, stock, on_sale))
+        return results
@@ -0,0 +1,197 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import socket
+import threading
+
+import inventory
+import scheduler
+from seller import Seller, AsyncSeller, SaleSession
+
+
+# Carries notifications between the processes of a cluster
+# Every worker has a datagram socket pair, anyone holding the sending end can post to that worker
+# The sending ends are non-blocking: a purchase or a timer never waits for a worker that is behind or gone,
+# the notification is dropped for that worker instead, like the broadcaster drops for a slow buyer
+class Bus:
+    def __init__(self, workers):
+        self.pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(workers)] # (receive, send) per worker
+        for _, send in self.pairs:
+            send.setblocking(False)
+
+    # Send a notification to every worker except skip (the worker that already delivered it to its own buyers)
+    # Returns how many workers it was dropped for, because their queue was full or they died
+    def publish(self, message, key=None, skip=None):
+        data = f"{key or ''}\n{message}".encode()
+        dropped = 0
+        for index, (_, send) in enumerate(self.pairs):
+            if index != skip:
+                try:
+                    send.send(data)
+                except (BlockingIOError, ConnectionRefusedError):
+                    dropped += 1
+        return dropped
+
+    # Wait for the next notification for a worker, returns (message, key)
+    def receive(self, worker):
+        data = self.pairs[worker][0].recv(65536)
+        key, _, message = data.decode().partition("\n")
+        return message, key or None
+
+
+# What a seller engine needs to run as one worker of a cluster
+# The cluster's parent process owns the sale sessions and timers, workers keep a copy of the sessions for on_sale/CURRENT
+class ClusterWorker:
+    def join_cluster(self, bus, index, commands, requests):
+        self.bus = bus
+        self.index = index
+        self.commands = commands # Parent -> worker: sale changes, answered with an acknowledgement
+        self.requests = requests # Worker -> parent: ask to end a sale
+        self.requests_lock = threading.Lock() # Many buyer threads can sell out at once
+        threading.Thread(target=self.receive_notifications, daemon=True).start()
+        threading.Thread(target=self.receive_commands, daemon=True).start()
+
+    # Deliver to this worker's buyers, then to every other worker's
+    def notify_buyers(self, message, key=None):
+        super().notify_buyers(message, key)
+        dropped = self.bus.publish(message, key, skip=self.index)
+        if dropped:
+            self.metrics.counter("bus.dropped").add(dropped)
+
+    def receive_notifications(self):
+        while True:
+            message, key = self.bus.receive(self.index)
+            super().notify_buyers(message, key) # Only to this worker's buyers
+
+    def receive_commands(self):
+        while True:
+            command = self.commands.recv()
+            if command[0] == "start":
+                _, item, started, deadline, warning = command
+                sale = SaleSession(item, deadline - started, warning)
+                sale.started, sale.deadline = started, deadline # time.monotonic() is the same clock in every process
+                with self.lock:
+                    self.sales[item] = sale
+                    self.sales_version += 1
+            elif command[0] == "end":
+                with self.lock:
+                    sale = self.sales.pop(command[1], None)
+                    self.sales_version += 1
+                if sale:
+                    sale.done.set()
+            self.commands.send(("ok",))
+
+    # Sales are ended by the parent, which tells every worker
+    def end_sale(self, item):
+        with self.requests_lock:
+            self.requests.send(("end_sale", item))
+        return item in self.sales
+
+
+class ClusterSeller(ClusterWorker, Seller):
+    pass
+
+class AsyncClusterSeller(ClusterWorker, AsyncSeller):
+    pass
+
+WORKER_ENGINES = {Seller: ClusterSeller, AsyncSeller: AsyncClusterSeller}
+
+
+# A seller spread over several processes, so it isn't limited to the one core the GIL allows
+# Every worker listens on the same port with SO_REUSEPORT and the kernel spreads the buyers between them
+# Stock is one SharedInventory in shared memory, notifications reach the buyers of every worker through the Bus
+# The parent process doesn't serve buyers, it runs the sale sessions (start_sale, end_sale, sell_item) like a Seller
+class SellerCluster(Seller):
+    def __init__(self, node_id, host, port, items, workers=None, engine=Seller, **options):
+        self.context = multiprocessing.get_context("fork") # Workers inherit the shared memory, locks and sockets
+        super().__init__(node_id, host, port, inventory.SharedInventory(items, self.context), reuse_port=True, **options)
+        # Only the workers listen, the parent's socket holds the port (the one the OS picked for port 0) until they have bound it
+
+        self.workers = workers or os.cpu_count()
+        self.engine = WORKER_ENGINES[engine]
+        self.options = options
+        self.bus = Bus(self.workers)
+        self.commands = [] # Parent ends of the command pipes, one per worker
+        self.commands_lock = threading.Lock()
+        self.processes = []
+
+    # Fork the workers and wait until every one of them is accepting buyers
+    def start_server(self):
+        print(f"Seller {self.node_id} Listening on port {self.port} ({self.workers} workers)")
+        requests = []
+        for index in range(self.workers):
+            commands, worker_commands = self.context.Pipe()
+            request_reader, request_writer = self.context.Pipe(duplex=False)
+            process = self.context.Process(target=self.run_worker, args=(index, worker_commands, request_writer), daemon=True)
+            process.start()
+            worker_commands.close() # The worker's ends, so the parent sees EOF when a worker exits
+            request_writer.close()
+            self.processes.append(process)
+            self.commands.append(commands)
+            requests.append(request_reader)
+
+        for commands in self.commands:
+            commands.recv() # ("ready",)
+        self.sock.close()
+        threading.Thread(target=self.receive_requests, args=(requests,), daemon=True).start()
+
+    # Runs in the forked worker process
+    def run_worker(self, index, commands, requests):
+        scheduler.shared_scheduler = None # The parent's timer thread wasn't copied into this process
+        worker = self.engine(self.node_id, self.host, self.port, self.items, reuse_port=True, **self.options)
+        worker.join_cluster(self.bus, index, commands, requests)
+        worker.start_server()
+        commands.send(("ready",))
+        threading.Event().wait() # The worker's threads do the rest
+
+    # Workers asking the parent to end a sale (e.g. its item sold out)
+    def receive_requests(self, requests):
+        while True:
+            for connection in multiprocessing.connection.wait(requests):
+                try:
+                    _, item = connection.recv()
+                except EOFError:
+                    requests.remove(connection) # Worker exited
+                    continue
+                self.end_sale(item)
+
+    # Send a command to every worker and wait for all of them to apply it
+    def command_workers(self, *command):
+        with self.commands_lock:
+            for commands in self.commands:
+                commands.send(command)
+            for commands in self.commands:
+                commands.recv()
+
+    # Order books live in one process, the workers' buyers couldn't all bid into the same one
+    def start_sale(self, item, duration=60, warning=10, bidding=None, ask=0):
+        if bidding:
+            raise ValueError("Auctions are not supported by a seller cluster")
+        return super().start_sale(item, duration, warning)
+
+    # Every worker changes the shared stock, there is no single stream of changes to send followers
+    def start_replication(self, host="127.0.0.1", port=0, mode="async", sock=None):
+        raise ValueError("Replication is not supported by a seller cluster")
+
+    # Workers know about the sale before buyers are told about it
+    def announce_sale(self, sale):
+        self.command_workers("start", sale.item, sale.started, sale.deadline, sale.warning)
+        super().announce_sale(sale)
+
+    def end_sale(self, item):
+        ended = super().end_sale(item)
+        if ended:
+            self.command_workers("end", item)
+        return ended
+
+    # The parent has no buyers of its own, every notification goes to the workers
+    def notify_buyers(self, message, key=None):
+        dropped = self.bus.publish(message, key)
+        if dropped:
+            self.metrics.counter("bus.dropped").add(dropped)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
@@ -0,0 +1,233 @@
+import struct # Used to pack the binary frame headers
+
+# Message kinds sent from seller to buyer
+CONNECTED = 1
+REPLY = 2
+NOTIFICATION = 3
+KIND_NAMES = {CONNECTED: "Connected", REPLY: "Reply", NOTIFICATION: "Notification"}
+KINDS = {name: kind for kind, name in KIND_NAMES.items()}
+
+# Opcodes for buyer commands in the binary protocol, TEXT carries any other command as text
+OPCODES = {"TEXT": 0, "ID": 1, "LIST": 2, "CURRENT": 3, "BUY": 4, "QUIT": 5}
+OPCODE_NAMES = {op: name for name, op in OPCODES.items()}
+
+LENGTH = struct.Struct("!H") # 2 byte length prefix in front of every binary frame
+HEADER = struct.Struct("!BI") # opcode (or kind) and request id at the start of every binary frame
+FRAME_HEADER = struct.Struct("!HBI") # Both at once, to build a frame with a single pack
+MAX_FRAME = 0xFFFF # Frames or lines bigger than this are rejected
+BUFFER_SIZE = 4096 # Starting size of a connection's receive buffer
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Split an "@<request id> " tag off the front of a text, returns (request id, rest), request id 0 if untagged
+def split_tag(text):
+    if text.startswith("@"):
+        tag, _, rest = text.partition(" ")
+        if tag[1:].isdigit():
+            return int(tag[1:]), rest
+    return 0, text
+
+
+# Receive buffer shared by both codecs, one per connection and reused for its whole life
+# receive() reads from the socket straight into it with recv_into, and commands are decoded from it in place,
+# so no bytes object is made per recv and nothing is copied per command
+# Bytes between start and end are received but not decoded yet, decoding only moves start
+# When everything was decoded both go back to 0, the undecoded tail of a command is only moved to the front when
+# the end of the buffer is reached, and the buffer only grows for a command bigger than it
+class Codec:
+    def __init__(self, data=b"", size=BUFFER_SIZE):
+        self.size = size
+        self.data = bytearray(max(size, len(data)))
+        self.view = memoryview(self.data)
+        self.start = 0
+        self.end = 0
+        if data:
+            self.feed(data)
+
+    # Number of bytes received but not decoded yet
+    def pending(self):
+        return self.end - self.start
+
+    # The bytes received but not decoded yet, e.g. to hand them to another codec
+    def unread(self):
+        return bytes(self.view[self.start:self.end])
+
+    # Make room for at least n more bytes after end
+    def reserve(self, n):
+        pending = self.end - self.start
+        if not pending:
+            self.start = self.end = 0
+            if len(self.data) > self.size >= n:
+                self.data = bytearray(self.size) # Done with a big command, give the memory back
+                self.view = memoryview(self.data)
+        if self.end + n <= len(self.data):
+            return
+
+        if pending + n > len(self.data):
+            # A bytearray can't be resized while the memoryview is held, grow into a new one
+            data = bytearray(max(2 * len(self.data), pending + n))
+            data[:pending] = self.view[self.start:self.end]
+            self.data = data
+            self.view = memoryview(data)
+        else:
+            self.data[:pending] = bytes(self.view[self.start:self.end]) # Copied first as the two can overlap
+        self.start, self.end = 0, pending
+
+    # Add received bytes to the buffer
+    def feed(self, data):
+        self.reserve(len(data))
+        self.data[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    # Read from a socket straight into the buffer, returns the number of bytes, 0 if the other side closed
+    # Raises what sock.recv_into raises (e.g. BlockingIOError on a non-blocking socket with nothing to read)
+    def receive(self, sock):
+        if len(self.data) - self.end < self.size // 4 or self.start == self.end:
+            self.reserve(self.size // 4)
+        count = sock.recv_into(self.view[self.end:])
+        self.end += count
+        return count
+
+
+# Newline separated text protocol, the original "Reply|..." format
+# Used by default and as the fallback when the buyer doesn't ask for binary
+# A command can start with "@<request id> ", the reply then starts with the same tag ("Reply|@7 ...")
+class TextCodec(Codec):
+    name = "TEXT"
+    replies = {} # Untagged frames of constant (bytes) replies, built once
+
+    # Take the next complete line out of the buffer, or None if there isn't one yet
+    def next_line(self):
+        while True:
+            end = self.data.find(b"\n", self.start, self.end)
+            if end < 0:
+                if self.end - self.start > MAX_FRAME:
+                    raise ProtocolError("Line too long")
+                return None
+
+            line = str(self.view[self.start:end], "utf-8").strip()
+            self.start = end + 1
+            if line:
+                return line # Skip blank lines
+
+    # Seller side: returns (request id, command text) or None
+    def next_command(self):
+        line = self.next_line()
+        return None if line is None else split_tag(line)
+
+    # Buyer side: returns (kind, request id, text) or None
+    def next_message(self):
+        line = self.next_line()
+        if line is None:
+            return None
+        name, _, text = line.partition("|")
+        rid, text = split_tag(text)
+        return KINDS.get(name, REPLY), rid, text
+
+    def encode_command(self, command, rid=0):
+        if rid:
+            return f"@{rid} {command}\n".encode()
+        return (command + "\n").encode()
+
+    def encode_message(self, kind, text, rid=0):
+        if rid:
+            return f"{KIND_NAMES[kind]}|@{rid} {text}\n".encode()
+        return f"{KIND_NAMES[kind]}|{text}\n".encode()
+
+    # Seller side: a reply to the command with request id rid
+    # payload is a str, or bytes for the constant replies, whose untagged frames are only built once
+    def encode_reply(self, payload, rid=0):
+        if type(payload) is str:
+            payload = payload.encode()
+        elif not rid:
+            data = self.replies.get(payload)
+            if data is None:
+                data = self.replies[payload] = b"Reply|" + payload + b"\n"
+            return data
+        if rid:
+            return b"Reply|@%d %b\n" % (rid, payload)
+        return b"Reply|" + payload + b"\n"
+
+
+# Length prefixed binary protocol, negotiated with "PROTO BIN"
+# frame = length (2 bytes) + opcode/kind (1 byte) + request id (4 bytes) + utf-8 text
+class BinaryCodec(Codec):
+    name = "BIN"
+    replies = {}
+
+    # Take the next complete frame out of the buffer as (code, request id, text), or None
+    def next_frame(self):
+        start = self.start
+        if self.end - start < FRAME_HEADER.size:
+            return None
+
+        length, code, rid = FRAME_HEADER.unpack_from(self.data, start)
+        if length < HEADER.size or length > MAX_FRAME:
+            raise ProtocolError("Bad frame length")
+
+        end = start + LENGTH.size + length
+        if self.end < end:
+            return None # Wait for the rest of the frame
+
+        text = str(self.view[start + FRAME_HEADER.size:end], "utf-8")
+        self.start = end
+        return code, rid, text
+
+    def next_command(self):
+        frame = self.next_frame()
+        if frame is None:
+            return None
+
+        opcode, rid, args = frame
+        name = OPCODE_NAMES.get(opcode)
+        if name is None:
+            raise ProtocolError("Unknown opcode")
+        if name == "TEXT":
+            return rid, args
+        return rid, f"{name} {args}" if args else name
+
+    def next_message(self):
+        return self.next_frame()
+
+    def encode_frame(self, code, rid, text):
+        payload = text.encode()
+        if HEADER.size + len(payload) > MAX_FRAME:
+            raise ProtocolError("Message too long")
+        return FRAME_HEADER.pack(HEADER.size + len(payload), code, rid) + payload
+
+    def encode_command(self, command, rid=0):
+        name, _, args = command.partition(" ")
+        opcode = OPCODES.get(name.upper())
+        if opcode is None:
+            return self.encode_frame(OPCODES["TEXT"], rid, command)
+        return self.encode_frame(opcode, rid, args)
+
+    def encode_message(self, kind, text, rid=0):
+        return self.encode_frame(kind, rid, text)
+
+    def encode_reply(self, payload, rid=0):
+        if type(payload) is str:
+            payload = payload.encode()
+        elif not rid:
+            data = self.replies.get(payload)
+            if data is None:
+                data = self.replies[payload] = FRAME_HEADER.pack(HEADER.size + len(payload), REPLY, 0) + payload
+            return data
+        if HEADER.size + len(payload) > MAX_FRAME:
+            raise ProtocolError("Message too long")
+        return FRAME_HEADER.pack(HEADER.size + len(payload), REPLY, rid) + payload
+
+
+CODECS = {"TEXT": TextCodec, "BIN": BinaryCodec}
+
+# Switch a connection to another protocol, keeping any bytes that already arrived after the switch
+def switch(codec, name):
+    return CODECS[name](codec.unread())
+
+# Encode many commands into one write, so they can be pipelined to the seller
+# commands are strings, or (command, request id) pairs
+def encode_batch(codec, commands):
+    return b"".join(codec.encode_command(command) if isinstance(command, str) else codec.encode_command(*command) for command in commands)
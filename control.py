@@ -0,0 +1,165 @@
+import json
+import socket
+import sys
+import threading
+import time
+
+import auction
+
+# Admin commands, one line each, every reply is one line starting with "OK" or "Error:"
+#   STOCK                                    - OK {"item": stock, ...}
+#   RESTOCK <item> <quantity> [...]          - add stock at runtime, OK {"item": stock left, ...}
+#   LOAD <file>                              - RESTOCK from a JSON file {"item": quantity, ...} on the seller's machine
+#   SALE <item> [seconds] [warning] [mode] [ask] - start a sale session, mode "batch" or "continuous" sells it by bidding
+#   END <item>                               - end a sale session early
+#   ASK <item> <price>                       - change the asking price of a "continuous" auction
+#   SALES                                    - OK [[item, seconds left, warning, mode, ask], ...]
+#   INFO                                     - OK {"id": .., "host": .., "port": .., "items": [..]}
+#   STATS                                    - OK and the seller's metrics, as STATS from a buyer
+COMMANDS = ("STOCK", "RESTOCK", "LOAD", "SALE", "END", "ASK", "SALES", "INFO", "STATS")
+
+# Commands that change the stock or the sales, a follower refuses them like it refuses BUY
+WRITES = ("RESTOCK", "LOAD", "SALE", "END", "ASK")
+
+
+# Starting stock from a JSON file {"item": quantity, ...}
+def load_stock(path):
+    with open(path) as f:
+        stock = json.load(f)
+    if not isinstance(stock, dict) or not all(isinstance(quantity, int) and quantity >= 0 for quantity in stock.values()):
+        raise ValueError(f"{path} should hold {{\"item\": quantity, ...}}")
+    return stock
+
+
+# Admin socket of one seller, so a script can run it without anyone at the seller's terminal
+# Only listens on the given host (localhost by default), anyone who can connect can change the stock
+# Every connection gets a thread and can send any number of commands, the Seller methods it calls are thread safe
+class ControlServer:
+    def __init__(self, seller, host="127.0.0.1", port=0):
+        self.seller = seller
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname() # The port the OS picked for port 0
+        self.times = {name: seller.metrics.histogram(f"control.{name}") for name in COMMANDS}
+
+    def start(self):
+        self.sock.listen(16)
+        threading.Thread(target=self.accept_forever, daemon=True).start()
+        return self
+
+    def accept_forever(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return # Closed
+            threading.Thread(target=self.serve, args=(sock,), daemon=True).start()
+
+    def serve(self, sock):
+        try:
+            with sock, sock.makefile("rb") as lines:
+                for line in lines:
+                    sock.sendall((self.handle(line.decode().split()) + "\n").encode())
+        except OSError:
+            pass # Admin went away
+
+    # Run one command, returns the reply line
+    def handle(self, command):
+        name = command[0].upper() if command else ""
+        if name not in COMMANDS:
+            return "Error: Unknown command."
+        if name in WRITES and self.seller.follower:
+            return "Error: This seller is a read-only copy, send it to the seller it follows."
+
+        start = time.perf_counter()
+        try:
+            return self.run(name, command[1:])
+        except IndexError:
+            return "Error: Missing arguments."
+        except (ValueError, OSError) as e:
+            return f"Error: {e}"
+        finally:
+            self.times[name].record(time.perf_counter() - start)
+
+    def run(self, name, arguments):
+        seller = self.seller
+        if name == "STOCK":
+            return "OK " + json.dumps(seller.items.snapshot())
+
+        if name in ("RESTOCK", "LOAD"):
+            if name == "LOAD":
+                order = load_stock(arguments[0])
+            elif len(arguments) % 2 or not arguments:
+                raise ValueError("Usage: RESTOCK <item> <quantity> [<item> <quantity> ...]")
+            else:
+                order = {}
+                for item, quantity in zip(arguments[::2], arguments[1::2]):
+                    order[item] = order.get(item, 0) + int(quantity)
+            return "OK " + json.dumps(seller.restock(order))
+
+        if name == "SALE":
+            item = arguments[0]
+            duration = float(arguments[1]) if len(arguments) > 1 else 60
+            warning = float(arguments[2]) if len(arguments) > 2 else 10
+            bidding = arguments[3] if len(arguments) > 3 else None
+            if bidding and bidding not in auction.MODES:
+                raise ValueError(f"Unknown auction mode: {bidding}")
+            ask = float(arguments[4]) if len(arguments) > 4 else 0
+            seller.start_sale(item, duration, warning, bidding, ask)
+            return "OK"
+
+        if name == "END":
+            return "OK" if seller.end_sale(arguments[0]) else f"Error: {arguments[0]} is not on sale."
+
+        if name == "ASK":
+            filled = seller.set_ask(arguments[0], float(arguments[1]))
+            return f"OK {len(filled)} bids filled"
+
+        if name == "SALES":
+            return "OK " + json.dumps(seller.sales_state())
+
+        if name == "INFO":
+            return "OK " + json.dumps({"id": seller.node_id, "host": seller.host, "port": seller.port, "items": list(seller.items)})
+
+        return "OK " + json.dumps(seller.stats()) # STATS
+
+    def close(self):
+        self.sock.close()
+
+
+# Connection to a seller's admin socket, for scripts driving many sellers
+class ControlClient:
+    def __init__(self, address, timeout=5.0):
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.lines = self.sock.makefile("rb")
+
+    # Send one command, returns the reply line, raises ConnectionError if the seller went away
+    def request(self, command):
+        self.sock.sendall((command + "\n").encode())
+        reply = self.lines.readline()
+        if not reply:
+            raise ConnectionError("Seller closed the admin connection")
+        return reply.decode().strip()
+
+    def close(self):
+        self.lines.close()
+        self.sock.close()
+
+
+# python control.py <host:port> <command ...> sends one admin command to a seller started with --control
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python control.py <host:port> <command ...>")
+        sys.exit(1)
+
+    host, _, port = sys.argv[1].rpartition(":")
+    try:
+        client = ControlClient((host or "127.0.0.1", int(port)))
+        reply = client.request(" ".join(sys.argv[2:]))
+        client.close()
+    except OSError as e:
+        print(f"Error: Could not reach the seller: {e}")
+        sys.exit(1)
+    print(reply)
+    sys.exit(0 if reply.startswith("OK") else 1)
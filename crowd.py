@@ -0,0 +1,378 @@
+import argparse
+import errno
+import heapq
+import itertools
+import json
+import random
+import selectors
+import socket
+import sys
+import time
+
+import codec # Framing for the buyer/seller protocol
+import market # Sellers to spread the buyers over, and their IDs
+import metrics # Command latencies and connection counts
+
+# Thousands of simulated buyers in one thread of one process, instead of a process (and a listener thread) per buyer
+# Every buyer is a non-blocking socket on one selector and a behaviour script, a generator that yields what to do next:
+#   "<command>"     - send a command to the seller, the script gets the reply text back
+#   Sleep(seconds)  - think for a while, the script gets None back
+#   WaitFor(text)   - wait for a notification containing text, the script gets the notification back (None after the timeout)
+# Every buyer sends "ID <buyer id>" before its script starts, and QUIT is not needed: the connection is closed when the script ends
+
+
+class Sleep:
+    __slots__ = ("seconds",)
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class WaitFor:
+    __slots__ = ("text", "timeout")
+
+    def __init__(self, text, timeout=None):
+        self.text = text
+        self.timeout = timeout
+
+
+# Behaviour scripts, each takes the BuyerSession (for its buyer_id and random) and runs until the crowd stops
+
+# Look around: LIST and CURRENT, then think
+def browse(session, think=(0.5, 2.0)):
+    while True:
+        yield "LIST"
+        yield "CURRENT"
+        yield Sleep(session.random.uniform(*think))
+
+# Wait for the warning near the end of a sale ("10 seconds left for sugar.") and buy at the last moment
+def snipe(session, quantity=1):
+    while True:
+        warning = yield WaitFor("seconds left for")
+        item = warning.rsplit(" ", 1)[-1].rstrip(".")
+        yield f"BUY {item}:{quantity}"
+
+# Buy a lot of everything on sale (not by auction) in one order, every few seconds
+def bulk(session, quantity=50, think=(1.0, 3.0)):
+    while True:
+        current = yield "CURRENT"
+        items = [part.split(",")[0].removeprefix("Current: ") for part in current.split("; ")
+                 if part.startswith("Current: ") and "bidding=" not in part]
+        if items:
+            yield "BUY " + " ".join(f"{item}:{quantity}" for item in items)
+        yield Sleep(session.random.uniform(*think))
+
+BEHAVIOURS = {"browse": browse, "snipe": snipe, "bulk": bulk}
+
+
+# One simulated buyer: its connection, its script and the command it is waiting on (one at a time)
+class BuyerSession:
+    def __init__(self, crowd, buyer_id, address, behaviour, rng):
+        self.crowd = crowd
+        self.buyer_id = str(buyer_id)
+        self.address = address
+        self.random = rng
+        self.script = self.run(behaviour)
+        self.codec = codec.TextCodec()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.events = 0 # What the selector watches for
+        self.out = bytearray() # Bytes the socket didn't take yet
+        self.rids = itertools.count(1)
+        self.rid = 0 # Request id of the command in flight
+        self.command = None # Name of the command in flight, None if there is none
+        self.latency = None # Histogram of that command
+        self.sent = 0.0 # time.monotonic() it was sent
+        self.waiting = None # Text a WaitFor is looking for
+        self.wakeup = 0 # Changes whenever the session moves on, so an old timer knows it no longer applies
+        self.started = time.monotonic()
+        self.connected = False
+        self.closed = False
+
+    def run(self, behaviour):
+        if self.crowd.binary:
+            yield "PROTO BIN"
+        yield f"ID {self.buyer_id}"
+        yield from behaviour(self)
+
+    def connect(self):
+        error = self.sock.connect_ex(self.address)
+        if error not in (0, errno.EINPROGRESS):
+            self.close("refused")
+            return
+        self.watch(selectors.EVENT_WRITE) # Writable once connected
+
+    # Change what the selector watches for
+    def watch(self, events):
+        if events == self.events:
+            return
+        if not self.events:
+            self.crowd.selector.register(self.sock, events, self)
+        else:
+            self.crowd.selector.modify(self.sock, events, self)
+        self.events = events
+
+    def writable(self):
+        if not self.connected:
+            if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                self.close("refused")
+                return
+            self.connected = True
+            self.crowd.connect_times.add(time.monotonic() - self.started)
+            self.watch(selectors.EVENT_READ) # The script starts when the seller's welcome arrives
+            return
+        self.flush()
+
+    def readable(self):
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close("reset")
+            return
+        if not data:
+            self.close("disconnected") # The seller closed the connection, recv would return b"" forever
+            return
+
+        self.codec.feed(data)
+        while not self.closed:
+            try:
+                frame = self.codec.next_message()
+            except codec.ProtocolError:
+                self.close("protocol")
+                return
+            if frame is None:
+                break
+            self.handle(*frame)
+
+    def handle(self, kind, rid, text):
+        if kind == codec.NOTIFICATION:
+            self.crowd.notifications.add()
+            if self.waiting is not None and self.waiting in text:
+                self.waiting = None
+                self.resume(text)
+        elif kind == codec.CONNECTED:
+            self.resume(None)
+        elif rid == 0 and text.startswith("Error"):
+            self.close("busy") # Turned away by the seller's connection limit, every command of a session is tagged
+        elif rid == self.rid and self.command:
+            self.latency.add(time.monotonic() - self.sent)
+            self.command = None
+            if text == "PROTO BIN":
+                self.codec = codec.switch(self.codec, "BIN") # Everything after this reply is binary
+            self.resume(text)
+
+    # Run the script up to its next step and start that step
+    def resume(self, value):
+        self.wakeup += 1
+        try:
+            step = self.script.send(value)
+        except StopIteration:
+            self.close("done")
+            return
+        except Exception:
+            self.close("script")
+            return
+
+        if isinstance(step, str):
+            self.send(step)
+        elif isinstance(step, Sleep):
+            self.crowd.call_later(step.seconds, self)
+        elif isinstance(step, WaitFor):
+            self.waiting = step.text
+            if step.timeout is not None:
+                self.crowd.call_later(step.timeout, self)
+        else:
+            self.close("script")
+
+    # A Sleep or a WaitFor's timeout is up
+    def timer(self, wakeup):
+        if wakeup == self.wakeup and not self.closed:
+            self.waiting = None
+            self.resume(None)
+
+    def send(self, command):
+        self.rid = next(self.rids)
+        self.command = command.split(None, 1)[0].upper()
+        self.latency = self.crowd.histogram(self.command)
+        self.sent = time.monotonic()
+        data = self.codec.encode_command(command, self.rid)
+        if self.out:
+            self.out += data # Still writing an earlier command, keep the order
+            return
+        try:
+            sent = self.sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.close("reset")
+            return
+        if sent < len(data):
+            self.out += data[sent:]
+            self.watch(selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    def flush(self):
+        try:
+            sent = self.sock.send(self.out)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close("reset")
+            return
+        del self.out[:sent]
+        if not self.out:
+            self.watch(selectors.EVENT_READ)
+
+    def close(self, reason):
+        if self.closed:
+            return
+        self.closed = True
+        if self.events:
+            self.crowd.selector.unregister(self.sock)
+        self.sock.close()
+        self.script.close()
+        self.crowd.sessions.discard(self)
+        self.crowd.metrics.counter(f"closed.{reason}").add()
+
+
+# The runtime: one selector, one timer heap and the buyers, all driven from the thread that calls run()
+# Latencies go into metrics histograms ("command.<NAME>", "connect"), how buyers ended into counters ("closed.<reason>")
+class Crowd:
+    def __init__(self, timeout=5.0, binary=False):
+        self.timeout = timeout # Seconds a command may wait for its reply before the buyer gives up
+        self.binary = binary # Buyers switch to the binary protocol before their scripts start
+        self.selector = selectors.DefaultSelector()
+        self.sessions = set()
+        self.timers = [] # Heap of (time.monotonic(), sequence, session, wakeup)
+        self.sequence = itertools.count()
+        self.ids = itertools.count(1)
+        self.random = random.Random()
+        self.metrics = metrics.Registry()
+        self.connect_times = self.metrics.histogram("connect")
+        self.notifications = self.metrics.counter("notifications")
+        self.metrics.gauge("sessions", lambda: len(self.sessions))
+        self.histograms = {}
+
+    def histogram(self, command):
+        histogram = self.histograms.get(command)
+        if histogram is None:
+            histogram = self.histograms[command] = self.metrics.histogram(f"command.{command}")
+        return histogram
+
+    # Start a buyer connecting to a seller at address (host, port), behaviour is a script like browse
+    def add(self, address, behaviour, buyer_id=None):
+        session = BuyerSession(self, buyer_id or next(self.ids), address, behaviour, random.Random(self.random.random()))
+        self.sessions.add(session)
+        session.connect()
+        return session
+
+    def call_later(self, delay, session):
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.sequence), session, session.wakeup))
+
+    # Serve every buyer until they have all finished, or for duration seconds
+    def run(self, duration=None):
+        deadline = time.monotonic() + duration if duration else None
+        next_sweep = time.monotonic() + self.timeout / 4
+        while self.sessions:
+            now = time.monotonic()
+            if deadline and now >= deadline:
+                break
+            while self.timers and self.timers[0][0] <= now:
+                _, _, session, wakeup = heapq.heappop(self.timers)
+                session.timer(wakeup)
+            if now >= next_sweep:
+                self.expire(now)
+                next_sweep = now + self.timeout / 4
+
+            wait = min(next_sweep, deadline or next_sweep, self.timers[0][0] if self.timers else next_sweep) - now
+            for key, events in self.selector.select(max(0.0, wait)):
+                session = key.data
+                if events & selectors.EVENT_WRITE:
+                    session.writable()
+                if events & selectors.EVENT_READ and not session.closed:
+                    session.readable()
+
+    # Give up on buyers whose command has waited more than timeout seconds, or who never got connected
+    def expire(self, now):
+        for session in list(self.sessions):
+            if session.command and now - session.sent > self.timeout:
+                self.metrics.counter(f"timeouts.{session.command}").add()
+                session.close("timeout")
+            elif not session.connected and now - session.started > self.timeout:
+                session.close("timeout")
+
+    def close(self):
+        for session in list(self.sessions):
+            session.close("stopped")
+        self.selector.close()
+
+    # Commands answered per command name with their latencies, and how the buyers ended
+    def report(self, elapsed):
+        snapshot = self.metrics.snapshot()
+        commands = {name.removeprefix("command."): h for name, h in snapshot["histograms"].items() if name.startswith("command.")}
+        return {
+            "commands": {name: {"count": h["count"], "per_sec": h["count"] / elapsed, "p50_ms": h["p50_us"] / 1000,
+                                "p99_ms": h["p99_us"] / 1000, "p999_ms": h["p999_us"] / 1000} for name, h in commands.items()},
+            "total_per_sec": sum(h["count"] for h in commands.values()) / elapsed,
+            "connect_p99_ms": snapshot["histograms"]["connect"]["p99_us"] / 1000,
+            "notifications": snapshot["counters"].get("notifications", 0),
+            "closed": {name.removeprefix("closed."): n for name, n in snapshot["counters"].items() if name.startswith("closed.")},
+            "sessions": snapshot["gauges"]["sessions"],
+        }
+
+
+# "browse=2,snipe=1" -> [(behaviour, weight), ...]
+def parse_mix(text):
+    mix = []
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in BEHAVIOURS:
+            raise ValueError(f"Unknown behaviour: {name} (known: {', '.join(BEHAVIOURS)})")
+        mix.append((BEHAVIOURS[name], float(weight or 1)))
+    return mix
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Thousands of scripted buyers in one process, spread over the market's sellers")
+    parser.add_argument("--buyers", type=int, default=1000, help="number of simulated buyers")
+    parser.add_argument("--mix", default="browse=2,snipe=1,bulk=1", help=f"behaviour weights, from {', '.join(BEHAVIOURS)}")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run")
+    parser.add_argument("--market", default=f"{market.MARKET_HOST}:{market.MARKET_PORT}", help="market host:port")
+    parser.add_argument("--binary", action="store_true", help="buyers use the binary protocol")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds to wait for each reply")
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args(argv)
+
+# python crowd.py --buyers 2000 --mix browse=2,snipe=1,bulk=1 --duration 60
+if __name__ == "__main__":
+    options = parse_args(sys.argv[1:])
+    host, _, port = options.market.rpartition(":")
+    market_address = (host or market.MARKET_HOST, int(port))
+    try:
+        sellers = list(market.parse_listing(market.send_command("LIST", *market_address)).values())
+    except OSError as e:
+        print(f"Error: Could not reach the market: {e}")
+        sys.exit(1)
+    if not sellers:
+        print("No sellers in the market.")
+        sys.exit(1)
+
+    behaviours, weights = zip(*parse_mix(options.mix))
+    crowd = Crowd(options.timeout, options.binary)
+    for n in range(options.buyers):
+        buyer_id = market.new_buyer_id(market_address) # IDs from the market, so they don't clash with real buyers
+        crowd.add(sellers[n % len(sellers)], crowd.random.choices(behaviours, weights)[0], buyer_id)
+
+    start = time.monotonic()
+    crowd.run(options.duration)
+    results = crowd.report(time.monotonic() - start)
+    crowd.close()
+
+    print(f"{options.buyers} buyers on {len(sellers)} sellers for {options.duration:g}s, {results['sessions']} still connected at the end")
+    for name, r in sorted(results["commands"].items()):
+        print(f"  {name:8} {r['count']:8} {r['per_sec']:9.0f}/s   p50={r['p50_ms']:.3f}ms p99={r['p99_ms']:.3f}ms p999={r['p999_ms']:.3f}ms")
+    print(f"  {results['total_per_sec']:.0f} commands/s, {results['notifications']} notifications, connect p99 {results['connect_p99_ms']:.3f}ms")
+    print(f"  ended: {', '.join(f'{reason}={n}' for reason, n in sorted(results['closed'].items())) or 'none'}")
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
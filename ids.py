@@ -0,0 +1,23 @@
+import threading
+
+
+# Hands out unique, increasing numeric IDs for one kind of node ("seller" or "buyer"), replacing random picks
+# IDs come from blocks reserved in the store (store.Store.reserve_ids), so the store is written once per block
+# rather than once per ID, and no two markets sharing the store ever give out the same ID
+# IDs left in a block when the market stops are never used, so there can be gaps but never repeats
+class IdAllocator:
+    def __init__(self, store, kind, block=1000):
+        self.store = store
+        self.kind = kind
+        self.block = block
+        self.ids = iter(()) # What is left of the current block
+        self.lock = threading.Lock()
+
+    # Next unused ID, as a string like every other ID in the registry
+    def next(self):
+        with self.lock:
+            value = next(self.ids, None)
+            if value is None:
+                self.ids = iter(self.store.reserve_ids(self.kind, self.block))
+                value = next(self.ids)
+            return str(value)
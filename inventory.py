@@ -0,0 +1,336 @@
+import collections.abc
+import heapq
+import itertools
+import threading
+import time
+
+
+# Stock for one seller, with a lock per item instead of one lock for everything
+# Purchases of different items never wait on each other, and no lock is ever held while talking to a buyer
+# It behaves like a read-only dictionary (item -> stock), so code that only reads stock can use it like the old dict
+# With a journal (wal.WriteAheadLog) every change is logged, and the stock is recovered from the log if there is one
+# With replication (replication.Leader) every change is also streamed to followers, in the same records as the log
+# Locks are always taken in the order: item locks (sorted), reservations lock, journal, replication
+class Inventory(collections.abc.Mapping):
+    def __init__(self, items, journal=None):
+        self.stock = dict(items) # item -> units available
+        self.reservations = {} # reservation id -> {item: quantity}
+        self.expiry = [] # Heap of (expiry time, reservation id)
+        self.reservations_lock = threading.Lock() # Protects the two above
+        self.ids = itertools.count(1)
+        self.changes = itertools.count(1) # next() is atomic, so changes under different item locks still get different numbers
+        self.last_change = 0
+
+        self.journal = journal
+        self.replication = None # replication.Leader, set when followers copy this stock
+        self.checkpoint_lock = threading.Lock() # One snapshot at a time
+        if journal:
+            self.recover()
+
+        self.locks = {item: threading.Lock() for item in self.stock} # One lock per item (the shards)
+
+    # Record the wait and hold times of every item lock in a metrics.Registry ("lock.item.<name>.wait/hold")
+    def time_locks(self, registry):
+        self.locks = {item: registry.timed_lock(f"item.{item}", lock) for item, lock in self.locks.items()}
+
+    # Called after every stock change, caller holds the locks of the items it changed
+    def changed(self):
+        self.last_change = next(self.changes)
+
+    # Number that differs whenever the stock has changed, so a reply built from the stock can be cached until it moves
+    def version(self):
+        return self.last_change
+
+    # Reads don't need a lock, reading one int from a dict is atomic
+    def __getitem__(self, item):
+        return self.stock[item]
+
+    def __iter__(self):
+        return iter(self.stock)
+
+    def __len__(self):
+        return len(self.stock)
+
+    # Buy quantity of one item, returns (True, stock left) or (False, stock available)
+    def buy(self, item, quantity):
+        self.expire_reservations()
+        with self.locks[item]:
+            stock = self.stock[item]
+            if quantity > stock:
+                return False, stock
+            self.stock[item] = stock - quantity
+            self.changed()
+            sequence = self.log("T", {item: quantity})
+        self.saved(sequence)
+        return True, stock - quantity
+
+    # Buy several items at once, all or nothing
+    # order is {item: quantity}, returns (True, {item: stock left}) or (False, {item: stock available}) for the items that were short
+    def buy_many(self, order):
+        self.expire_reservations()
+        return self.take(order)
+
+    # Take stock for an order, caller has already checked the item names
+    # reservation is (id, ttl) when the stock is being reserved rather than bought
+    def take(self, order, reservation=None):
+        locks = [self.locks[item] for item in sorted(order)] # Always lock in the same order so two orders can't deadlock
+        for lock in locks:
+            lock.acquire()
+        try:
+            short = {item: self.stock[item] for item, quantity in order.items() if quantity > self.stock[item]}
+            if short:
+                return False, short
+            for item, quantity in order.items():
+                self.stock[item] -= quantity
+            self.changed()
+
+            if reservation is None:
+                sequence = self.log("T", order)
+            else:
+                rid, ttl = reservation
+                with self.reservations_lock:
+                    self.reservations[rid] = dict(order)
+                    heapq.heappush(self.expiry, (time.monotonic() + ttl, rid))
+                    self.holding(order, 1)
+                    sequence = self.log("R", order, rid)
+            result = {item: self.stock[item] for item in order}
+        finally:
+            for lock in locks:
+                lock.release()
+
+        self.saved(sequence)
+        return True, result
+
+    # Put stock back (restocking)
+    def add(self, order):
+        locks = [self.locks[item] for item in sorted(order)]
+        for lock in locks:
+            lock.acquire()
+        try:
+            for item, quantity in order.items():
+                self.stock[item] += quantity
+            self.changed()
+            sequence = self.log("A", order)
+        finally:
+            for lock in locks:
+                lock.release()
+        self.saved(sequence)
+
+    # Hold stock for ttl seconds, returns (reservation id, {item: stock left}) or (None, {item: stock available}) for the short items
+    def reserve(self, order, ttl=30.0):
+        self.expire_reservations()
+        rid = next(self.ids)
+        ok, result = self.take(order, (rid, ttl))
+        if not ok:
+            return None, result
+        return rid, result
+
+    # Turn a reservation into a purchase, returns the reserved order or None if it expired or doesn't exist
+    def commit(self, rid):
+        self.expire_reservations()
+        with self.reservations_lock:
+            order = self.reservations.pop(rid, None) # The stock was already taken when reserving
+            if order:
+                self.holding(order, -1)
+            sequence = self.log("C", rid) if order else (0, 0)
+        self.saved(sequence)
+        return order
+
+    # Give reserved stock back, returns the order that was released or None
+    def release(self, rid):
+        with self.reservations_lock:
+            order = self.reservations.get(rid)
+        if not order:
+            return None
+
+        # The item locks come before the reservations lock, so look the order up first then check it is still there
+        locks = [self.locks[item] for item in sorted(order)]
+        for lock in locks:
+            lock.acquire()
+        try:
+            with self.reservations_lock:
+                if self.reservations.pop(rid, None) is None:
+                    return None # Committed or released by someone else in the meantime
+                self.holding(order, -1)
+                for item, quantity in order.items():
+                    self.stock[item] += quantity
+                self.changed()
+                sequence = self.log("X", rid)
+        finally:
+            for lock in locks:
+                lock.release()
+
+        self.saved(sequence)
+        return order
+
+    # Units of an item held by open reservations, taken out of the stock but not sold yet
+    # Expired reservations still count until expire_reservations gives them back
+    def held(self, item):
+        with self.reservations_lock:
+            return sum(order.get(item, 0) for order in self.reservations.values())
+
+    # Called with the reservations lock held when a reservation is made (sign 1) or ends (sign -1)
+    # held() adds up the reservations themselves, SharedInventory counts them for the other workers too
+    def holding(self, order, sign):
+        pass
+
+    # Give back the stock of every reservation past its expiry time
+    def expire_reservations(self):
+        if not self.expiry or self.expiry[0][0] > time.monotonic():
+            return # Cheap check, nothing has expired
+
+        expired = []
+        with self.reservations_lock:
+            now = time.monotonic()
+            while self.expiry and self.expiry[0][0] <= now:
+                expired.append(heapq.heappop(self.expiry)[1])
+
+        for rid in expired:
+            self.release(rid)
+
+    # Copy of the current stock levels
+    def snapshot(self):
+        return dict(self.stock)
+
+    # Write a record to the journal and send it to the followers, caller holds the locks of everything it changed
+    # Returns the record's sequence numbers in the journal and the replication stream, 0 for whichever isn't used
+    def log(self, operation, *arguments):
+        sequence = self.journal.append(operation, *arguments) if self.journal else 0
+        shipped = self.replication.append(operation, *arguments) if self.replication else 0
+        return sequence, shipped
+
+    # Wait until a logged change is durable (depends on the journal's and the replication's modes), called after the locks are released
+    def saved(self, sequence):
+        sequence, shipped = sequence
+        if shipped:
+            self.replication.wait(shipped)
+        if not sequence:
+            return
+        self.journal.wait(sequence)
+        if self.journal.needs_checkpoint():
+            self.checkpoint()
+
+    # Rebuild the stock from the journal's snapshot and log, then start logging
+    # Reservations still open at the crash are given back, the buyers that held them are gone
+    def recover(self):
+        state, records = self.journal.recover()
+        if state:
+            self.stock.update(state["stock"]) # Items added since the snapshot keep their starting stock
+            open_reservations = {int(rid): order for rid, order in state["reservations"].items()}
+        else:
+            open_reservations = {}
+
+        for record in records:
+            self.replay(record, open_reservations)
+
+        for order in open_reservations.values():
+            for item, quantity in order.items():
+                self.stock[item] += quantity
+
+        self.journal.open(self.state())
+
+    # Apply one logged change [sequence, operation, arguments...] to the stock, reservations is {id: order} of the open ones
+    def replay(self, record, reservations):
+        operation, arguments = record[1], record[2:]
+        if operation in ("T", "R"):
+            for item, quantity in arguments[0].items():
+                self.stock[item] -= quantity
+            if operation == "R":
+                reservations[arguments[1]] = arguments[0]
+        elif operation == "A":
+            for item, quantity in arguments[0].items():
+                self.stock[item] += quantity
+        elif operation == "C":
+            reservations.pop(arguments[0], None)
+        elif operation == "X":
+            for item, quantity in reservations.pop(arguments[0], {}).items():
+                self.stock[item] += quantity
+
+    # Replace the stock and open reservations with a copy of another inventory's state(), items it didn't have get a lock
+    # The dictionaries are swapped whole, so readers never see them half filled
+    def restore(self, state):
+        self.locks = {item: self.locks.get(item) or threading.Lock() for item in state["stock"]}
+        self.reservations = {int(rid): order for rid, order in state["reservations"].items()}
+        self.stock = dict(state["stock"])
+        self.changed()
+
+    # Call fn with every lock held, so nothing changes while it runs (snapshots), returns what fn returns
+    def locked(self, fn):
+        locks = [self.locks[item] for item in sorted(self.locks)]
+        for lock in locks:
+            lock.acquire()
+        try:
+            with self.reservations_lock:
+                return fn()
+        finally:
+            for lock in locks:
+                lock.release()
+
+    # Stock and open reservations, as written to a snapshot
+    def state(self):
+        return {"stock": dict(self.stock), "reservations": {str(rid): dict(order) for rid, order in self.reservations.items()}}
+
+    # Snapshot the stock and start a new log, so the log doesn't grow forever and recovery stays quick
+    # Every lock is held only while the log file is switched, the snapshot is written afterwards
+    def checkpoint(self):
+        if not self.checkpoint_lock.acquire(blocking=False):
+            return # Another thread is already doing it
+
+        try:
+            state, sequence = self.locked(lambda: (self.state(), self.journal.rotate()))
+            self.journal.save_snapshot(state, sequence)
+        finally:
+            self.checkpoint_lock.release()
+
+
+# Stock levels in shared memory, one 64-bit counter per item, readable and writable from every forked process
+class SharedStock(collections.abc.MutableMapping):
+    def __init__(self, items, context):
+        self.index = {item: i for i, item in enumerate(items)} # item -> position in the array
+        self.counters = context.RawArray("q", list(items.values())) # No lock of its own, the inventory's item locks protect it
+
+    def __getitem__(self, item):
+        return self.counters[self.index[item]]
+
+    def __setitem__(self, item, value):
+        self.counters[self.index[item]] = value # Only existing items, the array can't grow
+
+    def __delitem__(self, item):
+        raise TypeError("Items can't be removed from shared stock")
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+# One inventory shared by the worker processes of a cluster (cluster.py)
+# Stock and item locks live in shared memory, so a purchase in one worker is seen by all of them straight away
+# Reservations stay in the worker that made them, the connection that holds one only ever talks to that worker
+# Must be created before the workers are forked, context is a multiprocessing context using "fork"
+class SharedInventory(Inventory):
+    def __init__(self, items, context):
+        super().__init__({})
+        self.stock = SharedStock(items, context)
+        self.locks = {item: context.Lock() for item in self.stock} # Process-shared, same acquire/release as threading.Lock
+        self.shared_version = context.RawValue("q", 0) # Stock version seen by every worker, read without a lock
+        self.version_lock = context.Lock() # Workers changing different items still need different numbers
+        self.holds = SharedStock(dict.fromkeys(items, 0), context) # item -> units held by the reservations of every worker
+        self.holds_lock = context.Lock()
+
+    def changed(self):
+        with self.version_lock:
+            self.shared_version.value += 1
+
+    def version(self):
+        return self.shared_version.value
+
+    # A worker only has its own reservations, so held() reads the count every worker keeps up to date
+    def held(self, item):
+        return self.holds[item]
+
+    def holding(self, order, sign):
+        with self.holds_lock:
+            for item, quantity in order.items():
+                self.holds[item] += sign * quantity
@@ -0,0 +1,283 @@
+import argparse
+import asyncio # Simulated buyers are coroutines, one process can drive hundreds of them
+import contextlib
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import market
+import metrics
+from benchmark import free_port, percentile
+from buyer import AsyncBuyerClient
+from seller import Seller, AsyncSeller
+
+HOST = "127.0.0.1"
+ITEMS = {"flower": 10**9, "sugar": 10**9, "potato": 10**9, "oil": 10**9} # Enough stock that BUY never runs out
+ENGINES = {"thread": Seller, "async": AsyncSeller}
+MIX = "LIST=1,CURRENT=1,BUY=2" # Default weights of the commands each buyer sends after ID
+COMMANDS = {"LIST": "LIST", "CURRENT": "CURRENT", "BUY": "BUY 1"}
+
+
+# Latencies and errors for every command, shared by all the simulated buyers
+class Stats:
+    def __init__(self):
+        self.latencies = {} # command -> list of latencies in ms
+        self.errors = {} # command -> number of failed requests
+
+    def record(self, command, latency, ok):
+        self.latencies.setdefault(command, []).append(latency * 1000)
+        self.errors.setdefault(command, 0)
+        if not ok:
+            self.errors[command] += 1
+
+    # Throughput, latency percentiles and error rate per command, plus the totals
+    def report(self, elapsed):
+        commands = {}
+        for command, latencies in self.latencies.items():
+            commands[command] = summarize(latencies, self.errors[command], elapsed)
+        everything = [latency for latencies in self.latencies.values() for latency in latencies]
+        return commands, summarize(everything, sum(self.errors.values()), elapsed)
+
+def summarize(latencies, errors, elapsed):
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "error_rate": errors / len(latencies) if latencies else 0.0,
+        "per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+        "p999_ms": percentile(latencies, 99.9),
+        "max_ms": max(latencies, default=0.0),
+    }
+
+# "LIST=1,CURRENT=1,BUY=2" -> list of commands to pick from at random
+def parse_mix(text):
+    mix = []
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip().upper()
+        if name not in COMMANDS:
+            raise ValueError(f"Unknown command in mix: {name}")
+        mix.extend([name] * int(weight or 1))
+    return mix
+
+
+# Wait until something is listening on the port
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing listening on port {port}")
+
+# Start a seller with every item on sale and register it with the market
+# Port 0 lets the OS pick the seller's port, the market learns it from the registration
+def start_seller(seller_id, port, engine, market_port):
+    seller = ENGINES[engine](seller_id, HOST, port, ITEMS)
+    seller.start_server()
+    for item in ITEMS:
+        seller.start_sale(item, duration=24 * 3600)
+    reply = market.send_command(f"REGISTER {seller_id} {HOST} {seller.port} {' '.join(ITEMS)}", HOST, market_port)
+    if not reply.startswith("OK"):
+        raise RuntimeError(f"Seller {seller_id} could not register: {reply.strip()}")
+    market.keep_alive(seller_id, HOST, seller.port, ITEMS, market_address=(HOST, market_port))
+    return seller
+
+
+# The market and the sellers, either as threads of this process or as child processes
+class Cluster:
+    def __init__(self, sellers, engine, processes):
+        self.engine = engine
+        self.processes = processes
+        self.market_port = free_port()
+        self.seller_ids = [str(n) for n in range(1, sellers + 1)]
+        self.sellers = [] # Seller objects (in-process) or Popen handles (subprocesses)
+        self.database = os.path.join(tempfile.mkdtemp(prefix="loadgen-"), "market.db") # Keep the real market.db untouched
+
+    def start(self):
+        if self.processes:
+            self.sellers.append(self.spawn("market", self.market_port, self.database))
+        else:
+            registry = market.SellerRegistry(self.database)
+            threading.Thread(target=market.start_market, args=(HOST, self.market_port, registry), daemon=True).start()
+        wait_for_port(self.market_port)
+
+        for seller_id in self.seller_ids:
+            if self.processes:
+                self.sellers.append(self.spawn("seller", seller_id, 0, self.engine, self.market_port))
+            else:
+                self.sellers.append(start_seller(seller_id, 0, self.engine, self.market_port))
+
+        # Subprocess sellers are ready once the market knows about them
+        deadline = time.monotonic() + 10
+        for seller_id in self.seller_ids:
+            while market.send_command(f"LOOKUP {seller_id}", HOST, self.market_port).startswith("Error"):
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Seller {seller_id} did not start")
+                time.sleep(0.05)
+
+    def spawn(self, role, *args):
+        command = [sys.executable, os.path.abspath(__file__), "--serve", role, *map(str, args)]
+        return subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+    def stop(self):
+        for process in self.sellers:
+            if isinstance(process, subprocess.Popen):
+                process.terminate()
+                process.wait()
+
+    # Metrics of the in-process sellers (command latencies, lock times, broadcast numbers), subprocesses can't be asked
+    def metrics(self):
+        return {seller.node_id: seller.stats() for seller in self.sellers if isinstance(seller, Seller)}
+
+
+# One simulated buyer: find a seller through the market, then ID, a mix of commands, QUIT
+async def run_buyer(n, cluster, options, mix, stats, deadline):
+    loop = asyncio.get_running_loop()
+    rng = random.Random(n)
+    seller_id = cluster.seller_ids[n % len(cluster.seller_ids)]
+
+    async def timed(command, awaitable):
+        start = time.perf_counter()
+        try:
+            reply = await awaitable
+            ok = not reply.startswith("Error")
+        except (asyncio.TimeoutError, ConnectionError, OSError, ValueError):
+            reply, ok = None, False
+        stats.record(command, time.perf_counter() - start, ok)
+        return reply
+
+    reply = await timed("LOOKUP", loop.run_in_executor(None, market.send_command, f"LOOKUP {seller_id}", HOST, cluster.market_port))
+    if reply is None or reply.startswith("Error"):
+        return
+    host, port = reply.split()
+
+    client = AsyncBuyerClient(10000 + n, binary=options.binary, timeout=options.timeout)
+    if await timed("ID", client.connect(host, int(port))) is None:
+        await client.close()
+        return
+
+    sent = 0
+    while time.monotonic() < deadline and (not options.requests or sent < options.requests):
+        command = rng.choice(mix)
+        if await timed(command, client.request(COMMANDS[command])) is None:
+            await client.close()
+            return # The connection is gone
+        sent += 1
+
+    await timed("QUIT", client.quit())
+
+async def run_buyers(cluster, options, mix, stats):
+    deadline = time.monotonic() + options.duration
+    await asyncio.gather(*(run_buyer(n, cluster, options, mix, stats, deadline) for n in range(options.buyers)))
+
+
+# Start everything, drive the buyers and return the results as a dictionary
+def run(options):
+    mix = parse_mix(options.mix)
+    cluster = Cluster(options.sellers, options.engine, options.processes)
+    stats = Stats()
+    metrics.set_log_level("WARNING") # The in-process servers' per-connection messages
+
+    with contextlib.redirect_stdout(io.StringIO()): # Hide the market's and sellers' per-connection prints
+        try:
+            cluster.start()
+            start = time.perf_counter()
+            asyncio.run(run_buyers(cluster, options, mix, stats))
+            elapsed = time.perf_counter() - start
+            seller_metrics = cluster.metrics()
+        finally:
+            cluster.stop()
+
+    commands, total = stats.report(elapsed)
+    return {
+        "config": {
+            "sellers": options.sellers,
+            "buyers": options.buyers,
+            "engine": options.engine,
+            "processes": options.processes,
+            "binary": options.binary,
+            "mix": options.mix,
+            "duration": options.duration,
+            "requests": options.requests,
+        },
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "elapsed_s": elapsed,
+        "commands": commands,
+        "total": total,
+        "sellers": seller_metrics,
+    }
+
+def print_results(results):
+    config = results["config"]
+    print(f"{config['buyers']} buyers, {config['sellers']} {config['engine']} sellers"
+          f"{' (subprocesses)' if config['processes'] else ''}, {results['elapsed_s']:.1f}s")
+    for name, r in [*results["commands"].items(), ("TOTAL", results["total"])]:
+        print(f"  {name:8} {r['count']:8} {r['per_sec']:10.0f}/s   p50={r['p50_ms']:.3f}ms p99={r['p99_ms']:.3f}ms "
+              f"p999={r['p999_ms']:.3f}ms   errors={r['errors']} ({r['error_rate']:.2%})")
+
+# Print how throughput and p99 moved against an earlier results file
+def compare(results, baseline):
+    print(f"Compared with {baseline['started']}:")
+    for name, r in [*results["commands"].items(), ("TOTAL", results["total"])]:
+        old = baseline["total"] if name == "TOTAL" else baseline["commands"].get(name)
+        if not old:
+            continue
+        rate = (r["per_sec"] / old["per_sec"] - 1) * 100 if old["per_sec"] else 0.0
+        p99 = (r["p99_ms"] / old["p99_ms"] - 1) * 100 if old["p99_ms"] else 0.0
+        print(f"  {name:8} throughput {rate:+7.1f}%   p99 {p99:+7.1f}%   errors {old['errors']} -> {r['errors']}")
+
+
+# Child process entry points used by --processes
+def serve(role, args):
+    if role == "market":
+        port, path = args
+        market.start_market(HOST, int(port), market.SellerRegistry(path))
+    else:
+        seller_id, port, engine, market_port = args
+        start_seller(seller_id, int(port), engine, int(market_port))
+        while True:
+            time.sleep(3600)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Headless load generator for the market, sellers and buyers")
+    parser.add_argument("--sellers", type=int, default=2, help="number of sellers")
+    parser.add_argument("--buyers", type=int, default=100, help="number of simulated buyers, spread over the sellers")
+    parser.add_argument("--engine", choices=ENGINES, default="thread", help="seller engine")
+    parser.add_argument("--processes", action="store_true", help="run the market and each seller as a subprocess")
+    parser.add_argument("--binary", action="store_true", help="buyers use the binary protocol")
+    parser.add_argument("--mix", default=MIX, help="command weights, e.g. LIST=1,CURRENT=1,BUY=2")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds each buyer keeps sending commands")
+    parser.add_argument("--requests", type=int, default=0, help="stop each buyer after this many commands (0 = no limit)")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds before a request counts as an error")
+    parser.add_argument("--out", default="loadgen.json", help="file the JSON results are written to")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    return parser.parse_args(argv)
+
+# python loadgen.py --sellers 4 --buyers 500 --duration 10 --out run.json --compare baseline.json
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--serve"]:
+        serve(sys.argv[2], sys.argv[3:])
+        sys.exit(0)
+
+    options = parse_args(sys.argv[1:])
+    results = run(options)
+    print_results(results)
+
+    with open(options.out, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results written to {options.out}")
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f))
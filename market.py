@@ -1,41 +1,685 @@
 import socket # To handle network communication
 import threading # Used to handle multiple clients concurrently
-import json # Import json to work with JSON data
+import collections
+import heapq
+import random
+import selectors
+import time
+import store # sqlite storage for the registry
+import broadcast # Non-blocking pushes to directory subscribers
+import metrics # Counters, latency histograms and queued logging
+import admission # Connection cap and timeouts
+import ids # Seller and buyer IDs handed out by the market
+import catalog # Search index of every seller's items
+import json
 
-SELLERS_FILE = "sellers.json" # File used to store data
+MARKET_HOST = "127.0.0.1" # Where the market server listens
+MARKET_PORT = 8888
+SELLER_TTL = 30.0 # A seller that hasn't sent a heartbeat for this long is removed
+SEARCH_RESULTS = 20 # Most sellers a SEARCH returns
+COMMANDS = ("LIST", "JOIN", "NEWBUYER", "REGISTER", "DEREGISTER", "LOOKUP", "HEARTBEAT", "UPDATE", "MOVE", "SUBSCRIBE", "FIND", "CATALOG", "SEARCH", "STATS") # Each gets a latency histogram
 
-def load_sellers():
+# Every request is one short connection: no rate limit, but a cap on connections handled at once,
+# a client gets 10 seconds to send its command, and a command can't be longer than 64KB
+LIMITS = admission.Limits(rate=None, max_connections=512, idle_timeout=10.0, max_input=65536)
+
+log = metrics.get_logger("market") # Messages are written by a background thread
+
+# Send one command to the market and return its reply as a string
+# Used by sellers (REGISTER/DEREGISTER) and buyers (LIST/LOOKUP/FIND)
+def send_command(command, host=MARKET_HOST, port=MARKET_PORT):
+    with socket.create_connection((host, port)) as sock:
+        sock.sendall((command + "\n").encode())
+        sock.shutdown(socket.SHUT_WR) # Tell the market the command is complete
+
+        chunks = []
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            chunks.append(data)
+    return b"".join(chunks).decode()
+
+# Register a seller that is listening on (host, port) under a new ID from the market (JOIN), returns the ID
+# Raises ConnectionError if the market can't be reached or refuses (another seller has the port)
+def join(host, port, items, market_address=(MARKET_HOST, MARKET_PORT)):
+    return allocated(f"JOIN {host} {port} {' '.join(items)}", market_address)
+
+# Get a new buyer ID from the market (NEWBUYER), raises ConnectionError if the market can't be reached
+def new_buyer_id(market_address=(MARKET_HOST, MARKET_PORT)):
+    return allocated("NEWBUYER", market_address)
+
+# The ID in an "OK <id>" reply
+def allocated(command, market_address):
     try:
-        with open(SELLERS_FILE, "r") as f: # Try to open file in read only mode
-            return json.load(f) # Load and return the JSON content from file
-    except: # If error
-        return {} # Return an empty dictionary
+        reply = send_command(command, *market_address)
+    except OSError as e:
+        raise ConnectionError(f"Could not reach the market: {e}")
+    if not reply.startswith("OK "):
+        raise ConnectionError(reply.strip() or "No reply from the market.")
+    return reply.split()[1]
+
+# Best sellers of the items matching a query (SEARCH), as a list of {"id", "host", "port", "item", "stock", "sale"}
+# stock is None for a seller that hasn't published its stock yet
+def search(query, market_address=(MARKET_HOST, MARKET_PORT)):
+    matches = []
+    for line in send_command(f"SEARCH {query}", *market_address).splitlines():
+        if line.startswith("ID="):
+            fields = dict(field.split("=", 1) for field in line.split(", "))
+            matches.append({"id": fields["ID"], "host": fields["Host"], "port": int(fields["Port"]), "item": fields["Item"],
+                            "stock": None if fields["Stock"] == "?" else int(fields["Stock"]), "sale": fields["Sale"] == "yes"})
+    return matches
+
+# Turn a LIST reply into {seller id: (host, port)}
+def parse_listing(text):
+    sellers = {}
+    for line in text.splitlines():
+        if line.startswith("ID="):
+            fields = dict(field.split("=", 1) for field in line.split(", "))
+            sellers[fields["ID"]] = (fields["Host"], int(fields["Port"]))
+    return sellers
+
+
+# A live copy of the market's seller list, kept up to date by the market's pushes instead of polling LIST
+# After a lost connection it reconnects with the last version it saw and only gets the changes it missed
+# on_change(action, seller id, info) is called for every "ADD", "UPDATE" and "REMOVE" after the first sync
+class Directory:
+    def __init__(self, host=MARKET_HOST, port=MARKET_PORT, on_change=None, max_backoff=10.0):
+        self.address = (host, port)
+        self.on_change = on_change
+        self.max_backoff = max_backoff
+        self.sellers = {} # seller id -> {"host": .., "port": .., "items": [..]}
+        self.epoch = None # Which run of the market the version belongs to
+        self.version = 0 # Last change applied
+        self.synced = threading.Event() # Set while the directory is caught up with the market
+        self.has_synced = False # True after the first sync, changes are only reported after it
+        self.incoming = None # Full list being received after a "RESET"
+        self.incoming_epoch = None
+        self.received = 0 # Bytes received from the market, for comparing with polling
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        backoff = 0.1
+        while True:
+            try:
+                with socket.create_connection(self.address) as sock:
+                    command = f"SUBSCRIBE {self.epoch} {self.version}" if self.epoch else "SUBSCRIBE"
+                    sock.sendall((command + "\n").encode())
+                    backoff = 0.1
+                    for line in sock.makefile("r"):
+                        self.received += len(line)
+                        self.apply(line.split())
+            except OSError:
+                pass
+            self.synced.clear()
+            self.incoming = None # A half received full list is thrown away
+            time.sleep(backoff)
+            backoff = min(self.max_backoff, backoff * 2)
+
+    # Apply one line pushed by the market
+    def apply(self, fields):
+        if not fields:
+            return
+        if fields[0] == "RESET": # Missed too much (or the market restarted), a full list follows
+            self.incoming, self.incoming_epoch = {}, fields[1]
+            return
+        if fields[0] == "SYNC":
+            if self.incoming is not None:
+                old, self.sellers, self.incoming = self.sellers, self.incoming, None # Swap in the full list at once
+                self.epoch = self.incoming_epoch
+                if self.has_synced:
+                    self.report_differences(old)
+            self.version = int(fields[1])
+            self.has_synced = True
+            self.synced.set()
+            return
+
+        version, action, sid = int(fields[0]), fields[1], fields[2]
+        sellers = self.sellers if self.incoming is None else self.incoming
+        if action == "REMOVE":
+            info = sellers.pop(sid, None)
+        else:
+            info = {"host": fields[3], "port": int(fields[4]), "items": fields[5:]}
+            sellers[sid] = info
+        self.version = version
+        if self.on_change and self.incoming is None and self.has_synced:
+            self.on_change(action, sid, info)
+
+    # After a full list replaced the old one, tell on_change what is different
+    def report_differences(self, old):
+        if not self.on_change:
+            return
+        for sid, info in old.items():
+            if sid not in self.sellers:
+                self.on_change("REMOVE", sid, info)
+        for sid, info in self.sellers.items():
+            if sid not in old:
+                self.on_change("ADD", sid, info)
+            elif old[sid] != info:
+                self.on_change("UPDATE", sid, info)
+
+    # Host and port of a seller, or None
+    def lookup(self, seller_id):
+        info = self.sellers.get(seller_id)
+        return (info["host"], info["port"]) if info else None
+
+
+# Keep a seller registered by sending a heartbeat every interval seconds
+# If the market has dropped it (it expired, or the market restarted without it) it registers again
+def keep_alive(seller_id, host, port, items, interval=SELLER_TTL / 3, market_address=(MARKET_HOST, MARKET_PORT)):
+    def beat():
+        while True:
+            time.sleep(interval)
+            try:
+                if not send_command(f"HEARTBEAT {seller_id}", *market_address).startswith("OK"):
+                    send_command(f"REGISTER {seller_id} {host} {port} {' '.join(items)}", *market_address)
+            except OSError:
+                pass # Market is down, try again next time
+    threading.Thread(target=beat, daemon=True).start()
+
+
+# Keeps a seller's entries in the market's catalog (SEARCH) up to date: each item's stock and whether it is on sale
+# state(items) returns {item: (stock, on sale)} for the given items, or for every item when items is None
+# Items marked with changed() are sent together in one CATALOG every interval seconds, so a burst of purchases is
+# one update per item, and everything is sent again every refresh seconds, for a market that restarted or dropped
+# the seller, and for stock changed where changed() isn't called (the worker processes of a cluster)
+class CatalogPublisher:
+    def __init__(self, seller_id, state, interval=0.5, refresh=SELLER_TTL / 3, market_address=(MARKET_HOST, MARKET_PORT)):
+        self.seller_id = seller_id
+        self.state = state
+        self.interval = interval
+        self.refresh = refresh
+        self.market_address = market_address
+        self.dirty = set() # Items changed since the last CATALOG
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    # Mark items whose stock or sale changed
+    def changed(self, items):
+        with self.lock:
+            self.dirty.update(items)
+
+    def run(self):
+        refresh_at = 0 # Everything goes out first
+        while True:
+            with self.lock:
+                items, self.dirty = self.dirty, set()
+            full = time.monotonic() >= refresh_at
+            if full:
+                refresh_at = time.monotonic() + self.refresh
+            state = self.state(None if full else items)
+            try:
+                if state and not self.send(state):
+                    refresh_at = 0 # The market doesn't know the seller (yet), send everything once it does
+            except OSError:
+                refresh_at = 0 # Market is down, send everything when it is back
+            time.sleep(self.interval)
+
+    # Send {item: (stock, on sale)} as CATALOG lines, returns False if the market doesn't know the seller
+    def send(self, state):
+        entries = [f"{item}:{stock}:{int(on_sale)}" for item, (stock, on_sale) in state.items()]
+        for start in range(0, len(entries), 1000): # Lines well under the market's 64KB limit
+            reply = send_command(f"CATALOG {self.seller_id} {' '.join(entries[start:start + 1000])}", *self.market_address)
+            if not reply.startswith("OK"):
+                return False
+        return True
+
+
+# In-memory registry of sellers owned by the market
+# Lookups use dictionaries so they don't depend on how many sellers are registered
+# Every change is also written to the store as a single row, so a market restart keeps its sellers
+# Every change gets a version number and is pushed to subscribers as a delta line:
+#   "<version> ADD <id> <host> <port> [item ...]", "<version> UPDATE <id> <host> <port> [item ...]", "<version> REMOVE <id>"
+# Sellers stay registered only while they send heartbeats, one that is silent for ttl seconds is removed
+# New sellers (JOIN) and buyers (NEWBUYER) get their IDs from a counter in the store instead of picking one at random
+class SellerRegistry:
+    def __init__(self, path=store.DB_FILE, ttl=SELLER_TTL, max_changes=10000):
+        self.store = store.Store(path)
+        self.metrics = metrics.Registry()
+        self.lock = self.metrics.timed_lock("registry", threading.Lock()) # Protects all the indexes below
+
+        self.sellers = {} # seller id -> {"host": .., "port": .., "items": [..]}
+        self.by_port = {} # port -> seller id, used for the uniqueness check
+        self.by_item = {} # item name -> set of seller ids that sell it
+        self.catalog = catalog.Catalog() # Every seller's stock and sales, ranked for SEARCH
+        self.seller_ids = ids.IdAllocator(self.store, "seller")
+        self.buyer_ids = ids.IdAllocator(self.store, "buyer")
+
+        self.listing = None # Cached LIST reply, rebuilt only after the registry changes
+
+        # Subscribers check the epoch, so after a market restart they know its versions start again
+        self.epoch = f"{random.getrandbits(32):08x}"
+        self.version = 0
+        self.changes = collections.deque(maxlen=max_changes) # (version, delta line) of the latest changes
+        self.subscribers = broadcast.Broadcaster(max_queue=1024, policy="disconnect") # A subscriber that falls behind reconnects and catches up
+
+        self.metrics.gauge("sellers", lambda: len(self.sellers))
+        self.metrics.gauge("subscribers", lambda: len(self.subscribers.channels))
+        self.metrics.gauge("catalog.items", lambda: len(self.catalog.ranked))
+
+        self.ttl = ttl
+        self.deadlines = {} # seller id -> time.monotonic() its registration expires
+        self.expiry = [] # Heap of (deadline, seller id), one entry per seller, checked lazily
+
+        # Start from the stored sellers so a market restart keeps them, they get one ttl to send a heartbeat
+        for sid, info in self.store.sellers().items():
+            self.add(sid, info["host"], info["port"], info["items"])
+
+    # Add a seller to every index, caller must hold the lock (or be the constructor)
+    def add(self, seller_id, host, port, items):
+        self.sellers[seller_id] = {"host": host, "port": port, "items": list(items)}
+        self.by_port[port] = seller_id
+        for item in items:
+            self.by_item.setdefault(item, set()).add(seller_id)
+        self.catalog.retain(seller_id, items)
+        self.listing = None
+
+        self.deadlines[seller_id] = time.monotonic() + self.ttl
+        heapq.heappush(self.expiry, (self.deadlines[seller_id], seller_id))
+        self.changed(f"ADD {self.describe(seller_id)}")
+
+    # "<id> <host> <port> [item ...]" for delta lines
+    def describe(self, seller_id):
+        info = self.sellers[seller_id]
+        return " ".join([seller_id, info["host"], str(info["port"]), *info["items"]])
+
+    # Record a change and push it to the subscribers, caller holds the lock
+    def changed(self, delta):
+        self.version += 1
+        line = f"{self.version} {delta}\n".encode()
+        self.changes.append((self.version, line))
+        self.subscribers.publish(lambda session: line)
+
+    # Remove a seller from every index, caller holds the lock
+    def remove(self, seller_id):
+        info = self.sellers.pop(seller_id)
+        self.store.remove_seller(seller_id)
+        del self.deadlines[seller_id] # Its heap entry is skipped when it comes up
+
+        del self.by_port[info["port"]]
+        for item in info["items"]:
+            ids = self.by_item.get(item)
+            if ids:
+                ids.discard(seller_id)
+                if not ids:
+                    del self.by_item[item] # Don't keep empty entries around
+        self.catalog.remove(seller_id)
+
+        self.listing = None
+        self.changed(f"REMOVE {seller_id}")
+
+    # Register a seller, returns False if the ID or port is already taken
+    def register(self, seller_id, host, port, items):
+        with self.lock:
+            if seller_id in self.sellers or port in self.by_port:
+                return False
+            if not self.store.add_seller(seller_id, host, port, items):
+                return False # Taken in the stored registry (e.g. written by another market process)
+            self.add(seller_id, host, port, items)
+            return True
+
+    # Register a seller under a new ID, returns the ID or None if a seller on another host has the port
+    # IDs someone took by hand with REGISTER are skipped
+    # An entry with the same host and port is stale (a crashed seller, or one loaded from market.db that hasn't sent
+    # a heartbeat yet): the joining seller has bound that port, so the old one is gone and is replaced
+    def join(self, host, port, items):
+        while True:
+            seller_id = self.seller_ids.next()
+            with self.lock:
+                old = self.by_port.get(port)
+                if old is not None:
+                    if self.sellers[old]["host"] != host:
+                        return None
+                    self.remove(old)
+                    log.info(f"Seller {old} replaced by a new seller on its port {port}")
+                if seller_id in self.sellers:
+                    continue
+                if not self.store.add_seller(seller_id, host, port, items):
+                    if self.store.seller(seller_id) is None:
+                        return None # The port is taken in the stored registry
+                    continue
+                self.add(seller_id, host, port, items)
+                return seller_id
+
+    # Add a buyer under a new ID, returns the ID
+    def new_buyer(self):
+        while True:
+            buyer_id = self.buyer_ids.next()
+            if self.store.add_buyer(buyer_id):
+                return buyer_id
+
+    # Remove a seller, returns False if it wasn't registered
+    def deregister(self, seller_id):
+        with self.lock:
+            if seller_id not in self.sellers:
+                return False
+            self.remove(seller_id)
+            return True
+
+    # Change the items a seller has, returns False if it isn't registered
+    def update(self, seller_id, items):
+        with self.lock:
+            info = self.sellers.get(seller_id)
+            if info is None:
+                return False
+            self.store.update_seller(seller_id, items)
+
+            for item in info["items"]:
+                self.by_item[item].discard(seller_id)
+                if not self.by_item[item]:
+                    del self.by_item[item]
+            for item in items:
+                self.by_item.setdefault(item, set()).add(seller_id)
+            self.catalog.retain(seller_id, items)
+            info["items"] = list(items)
+            self.changed(f"UPDATE {self.describe(seller_id)}")
+            return True
+
+    # Point a seller's entry at a new address (a follower that took over from it, see replication.py)
+    # Counts as a heartbeat, returns False if the seller isn't registered or another seller has the port
+    def move(self, seller_id, host, port):
+        with self.lock:
+            info = self.sellers.get(seller_id)
+            if info is None or self.by_port.get(port, seller_id) != seller_id:
+                return False
+            if not self.store.move_seller(seller_id, host, port):
+                return False
+
+            del self.by_port[info["port"]]
+            info["host"], info["port"] = host, port
+            self.by_port[port] = seller_id
+            self.deadlines[seller_id] = time.monotonic() + self.ttl
+            self.listing = None
+            self.changed(f"UPDATE {self.describe(seller_id)}")
+            return True
+
+    # A seller is still alive, returns False if it isn't registered (e.g. it already expired)
+    def heartbeat(self, seller_id):
+        with self.lock:
+            if seller_id not in self.sellers:
+                return False
+            self.deadlines[seller_id] = time.monotonic() + self.ttl # The heap entry is moved when it comes up
+            return True
+
+    # Remove every seller whose heartbeats stopped, returns their ids
+    def expire(self):
+        expired = []
+        with self.lock:
+            now = time.monotonic()
+            while self.expiry and self.expiry[0][0] <= now:
+                _, sid = heapq.heappop(self.expiry)
+                deadline = self.deadlines.get(sid)
+                if deadline is None:
+                    continue # Deregistered
+                if deadline > now:
+                    heapq.heappush(self.expiry, (deadline, sid)) # Heartbeat since, check again later
+                else:
+                    self.remove(sid)
+                    expired.append(sid)
+        return expired
+
+    # Background thread removing sellers that stopped sending heartbeats
+    def expire_forever(self):
+        while True:
+            time.sleep(min(1.0, self.ttl / 4))
+            for sid in self.expire():
+                log.info(f"Seller {sid} stopped sending heartbeats, removed")
+
+    # Start pushing changes to a subscriber, first sending what it missed since (epoch, version)
+    # It gets only the missed deltas if they are still in the change log, otherwise "RESET" and every seller as an ADD
+    # Either way "SYNC <version>" marks the point where it is up to date
+    def subscribe(self, sock, epoch=None, version=0):
+        with self.lock: # No change can slip in between the catch-up and the live deltas
+            oldest = self.changes[0][0] if self.changes else self.version + 1
+            if epoch == self.epoch and oldest <= version + 1 and version <= self.version:
+                lines = [line for v, line in self.changes if v > version]
+            else:
+                lines = [f"RESET {self.epoch} {self.version}\n".encode()]
+                lines.extend(f"{self.version} ADD {self.describe(sid)}\n".encode() for sid in self.sellers)
+            lines.append(f"SYNC {self.version}\n".encode())
+
+            self.subscribers.add(sock, None)
+            self.subscribers.send(sock, b"".join(lines))
+
+    # Host and port of one seller, or None
+    def lookup(self, seller_id):
+        info = self.sellers.get(seller_id)
+        return (info["host"], info["port"]) if info else None
+
+    # Stock levels and sales published by a seller (CATALOG), entries are (item, stock, on sale)
+    # Only kept in memory, the seller sends them all again every so often, items it didn't register with are ignored
+    # Returns False if the seller isn't registered
+    def publish(self, seller_id, entries):
+        with self.lock:
+            if seller_id not in self.sellers:
+                return False
+            known = self.catalog.sellers.get(seller_id, ())
+            for item, stock, on_sale in entries:
+                if item in known:
+                    self.catalog.set(seller_id, item, stock, on_sale)
+            return True
+
+    # Best sellers of the items matching a query, on sale first then most stock (see catalog.Catalog.search)
+    # as a list of (id, host, port, item, stock, on sale)
+    def search(self, query, limit=SEARCH_RESULTS):
+        with self.lock:
+            return [(sid, self.sellers[sid]["host"], self.sellers[sid]["port"], item, stock, on_sale)
+                    for sid, item, stock, on_sale in self.catalog.search(query, limit)]
+
+    # Sellers that sell the given item, as a list of (id, host, port)
+    def find(self, item):
+        with self.lock:
+            return [(sid, self.sellers[sid]["host"], self.sellers[sid]["port"]) for sid in self.by_item.get(item, ())]
+
+    # The LIST reply, built once and reused until the registry changes
+    def listing_bytes(self):
+        listing = self.listing
+        if listing is None:
+            with self.lock:
+                if self.sellers:
+                    lines = ["Available Sellers:\n"]
+                    lines.extend(f"ID={sid}, Host={info['host']}, Port={info['port']}\n" for sid, info in self.sellers.items())
+                    listing = "".join(lines).encode() # join instead of += so building is linear
+                else:
+                    listing = b"No sellers available.\n"
+                self.listing = listing
+        return listing
+
+
+# Wait until the other end closes a non-blocking socket, anything it sends is ignored
+def wait_until_closed(sock):
+    with selectors.DefaultSelector() as reader:
+        reader.register(sock, selectors.EVENT_READ)
+        while True:
+            reader.select()
+            try:
+                if not sock.recv(1024):
+                    return
+            except (BlockingIOError, InterruptedError):
+                continue
+            except ConnectionError:
+                return
+
+# leave() gives the connection's slot back, it is called once the command is done (or once a subscriber is waiting)
+def handle_client(sock, registry, limits=LIMITS, leave=lambda: None):
+    subscribed = False
+
+    def send(data):
+        registry.metrics.counter("bytes.out").add(len(data))
+        sock.sendall(data)
 
-def handle_client(sock):
     try:
-        sellers = load_sellers() # Load all the sellers from json file
+        sock.settimeout(limits.idle_timeout) # Clients that connect and never finish a command are dropped
+        data = b""
+        while not data.endswith(b"\n"): # Read one command line
+            chunk = sock.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+            if limits.max_input and len(data) > limits.max_input:
+                registry.metrics.counter("admission.input_full").add()
+                send((admission.INPUT_FULL + "\n").encode())
+                return
+
+        registry.metrics.counter("bytes.in").add(len(data))
+        start = time.perf_counter()
+        command = data.decode().strip().split()
+        name = command[0].upper() if command else "LIST" # An empty request is treated as LIST
+        timed = registry.metrics.histogram(f"command.{name if name in COMMANDS else 'OTHER'}")
+
+        if name == "LIST":
+            send(registry.listing_bytes()) # Send cached message to buyers
+
+        # JOIN <host> <port> [item ...] registers a seller under a new ID, replies with "OK <id>"
+        elif name == "JOIN" and len(command) >= 3:
+            seller_id = registry.join(command[1], int(command[2]), command[3:])
+            if seller_id:
+                send(f"OK {seller_id}\n".encode())
+            else:
+                send(b"Error: Port already exists.\n")
+
+        # NEWBUYER replies with "OK <id>", a buyer ID nobody else has
+        elif name == "NEWBUYER" and len(command) == 1:
+            send(f"OK {registry.new_buyer()}\n".encode())
+
+        # REGISTER <id> <host> <port> [item ...]
+        elif name == "REGISTER" and len(command) >= 4:
+            if registry.register(command[1], command[2], int(command[3]), command[4:]):
+                send(b"OK\n")
+            else:
+                send(b"Error: Seller ID or Port already exists.\n")
+
+        # DEREGISTER <id>
+        elif name == "DEREGISTER" and len(command) == 2:
+            if registry.deregister(command[1]):
+                send(b"OK\n")
+            else:
+                send(b"Error: Invalid seller ID.\n")
+
+        # LOOKUP <id> replies with "<host> <port>"
+        elif name == "LOOKUP" and len(command) == 2:
+            address = registry.lookup(command[1])
+            if address:
+                send(f"{address[0]} {address[1]}\n".encode())
+            else:
+                send(b"Error: Invalid seller ID.\n")
+
+        # HEARTBEAT <id> keeps a seller registered
+        elif name == "HEARTBEAT" and len(command) == 2:
+            if registry.heartbeat(command[1]):
+                send(b"OK\n")
+            else:
+                send(b"Error: Invalid seller ID.\n")
+
+        # UPDATE <id> [item ...] changes a seller's items
+        elif name == "UPDATE" and len(command) >= 2:
+            if registry.update(command[1], command[2:]):
+                send(b"OK\n")
+            else:
+                send(b"Error: Invalid seller ID.\n")
+
+        # MOVE <id> <host> <port> points a seller's entry at a new address
+        elif name == "MOVE" and len(command) == 4:
+            if registry.move(command[1], command[2], int(command[3])):
+                send(b"OK\n")
+            else:
+                send(b"Error: Invalid seller ID or port already exists.\n")
+
+        # SUBSCRIBE [<epoch> <version>] keeps the connection open and pushes every change from then on
+        elif name == "SUBSCRIBE" and len(command) in (1, 3):
+            epoch, version = (command[1], int(command[2])) if len(command) == 3 else (None, 0)
+            registry.subscribe(sock, epoch, version)
+            subscribed = True
+            leave() # Subscribers wait without doing any work, they don't count against max_connections
+            timed.record(time.perf_counter() - start) # Time to catch up, not how long the subscription lasts
+            timed = None
+            wait_until_closed(sock) # The broadcaster does the writing from here on
+
+        # FIND <item> lists the sellers that have the item
+        elif name == "FIND" and len(command) == 2:
+            matches = registry.find(command[1])
+            lines = [f"ID={sid}, Host={host}, Port={port}\n" for sid, host, port in matches]
+            send(("".join(lines) or "No sellers have this item.\n").encode())
+
+        # CATALOG <id> <item>:<stock>:<on sale 0|1> ... publishes stock levels and sales of a seller's items (CatalogPublisher)
+        elif name == "CATALOG" and len(command) >= 2:
+            entries = []
+            for field in command[2:]:
+                item, stock, on_sale = field.rsplit(":", 2)
+                entries.append((item, int(stock), on_sale == "1"))
+            if registry.publish(command[1], entries):
+                send(b"OK\n")
+            else:
+                send(b"Error: Invalid seller ID.\n")
+
+        # SEARCH <words ...> lists the best sellers of the items matching every word, on sale first then most stock
+        elif name == "SEARCH" and len(command) >= 2:
+            matches = registry.search(" ".join(command[1:]))
+            lines = [f"ID={sid}, Host={host}, Port={port}, Item={item}, Stock={'?' if stock is None else stock}, Sale={'yes' if on_sale else 'no'}\n"
+                     for sid, host, port, item, stock, on_sale in matches]
+            send(("".join(lines) or "No sellers have this item.\n").encode())
+
+        # STATS replies with the market's counters, gauges and latency percentiles as JSON
+        elif name == "STATS":
+            send((json.dumps(registry.metrics.snapshot()) + "\n").encode())
 
-        if sellers:
-            message = "Available Sellers:\n" # Message used to list all sellers
-            for sid, info in sellers.items():
-                message += f"ID={sid}, Host={info['host']}, Port={info['port']}\n" # Append seller details
         else:
-            message = "No sellers available.\n"
+            send(b"Error: Unknown command.\n")
+
+        if timed:
+            timed.record(time.perf_counter() - start)
 
-        sock.sendall(message.encode()) # Send message to buyers
+    except (ValueError, OSError) as e:
+        log.error(f"Error handling client: {e}")
     finally:
+        leave()
+        if subscribed:
+            registry.subscribers.remove(sock)
         sock.close() # Close connection to the client
 
-def start_market():
-    print("Market running on port 8888") # Print message for feedback
+def start_market(host=MARKET_HOST, port=MARKET_PORT, registry=None, limits=LIMITS):
+    registry = registry or SellerRegistry()
+    slots = threading.BoundedSemaphore(limits.max_connections) if limits.max_connections else None
+    threading.Thread(target=registry.expire_forever, daemon=True).start()
+
+    print(f"Market running on port {port}") # Print message for feedback
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # Create a TCp/IP socket
-    server.bind(("127.0.0.1", 8888)) # Bind the socket to localhost on port 8888
-    server.listen(4) # Listen for incoming connections (up to 4 in the queue)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port)) # Bind the socket to localhost on port 8888
+    server.listen(128) # Listen for incoming connections
 
     while True:
         client_sock, addr = server.accept() # Wait for a client to connect
-        print(f"Buyer connected from {addr}")
-        threading.Thread(target=handle_client, args=(client_sock,), daemon=True).start()
+        if slots and not slots.acquire(blocking=False):
+            registry.metrics.counter("admission.busy").add()
+            try:
+                client_sock.setblocking(False)
+                client_sock.send((admission.BUSY + "\n").encode()) # Turned away without a thread
+                client_sock.recv(65536) # Drop the command if it's here, closing with it unread would reset the connection
+            except OSError:
+                pass
+            client_sock.close()
+            continue
+
+        log.info(f"Client connected from {addr}")
+        threading.Thread(target=handle_client, args=(client_sock, registry, limits, release_once(slots)), daemon=True).start()
+
+# Function that releases a slot the first time it is called, so calling it again is harmless
+def release_once(slots):
+    if slots is None:
+        return lambda: None
+    released = []
+    def leave():
+        if not released:
+            released.append(True)
+            slots.release()
+    return leave
 
 if __name__ == "__main__":
     start_market()
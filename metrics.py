@@ -0,0 +1,273 @@
+import json
+import logging
+import logging.handlers # QueueHandler/QueueListener, so logging never waits on the terminal
+import os
+import queue
+import sys
+import threading
+import time
+
+
+# A number that only goes up (commands handled, bytes sent)
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, n=1):
+        with self.lock:
+            self.value += n
+
+
+# A number that goes up and down (open connections)
+# With fn the value is read from fn() whenever a snapshot is taken, so nothing has to keep it up to date
+class Gauge:
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def set(self, value):
+        self.value = value
+
+    def read(self):
+        return self.fn() if self.fn else self.value
+
+
+# Latency histogram with HDR-style buckets: exact below 128us, then 64 buckets per power of two (within ~1.5%)
+# Recording is one bucket increment, so it costs the same whatever the number of samples, and percentiles never need sorting
+# Values are stored in whole microseconds, anything above max_seconds lands in the last bucket
+# The count and the minimum are worked out from the buckets when a snapshot is taken, to keep record() short
+class Histogram:
+    def __init__(self, max_seconds=60.0):
+        self.max_value = int(max_seconds * 1e6)
+        self.counts = [0] * (self.index(self.max_value) + 1)
+        self.total = 0 # Sum of the values, for the mean
+        self.max = 0
+        self.lock = threading.Lock()
+
+    # Bucket for a value in microseconds: the value itself below 128,
+    # otherwise 64 buckets for each power of two, picked by the top 7 bits of the value
+    @staticmethod
+    def index(value):
+        if value < 128:
+            return value
+        shift = value.bit_length() - 7
+        return (shift << 6) + (value >> shift)
+
+    # Smallest value that falls in a bucket
+    @staticmethod
+    def lowest(index):
+        if index < 128:
+            return index
+        shift, top = divmod(index, 64)
+        shift -= 1
+        return (top + 64) << shift
+
+    # Record a duration in seconds
+    def record(self, seconds):
+        with self.lock:
+            self.add(seconds)
+
+    # record() without the lock, for a caller that already makes sure only one thread records at a time
+    def add(self, seconds):
+        value = int(seconds * 1000000)
+        if value < 128:
+            index = value
+        else:
+            if value > self.max_value:
+                value = self.max_value
+            shift = value.bit_length() - 7
+            index = (shift << 6) + (value >> shift)
+        self.counts[index] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # Value in microseconds that pct percent of the samples are at or below
+    def percentile(self, pct):
+        with self.lock:
+            counts = list(self.counts)
+        wanted = max(1, -(-sum(counts) * pct // 100)) # Rank of the sample, rounded up
+        seen = 0
+        for index, n in enumerate(counts):
+            seen += n
+            if seen >= wanted:
+                return min(self.lowest(index), self.max)
+        return 0
+
+    def snapshot(self):
+        with self.lock:
+            counts, total, largest = list(self.counts), self.total, self.max
+        count = sum(counts)
+        smallest = next((self.lowest(index) for index, n in enumerate(counts) if n), 0)
+        return {
+            "count": count,
+            "mean_us": total / count if count else 0.0,
+            "min_us": smallest,
+            "p50_us": self.percentile(50),
+            "p99_us": self.percentile(99),
+            "p999_us": self.percentile(99.9),
+            "max_us": largest,
+        }
+
+
+# A lock that records how long callers waited for it and how long they held it
+# Works with threading.Lock and multiprocessing.Lock, anything with acquire/release
+# Most acquisitions don't wait at all, those are only counted, the wait histogram gets the ones that had to wait
+# Everything except the wait histogram is only written by the thread holding the lock, so it needs no lock of its own
+class TimedLock:
+    def __init__(self, lock, wait, hold):
+        self.lock = lock
+        self.wait = wait # Histogram of waiting times, for acquisitions that had to wait
+        self.hold = hold # Histogram of holding times
+        self.acquisitions = 0
+        self.contended = 0 # Acquisitions that had to wait
+        self.acquired = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.lock.acquire(False):
+            if not blocking:
+                return False
+            start = time.perf_counter()
+            if not (self.lock.acquire() if timeout < 0 else self.lock.acquire(True, timeout)): # multiprocessing locks take no -1
+                return False
+            self.wait.record(time.perf_counter() - start)
+            self.contended += 1
+        self.acquisitions += 1
+        self.acquired = time.perf_counter()
+        return True
+
+    def release(self):
+        self.hold.add(time.perf_counter() - self.acquired)
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# Named counters, gauges and histograms for one server (a seller or the market)
+class Registry:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock() # Only taken when a metric is created
+
+    def counter(self, name):
+        metric = self.counters.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.counters.setdefault(name, Counter())
+        return metric
+
+    def gauge(self, name, fn=None):
+        metric = self.gauges.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.gauges.setdefault(name, Gauge(fn))
+        return metric
+
+    def histogram(self, name):
+        metric = self.histograms.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.histograms.setdefault(name, Histogram())
+        return metric
+
+    # Wrap a lock so its wait and hold times go into "lock.<name>.wait" and "lock.<name>.hold"
+    def timed_lock(self, name, lock):
+        if isinstance(lock, TimedLock):
+            lock = lock.lock # Already wrapped (e.g. a forked cluster worker), record into this registry instead
+        timed = TimedLock(lock, self.histogram(f"lock.{name}.wait"), self.histogram(f"lock.{name}.hold"))
+        self.gauge(f"lock.{name}.acquisitions").fn = lambda: timed.acquisitions # Replaces the gauge of an earlier wrapper
+        self.gauge(f"lock.{name}.contended").fn = lambda: timed.contended
+        return timed
+
+    # Every metric's current value as a dictionary that can be turned into JSON
+    def snapshot(self):
+        with self.lock:
+            counters, gauges, histograms = dict(self.counters), dict(self.gauges), dict(self.histograms)
+        return {
+            "time": time.time(),
+            "counters": {name: metric.value for name, metric in sorted(counters.items())},
+            "gauges": {name: metric.read() for name, metric in sorted(gauges.items())},
+            "histograms": {name: metric.snapshot() for name, metric in sorted(histograms.items())},
+        }
+
+    # Write a snapshot to path every interval seconds, in a background thread
+    def dump_every(self, path, interval=10.0):
+        def dump_forever():
+            while True:
+                time.sleep(interval)
+                tmp = path + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(self.snapshot(), f, indent=4)
+                os.replace(tmp, path) # Readers never see half a file
+        threading.Thread(target=dump_forever, daemon=True).start()
+
+
+# Log handler that writes to whatever sys.stdout is when the record is written
+# (benchmarks swap sys.stdout to hide the servers' messages)
+class StdoutHandler(logging.StreamHandler):
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+log_listener = None
+log_lock = threading.Lock()
+
+# Send the app's log records through a queue to a background thread that writes them out
+def start_logging():
+    global log_listener
+    records = queue.SimpleQueue()
+    handler = StdoutHandler()
+    handler.setFormatter(logging.Formatter("%(message)s")) # Same output as the old prints
+    log_listener = logging.handlers.QueueListener(records, handler)
+    log_listener.start()
+
+    root = logging.getLogger("market-app")
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    if root.level == logging.NOTSET:
+        root.setLevel(logging.INFO)
+    root.propagate = False
+
+# A forked process (cluster worker) doesn't get the writer thread, it starts its own
+def restart_logging_in_child():
+    if log_listener is not None:
+        start_logging()
+
+os.register_at_fork(after_in_child=restart_logging_in_child)
+
+# Logger whose records are put on a queue and written by a background thread
+# The caller never waits for the terminal, so logging is safe on the hot path and while holding locks
+def get_logger(name):
+    with log_lock:
+        if log_listener is None:
+            start_logging()
+    return logging.getLogger(f"market-app.{name}")
+
+# Turn the servers' per-event messages on or off (benchmarks and the load generator turn them off)
+def set_log_level(level):
+    get_logger("seller") # Makes sure logging is set up
+    logging.getLogger("market-app").setLevel(level)
+
+# Write out every queued record, e.g. before the process exits
+def flush_logs():
+    if log_listener:
+        log_listener.stop()
+        log_listener.start()
@@ -0,0 +1,339 @@
+import collections
+import json
+import random
+import selectors
+import socket
+import threading
+import time
+
+import broadcast # Non-blocking pushes to the followers
+import market # A follower that takes over moves the seller's market entry to itself
+import metrics # Counters, gauges and queued logging
+
+# How long a change waits for the followers before the buyer gets its reply
+#   "async" - not at all, a leader crash loses the changes no follower had received yet (replication.lag shows how many)
+#   "sync"  - until at least one follower has applied it, at most timeout seconds (then the change is let through
+#             and counted in replication.sync_timeouts), a leader with no followers doesn't wait
+MODES = ("async", "sync")
+
+log = metrics.get_logger("replication")
+
+
+# One line of the replication stream
+def encode(record):
+    return json.dumps(record, separators=(",", ":")).encode() + b"\n"
+
+# Read one line from a blocking socket, the other end sends nothing more until it gets an answer
+def read_line(sock):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError("Closed before a whole line was read")
+        data += chunk
+    return data.decode().strip()
+
+
+# Streams every change to a seller's stock and sales to follower processes
+# A follower connects to (host, port) and sends "FOLLOW <epoch> <sequence> <host> <port> <seller port>": the last change it applied,
+# where it will replicate to the others if it takes over, and where its buyers connect. Like the market's directory it gets
+# only the changes it missed if they are still in the change log, otherwise a RESET with the whole state, then every change as it happens
+# Every line is JSON [sequence, operation, arguments...], sequence is the number of the latest change:
+#   HELLO epoch seller-id             - first line, names this run of the leader and the seller it copies
+#   RESET state sales                 - the whole stock (Inventory.state()) and the sales on (Seller.sales_state())
+#   T, R, A, C, X                     - stock changes, the same records as the write-ahead log (Inventory.replay)
+#   S item seconds warning mode ask   - a sale started, E item - a sale ended
+#   F [[host, port, seller port] ...] - the followers, in the order they take over
+#   P                                 - heartbeat every heartbeat seconds, a follower that hears nothing for a while takes over
+# Followers answer "ACK <sequence>" after applying what they got, a follower that stops answering is dropped
+class Leader:
+    def __init__(self, seller, host="127.0.0.1", port=0, mode="async", heartbeat=0.2, timeout=1.0, max_changes=100000, sock=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown replication mode: {mode}")
+
+        self.seller = seller
+        self.inventory = seller.items
+        self.mode = mode
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+
+        self.epoch = f"{random.getrandbits(32):08x}" # Followers of an earlier leader get a RESET
+        self.sequence = 0 # Number of the last change
+        self.acked = 0 # Highest change a follower has applied
+        self.changes = collections.deque(maxlen=max_changes) # (sequence, line) of the latest changes, for followers catching up
+        self.peers = {} # follower socket -> [host, port, seller port], in the order they joined
+        self.lock = threading.Lock() # Protects everything above, taken after the inventory's locks
+        self.acked_changed = threading.Condition(self.lock)
+        self.followers = broadcast.Broadcaster(max_queue=100000, policy="disconnect") # A follower that falls behind reconnects and catches up
+        self.closed = False
+
+        self.sync_timeouts = seller.metrics.counter("replication.sync_timeouts")
+        seller.metrics.gauge("replication.sequence", lambda: self.sequence)
+        seller.metrics.gauge("replication.lag", lambda: self.sequence - self.acked) # Changes a crash right now could lose
+        seller.metrics.gauge("replication.followers", lambda: len(self.peers))
+
+        # A follower taking over passes in the socket it bound when it started, the others know it by that port
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, port))
+        self.sock = sock
+        self.address = sock.getsockname()
+
+    def start(self):
+        self.sock.listen(16)
+        threading.Thread(target=self.accept_forever, daemon=True).start()
+        threading.Thread(target=self.ping_forever, daemon=True).start()
+        return self
+
+    # Record a change and push it to the followers, returns its sequence number for wait()
+    # The caller holds the locks of whatever the change touches, so changes go out in the order they were made
+    def append(self, operation, *arguments):
+        with self.lock:
+            self.sequence += 1
+            line = encode([self.sequence, operation, *arguments])
+            self.changes.append((self.sequence, line))
+            self.followers.publish(lambda session: line)
+            return self.sequence
+
+    # Block until a follower has applied the change, only "sync" mode waits
+    def wait(self, sequence):
+        if self.mode != "sync":
+            return
+        deadline = time.monotonic() + self.timeout
+        with self.lock:
+            while self.peers and self.acked < sequence:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    self.sync_timeouts.add()
+                    return
+                self.acked_changed.wait(left)
+
+    def accept_forever(self):
+        while not self.closed:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return # Closed
+            threading.Thread(target=self.serve_follower, args=(sock,), daemon=True).start()
+
+    # One follower: catch it up, then read its acknowledgements until it goes away
+    def serve_follower(self, sock):
+        try:
+            sock.settimeout(self.timeout)
+            command = read_line(sock).split()
+            if len(command) != 6 or command[0] != "FOLLOW":
+                sock.close()
+                return
+            address = [command[3], int(command[4]), int(command[5])]
+            self.subscribe(sock, command[1], int(command[2]), address)
+        except (OSError, ValueError):
+            sock.close()
+            return
+
+        log.info(f"Follower {address[0]}:{address[1]} joined")
+        reader = selectors.DefaultSelector()
+        reader.register(sock, selectors.EVENT_READ)
+        pending = b""
+        try:
+            while reader.select(self.timeout * 2): # Followers acknowledge every heartbeat, silence means it is gone
+                try:
+                    data = sock.recv(4096)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                if not data:
+                    break
+                *lines, pending = (pending + data).split(b"\n")
+                if lines:
+                    acked = int(lines[-1].split()[1])
+                    with self.lock:
+                        if acked > self.acked:
+                            self.acked = acked
+                            self.acked_changed.notify_all()
+        except (OSError, ValueError, IndexError):
+            pass
+        finally:
+            reader.close()
+            with self.lock:
+                self.peers.pop(sock, None)
+                self.publish_peers()
+            self.followers.remove(sock)
+            sock.close()
+            log.info(f"Follower {address[0]}:{address[1]} left")
+
+    # Send a follower what it missed since (epoch, sequence) and add it to the followers
+    # Every inventory lock is held, so the RESET state is exactly the stock after change number self.sequence
+    def subscribe(self, sock, epoch, sequence, address):
+        def catch_up():
+            with self.lock:
+                lines = [encode([self.sequence, "HELLO", self.epoch, self.seller.node_id])]
+                oldest = self.changes[0][0] if self.changes else self.sequence + 1
+                if epoch == self.epoch and oldest <= sequence + 1 and sequence <= self.sequence:
+                    lines.extend(line for number, line in self.changes if number > sequence)
+                else:
+                    lines.append(encode([self.sequence, "RESET", self.inventory.state(), self.seller.sales_state()]))
+
+                self.followers.add(sock, None)
+                self.followers.send(sock, b"".join(lines))
+                self.peers[sock] = address
+                self.publish_peers()
+        self.inventory.locked(catch_up)
+
+    # Tell every follower who takes over in which order, caller holds the lock
+    def publish_peers(self):
+        line = encode([self.sequence, "F", list(self.peers.values())])
+        self.followers.publish(lambda session: line)
+
+    def ping_forever(self):
+        while not self.closed:
+            time.sleep(self.heartbeat)
+            with self.lock:
+                line = encode([self.sequence, "P"])
+                self.followers.publish(lambda session: line)
+
+    # Where the followers' buyers can connect, [(host, seller port), ...]
+    def replicas(self):
+        with self.lock:
+            return [(host, seller_port) for host, _, seller_port in self.peers.values()]
+
+    # Stop replicating, the followers see the connection end as the leader going away
+    def close(self):
+        self.closed = True
+        self.sock.close()
+        with self.lock:
+            peers = list(self.peers)
+        for sock in peers:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+# Keeps a read-only copy of a leader's stock and sales in a seller, and takes over when the leader is gone
+# leader is the (host, port) the leader replicates on, (host, port) is where this follower replicates to the others
+# if it takes over (port 0 picks a free one, it is bound straight away so the other followers can be told about it)
+# When the leader has been silent for timeout seconds, the first follower in the leader's list takes over:
+# it starts selling, points the market's entry for the seller at itself and becomes the others' leader.
+# The others follow the first follower before them that answers, or take over if every one of them is gone too.
+# In "async" mode whatever the leader hadn't sent yet is lost, at most replication.lag changes when it died.
+class Follower:
+    def __init__(self, seller, leader, host="127.0.0.1", port=0, timeout=1.0, market_address=(market.MARKET_HOST, market.MARKET_PORT)):
+        self.seller = seller
+        self.leader = leader
+        self.timeout = timeout
+        self.market_address = market_address
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.address = (host, self.sock.getsockname()[1])
+
+        self.epoch = None # Run of the leader the sequence numbers belong to, None until the first HELLO
+        self.applied = 0 # Last change applied
+        self.behind = 0 # Changes the leader had made that weren't applied yet, at the last heartbeat
+        self.peers = [] # [host, port, seller port] of every follower, in the order they take over
+        self.promoted = threading.Event() # Set once this follower has taken over
+        self.failover_time = None # Seconds from losing the leader to selling
+
+        seller.metrics.gauge("replication.applied", lambda: self.applied)
+        seller.metrics.gauge("replication.behind", lambda: self.behind)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        leader = self.leader
+        while True:
+            if not self.stream(leader) and self.epoch is None:
+                time.sleep(self.timeout) # Never reached the leader, it may not be up yet
+                continue
+
+            lost = time.monotonic()
+            leader = self.next_leader()
+            if leader is None:
+                self.promote()
+                self.failover_time = time.monotonic() - lost
+                log.info(f"Took over as leader in {self.failover_time * 1000:.0f}ms")
+                return
+            log.info(f"Following {leader[0]}:{leader[1]}")
+
+    # Copy the leader's changes until the connection is lost or the leader goes quiet, False if it couldn't connect
+    def stream(self, leader):
+        try:
+            sock = socket.create_connection(leader, timeout=self.timeout)
+        except OSError:
+            return False
+
+        with sock:
+            try:
+                sock.sendall(f"FOLLOW {self.epoch} {self.applied} {self.address[0]} {self.address[1]} {self.seller.port}\n".encode())
+                chunks = []
+                while True:
+                    data = sock.recv(65536) # Times out when no heartbeat came for timeout seconds
+                    if not data:
+                        break
+                    if b"\n" not in data:
+                        chunks.append(data) # Part of a long line (a RESET)
+                        continue
+                    *lines, rest = (b"".join(chunks) + data).split(b"\n")
+                    chunks = [rest]
+                    for line in lines:
+                        self.apply(json.loads(line))
+                    sock.sendall(f"ACK {self.applied}\n".encode())
+            except (OSError, ValueError) as e:
+                log.info(f"Lost the leader: {e}")
+        return True
+
+    # Apply one line of the replication stream
+    def apply(self, record):
+        sequence, operation, arguments = record[0], record[1], record[2:]
+        if operation == "P":
+            self.behind = sequence - self.applied
+            return
+        if operation == "F":
+            self.peers = arguments[0]
+            return
+        if operation == "HELLO":
+            self.epoch, self.seller.node_id = arguments # A follower sells as the seller it copies
+            return
+
+        if operation == "RESET":
+            self.seller.replica_reset(*arguments)
+        elif operation == "S":
+            self.seller.replica_sale(*arguments)
+        elif operation == "E":
+            self.seller.replica_end(*arguments)
+        else:
+            self.seller.items.replay(record, self.seller.items.reservations)
+            self.seller.items.changed()
+        self.applied = sequence
+
+    # Address of the follower that took over, None if it is this one's turn
+    def next_leader(self):
+        for host, port, _ in self.peers:
+            if (host, port) == self.address:
+                return None # Every follower before this one is gone
+            deadline = time.monotonic() + self.timeout * 2 # Time for it to notice and take over
+            while time.monotonic() < deadline:
+                try:
+                    socket.create_connection((host, port), timeout=self.timeout).close()
+                    return (host, port)
+                except OSError:
+                    time.sleep(0.02)
+        return None
+
+    # Start selling, replicate to the other followers and move the seller's market entry here
+    def promote(self):
+        seller = self.seller
+        seller.take_over()
+        seller.start_replication(sock=self.sock)
+        try:
+            reply = market.send_command(f"MOVE {seller.node_id} {seller.host} {seller.port}", *self.market_address)
+            if not reply.startswith("OK"): # The market already dropped the old leader
+                market.send_command(f"REGISTER {seller.node_id} {seller.host} {seller.port} {' '.join(seller.items)}", *self.market_address)
+        except OSError:
+            log.error("Could not reach the market, buyers won't find this seller until it is back")
+        market.keep_alive(seller.node_id, seller.host, seller.port, list(seller.items), market_address=self.market_address)
+        seller.publish_catalog(self.market_address)
+        self.promoted.set()
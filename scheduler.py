@@ -0,0 +1,83 @@
+import heapq
+import itertools
+import threading
+import time
+
+import metrics # Errors go to the logging queue like the sellers' messages
+
+log = metrics.get_logger("scheduler")
+
+
+# A callback waiting to run at a given time (time.monotonic())
+class Timer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True # Left in the heap and skipped when it comes up
+
+
+# Runs callbacks at exact times from one thread, however many timers there are
+# Timers are kept in a heap ordered by deadline, the thread sleeps until the earliest one is due
+# Callbacks run on the scheduler thread, so they should be short (e.g. queue a notification)
+class Scheduler:
+    def __init__(self):
+        self.heap = [] # (when, sequence number, Timer)
+        self.sequence = itertools.count() # Keeps timers with the same deadline in the order they were added
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Run callback(*args) at the monotonic time when
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        with self.condition:
+            heapq.heappush(self.heap, (when, next(self.sequence), timer))
+            if self.heap[0][2] is timer:
+                self.condition.notify() # New earliest deadline, wake the thread so it sleeps less
+        return timer
+
+    # Run callback(*args) after delay seconds
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    # Number of timers waiting to run
+    def pending(self):
+        with self.condition:
+            return sum(1 for _, _, timer in self.heap if not timer.cancelled)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+
+                    delay = self.heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        timer = heapq.heappop(self.heap)[2]
+                        break
+                    self.condition.wait(delay) # Woken early if an earlier timer is added
+
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                log.exception("Error in scheduled callback")
+
+
+shared_scheduler = None
+shared_lock = threading.Lock()
+
+# One scheduler for the whole process, so many sellers in one process share a single thread
+def shared():
+    global shared_scheduler
+    with shared_lock:
+        if shared_scheduler is None:
+            shared_scheduler = Scheduler()
+        return shared_scheduler
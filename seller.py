@@ -1,111 +1,270 @@
 import socket # This is used for handling network connections (TCP)
 import threading # Used to run multiple threads for concurrency
 import time # For time related functions
-import json # To read and write to JSON files
-import random
+import asyncio # Used by the event-loop seller engine
+import sys
+import os
+import signal
+import market # Used to register with the market server
+import codec # Framing for the buyer/seller protocol
+import broadcast # Non-blocking fan-out of replies and notifications
+import selectors
+import inventory # Stock with per-item locks
+import wal # Write-ahead log for the stock
+import scheduler # Timers for the sale sessions
+import metrics # Counters, latency histograms and queued logging
+import json
+import itertools
+import auction # Order books for sales sold by bidding
+import admission # Rate limits and connection caps
+import replication # Followers that copy the stock and take over if the seller dies
+import control # Admin socket for running a seller from a script
 
-# Function to load existing sellers from the sellers.json file
-def load_sellers():
+# Remove the seller from the market when it shuts down
+def remove_seller(seller_id, market_address=(market.MARKET_HOST, market.MARKET_PORT)):
     try:
-        with open("sellers.json", "r") as f:  # Try to open file in read-only mode
-            return json.load(f)  # Load and return the JSON content from the file
-    except:
-        return {}  # Return an empty dictionary if file is not found
-
-# Function to generate a random seller node_id
-def generate_node_id():
-    return random.randint(1,1000)  # Generate a unique node_id 
-
-# Function to generate a random port between 1024 and 65535
-def generate_port():
-    return random.randint(1024, 65535)  # Random port between 1024 and 65535
-
-# Function to ensure seller ID and port are unique
-def is_unique_seller_id_and_port(seller_id, port):
-    sellers = load_sellers()
-    
-    # Check if the seller ID already exists
-    if seller_id in sellers:
-        return False
-    
-    # Check if the port is already in use
-    for seller in sellers.values():
-        if seller['port'] == port:
-            return False
-    
-    return True
-
-# Save the seller information only if it's unique
-def save_seller(seller_id, host, port, items):
-    if is_unique_seller_id_and_port(seller_id, port):
-        sellers = load_sellers()
-        sellers[seller_id] = {"host": host, "port": port}  # Add the seller to the dictionary
-        with open("sellers.json", "w") as f:
-            json.dump(sellers, f, indent=4)  # Save the seller data to the file
-        return True
-    else:
-        return False
-    
+        market.send_command(f"DEREGISTER {seller_id}", *market_address)
+    except OSError:
+        pass # Market is gone, nothing to clean up
+
+# Commands that get their own latency histogram, anything else is counted as OTHER
+COMMANDS = ("ID", "LIST", "CURRENT", "BUY", "BID", "WITHDRAW", "RESERVE", "CONFIRM", "CANCEL", "QUIT", "PING", "PROTO", "STATS", "REPLICAS")
+
+# Commands that change the stock, a follower refuses them
+WRITES = ("BUY", "BID", "WITHDRAW", "RESERVE", "CONFIRM", "CANCEL")
+
+# Replies that never change, kept as bytes so each protocol only frames them once (codec encode_reply)
+REGISTERED = b"Buyer ID registered."
+PONG = b"PONG"
+NO_BUYER_ID = b"Error: Buyer ID not set."
+SALE_OVER = b"Sale is over. You cannot buy."
+INVALID_AMOUNT = b"Invalid amount."
+EXPIRED = b"Reservation expired."
+READ_ONLY = b"Error: Read-only copy of the seller, buy from the seller itself."
+UNKNOWN_COMMAND = b"Unknown command."
+
+# One timed sale of an item, several can run at the same time
+class SaleSession:
+    def __init__(self, item, duration, warning):
+        self.item = item
+        self.started = time.monotonic()
+        self.deadline = self.started + duration # The sale ends exactly at this time
+        self.warning = warning # Seconds before the end that buyers are warned
+        self.timers = [] # Scheduled warning and end callbacks
+        self.done = threading.Event() # Set when the session has ended
+        self.book = None # auction.OrderBook when the item is sold by bidding instead of BUY
+
+    # Seconds until the sale ends, 0 once it is over
+    def time_left(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+
+# A reply that is built once and sent as is until what it shows changes
+# key() returns something that changes whenever the reply might (e.g. the stock version), build() returns
+# (text, monotonic time the text goes out of date or None), and is only called when the key changed or the text expired
+# version only goes up when the text is different, buyers send it back to get "Not modified" instead of the whole reply
+# Hits take no lock, the current entry is one tuple that is swapped whole
+class CachedReply:
+    def __init__(self, key, build):
+        self.key = key
+        self.build = build
+        self.lock = threading.Lock() # Only taken to rebuild, so two threads don't both bump the version
+        self.entry = (None, None, 0, "", b"", {}) # (key, expires, version, text, utf-8 text, {codec name: untagged reply bytes})
+
+    # The current (key, expires, version, text, payload, encoded) entry
+    def get(self):
+        key = self.key() # Read before building, so the text is never older than the key it is stored with
+        entry = self.entry
+        if entry[0] != key or (entry[1] is not None and time.monotonic() >= entry[1]):
+            entry = self.rebuild(key)
+        return entry
+
+    def rebuild(self, key):
+        with self.lock:
+            entry = self.entry
+            if entry[0] == key and (entry[1] is None or time.monotonic() < entry[1]):
+                return entry # Another thread rebuilt it first
+            text, expires = self.build()
+            if text == entry[3]:
+                entry = (key, expires, entry[2], text, entry[4], entry[5]) # Same text, same version and bytes
+            else:
+                entry = (key, expires, entry[2] + 1, text, text.encode(), {})
+            self.entry = entry
+            return entry
+
+    # The reply ready to send on a connection using conn_codec, tagged with the command's request id rid if it has one
+    # Untagged replies are kept whole, tagged ones only need their header built around the cached bytes
+    def encoded(self, conn_codec, rid=0):
+        _, _, _, _, payload, encoded = self.get()
+        if rid:
+            return conn_codec.encode_reply(payload, rid)
+        data = encoded.get(conn_codec.name)
+        if data is None:
+            data = encoded[conn_codec.name] = conn_codec.encode_reply(payload)
+        return data
+
+
 class Seller:
-    def __init__(self, node_id, host, port, items):
+    def __init__(self, node_id, host, port, items, backlog=128, max_queue=256, broadcast_policy="coalesce", journal=None, reuse_port=False, limits=None):
         # Seller class with parameters
         self.node_id = node_id # Seller's unique identifier
         self.host = host # The server will bind to localhost
         self.port = port # This is the port number the server will listen to
-        self.items = items # Dictionary containing item names as keys and their stock as values
+        # Item names as keys and their stock as values, with a lock per item, recovered from the journal if given
+        # An Inventory can also be passed in directly (e.g. the shared stock of a cluster)
+        self.items = items if isinstance(items, inventory.Inventory) else inventory.Inventory(items, journal)
+        self.reservation_ttl = 30.0 # Seconds a RESERVE holds stock before it is given back
+        self.backlog = backlog # How many pending connections the OS will queue before refusing new buyers
+        self.max_queue = max_queue # How many messages a buyer can fall behind by
+        self.broadcast_policy = broadcast_policy # "coalesce" or "disconnect", what to do with buyers that fall behind
+        self.broadcaster = None # Created when the server starts
+
+        # What buyers are allowed (admission.Limits), so one misbehaving buyer can't starve the rest
+        self.limits = limits or admission.Limits()
+        self.slots = threading.BoundedSemaphore(self.limits.max_connections) if self.limits.max_connections else None
+
+        # Telemetry, recorded without printing on the hot path
+        self.metrics = metrics.Registry()
+        self.log = metrics.get_logger("seller") # Messages are written by a background thread
+        self.command_times = {name: self.metrics.histogram(f"command.{name}") for name in COMMANDS + ("OTHER",)}
+        self.fanout_times = self.metrics.histogram("broadcast.fanout")
+        self.bytes_in = self.metrics.counter("bytes.in")
+        self.bytes_out = self.metrics.counter("bytes.out")
+        self.rejected = {reason: self.metrics.counter(f"admission.{reason}") for reason in ("busy", "rate_limited", "idle", "input_full")}
+        self.metrics.gauge("connections", lambda: len(self.clients))
+        self.metrics.gauge("sales", lambda: len(self.sales))
+        self.items.time_locks(self.metrics) # Wait and hold times of the item locks
+
+        self.sales = {} # Items on sale, each item maps to its SaleSession
+        self.sales_version = 0 # Goes up whenever a sale starts or ends
+        self.bidding = None # Auction mode sell_item uses ("batch" or "continuous"), None sells with BUY
+        self.bid_ids = itertools.count(1) # Shared by every order book, so a bid id names one bid
+        self.lock = self.metrics.timed_lock("sales", threading.Lock()) # Protects the sale sessions and their version
 
-        self.current_item = None # A flag almost, this is to keep a track of what item is being sold
-        self.time_left = 0 # How much time is left for the current session
-        self.selling = False # This is a flag to check if an item is being sold
+        # LIST and CURRENT are polled far more often than the stock or the sales change, so their replies are cached
+        self.list_reply = CachedReply(self.items.version, self.format_list)
+        self.current_reply = CachedReply(lambda: (self.items.version(), self.sales_version), self.format_current)
+        self.cached_replies = {"LIST": self.list_reply, "CURRENT": self.current_reply} # Commands answered straight from the cache
 
-        self.lock = threading.Lock() # This is to manage concurrent access to shared resources aka the items
-        self.clients = [] # A list is used to store connected buyers (clients)
+        # What runs each buyer command, found with one lookup of the command's first word
+        self.handlers = {
+            "PROTO": self.command_proto, "ID": self.command_id, "LIST": self.command_list, "CURRENT": self.command_current,
+            "BUY": self.command_buy, "BID": self.command_bid, "WITHDRAW": self.command_withdraw, "RESERVE": self.command_reserve,
+            "CONFIRM": self.command_confirm, "CANCEL": self.command_cancel, "QUIT": self.command_quit, "PING": self.command_ping,
+            "REPLICAS": self.command_replicas, "STATS": self.command_stats,
+        }
+        self.scheduler = scheduler.shared() # One timer thread for every sale session
+
+        self.replication = None # replication.Leader while followers copy this seller
+        self.follower = None # replication.Follower while this seller is a read-only copy of another one
+        self.control = None # control.ControlServer once the admin socket is open
+        self.publisher = None # market.CatalogPublisher once the seller's stock is in the market's catalog
+
+        self.clients = {} # Connected buyers (clients), each socket maps to its session
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # Server socket created using IPv4 and TCP
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Enable address reuse to prevent errors if the server restarts
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # Several processes listen on the port, the kernel spreads the connections
 
         self.sock.bind((self.host, self.port)) # This is used to bind the socket to the given host and port
+        self.port = self.sock.getsockname()[1] # Port 0 lets the OS pick a free port, this is the one it picked
+
+    # Encode a notification once per protocol in use, instead of once per buyer
+    def encode_notification(self, message, session, encoded):
+        name = session["codec"].name
+        if name not in encoded:
+            encoded[name] = session["codec"].encode_message(codec.NOTIFICATION, message)
+        return encoded[name]
 
     # Function used to send message to all connected buyers
-    def notify_buyers(self, message):
-        tagged = "Notification|" + message # When a 
-        failed = [] # This is used to store clients that failed to receive the message
+    # Only queues the message, the broadcaster's writer thread does the sending so a slow buyer never blocks the caller
+    # Messages with the same key (e.g. stock updates for one item) can be coalesced for buyers that fall behind
+    def notify_buyers(self, message, key=None):
+        if self.broadcaster is None:
+            return # Nobody can be connected yet
 
-        for client in self.clients: # Loop through all clients
-            try:
-                client.sendall((tagged + "\n").encode()) # Send the notification to all clients attached to the seller
-            except:
-                failed.append(client) # If sending the message fails, the client will be appended to 'failed' list
+        encoded = {} # Notification bytes for each protocol
+        sent = [0] # Bytes queued for all the buyers, added to the counter once
+        def encode(session):
+            data = self.encode_notification(message, session, encoded)
+            sent[0] += len(data)
+            return data
+
+        start = time.perf_counter()
+        self.broadcaster.publish(encode, key)
+        self.fanout_times.record(time.perf_counter() - start)
+        self.bytes_out.add(sent[0])
 
-        for i in failed:
-            if i in self.clients:
-                self.clients.remove(i) # If the message failed to send, remove client 
+    # Broadcast latency and queue depth numbers
+    def broadcast_metrics(self):
+        return self.broadcaster.metrics() if self.broadcaster else {}
+
+    # Every metric of this seller, what STATS replies with
+    def stats(self):
+        snapshot = self.metrics.snapshot()
+        snapshot["seller"] = self.node_id
+        snapshot["broadcast"] = self.broadcast_metrics()
+        return snapshot
 
     # Start the connection between seller server and handle incoming connections.
     def start_selling(self):
+        self.start_server()
+
+        while True:
+            self.sell_item() # While true, refer to sell_item function, but select and sell an item
+
+    # Start listening for buyers without blocking the caller
+    def start_server(self):
         print(f"Seller {self.node_id} Listening on port {self.port}")
-        self.sock.listen(4) # This listens for incoming connections (A max of 4)
+        self.broadcaster = broadcast.Broadcaster(self.max_queue, self.broadcast_policy)
+        self.sock.listen(self.backlog) # This listens for incoming connections (up to the backlog size)
 
         # A separate thread is used to handle all the buyers 
         threading.Thread(target=self.accept_buyer, daemon=True).start()
 
-        while True:
-            self.sell_item() # While true, refer to sell_item function, but select and sell an item
-
     # Accept the buyer connection, and assign a new thread for handling
     def accept_buyer(self):
         while True:
             # addr has IP address and port
             client_sock, addr = self.sock.accept() # Accept a new client connection, as the seller. sock.accept() returns 2 values, a new socket object for client, and an address containing the IP address
-            print(f"Buyer connected: {addr}") # For seller to see, print the address of connected buyer.
-
-            self.clients.append(client_sock) # Add the client socket to list of connected clients
+            if not self.admit():
+                self.turn_away(client_sock)
+                continue
+            self.log.info(f"Buyer connected: {addr}") # For seller to see, print the address of connected buyer.
 
             # Start a new thread to handle the buyer's commands
             # threading.Thread allows handle_buyer to run in parallel to main operations, so the server can still interact with buyer
             # daemon threads are threads that automatically close when main program exits. This lets the server keep running while buyer threads are still working
             threading.Thread(target=self.handle_buyer, args=(client_sock,), daemon=True).start()
 
-    # Allow the seller to select first item and start session.
+    # Take a connection slot, False when max_connections buyers are already connected
+    def admit(self):
+        return self.slots is None or self.slots.acquire(blocking=False)
+
+    def leave(self):
+        if self.slots:
+            self.slots.release()
+
+    # Tell a buyer over the connection limit to come back later, without giving it a thread
+    def turn_away(self, sock):
+        self.rejected["busy"].add()
+        try:
+            sock.setblocking(False)
+            sock.send(codec.TextCodec().encode_message(codec.REPLY, admission.BUSY))
+        except OSError:
+            pass
+        sock.close()
+
+    # False if a buyer left more than max_input bytes of an unfinished command, the connection is then closed
+    # Commands held back by the rate limit don't count, nothing more is read until they are handled
+    def input_ok(self, session, send):
+        if self.limits.max_input and session["codec"].pending() > self.limits.max_input and not session.get("throttled"):
+            self.rejected["input_full"].add()
+            send(session["codec"].encode_message(codec.REPLY, admission.INPUT_FULL))
+            return False
+        return True
+
+    # Allow the seller to select an item and start a session, then wait for it to end
     def sell_item(self):
         print("\nChoose an item to sell:")
         for i, item in enumerate(self.items.keys(), start=1):
@@ -125,188 +284,983 @@ class Seller:
             except:
                 print("Numbers only.")
 
-        # This sets what item is for sale
-        self.current_item = choice
-        # Set the sale time
-        self.time_left = 60
-        # Flage to show that the item is in the middle of being sold
-        self.selling = True
+        try:
+            sale = self.start_sale(choice, bidding=self.bidding)
+        except ValueError as e:
+            print(e)
+            return
 
+        # The scheduler ends the sale, this only reports progress to the seller every 5 seconds
+        while not sale.done.wait(5):
+            print(f"Time left: {int(sale.time_left())}s")
+
+    # Put an item on sale for duration seconds, buyers are warned warning seconds before the end
+    # Several items can be on sale at once, each session has its own timers on the shared scheduler
+    # With bidding ("batch" or "continuous", see auction.py) buyers BID for the item instead of BUY, ask is the lowest price accepted
+    def start_sale(self, item, duration=60, warning=10, bidding=None, ask=0):
+        if item not in self.items:
+            raise ValueError(f"Unknown item: {item}")
+
+        with self.lock:
+            if item in self.sales:
+                raise ValueError(f"{item} is already on sale")
+            sale = SaleSession(item, duration, warning)
+            if bidding:
+                sale.book = auction.OrderBook(item, lambda quantity: self.take_stock(item, quantity), bidding, ask, self.bid_ids)
+            self.sales[item] = sale
+            self.sales_version += 1
+
+        if self.replication:
+            self.replication.append("S", item, duration, warning, bidding, ask)
+        if self.publisher:
+            self.publisher.changed((item,))
+        self.announce_sale(sale)
+        self.schedule(sale)
+        return sale
+
+    # Timers that warn the buyers and end the sale
+    def schedule(self, sale):
+        if 0 < sale.warning < sale.time_left():
+            sale.timers.append(self.scheduler.call_at(sale.deadline - sale.warning, self.warn_sale, sale))
+        sale.timers.append(self.scheduler.call_at(sale.deadline, self.end_sale, sale.item))
+
+    def announce_sale(self, sale):
         # Seller announcement
-        print(f"\nCurrently selling: '{self.current_item}' ({self.items[self.current_item]} stock)")
+        self.log.info(f"\nCurrently selling: '{sale.item}' ({self.items[sale.item]} stock)")
         # Let all buyers know what item is being sold
-        self.notify_buyers(f"New item on sale: {self.current_item} Stock={self.items[self.current_item]}")
-
-        # Keep a track of start time of the sale
-        start_time = time.time()
-        warned_10 = False # Flag for buyers at the 10 second mark
-        timer = 60 # Sale duration in seconds
+        self.notify_buyers(f"New item on sale: {sale.item} Stock={self.items[sale.item]}")
 
-        # Loop while there is time, and there are still more of the item available
-        while self.time_left > 0 and self.items[self.current_item] > 0:
-            time.sleep(1) # Wait one second
-            time_passed = int(time.time() - start_time) # Used to calculate time that has passed
-            self.time_left = max(0, timer - time_passed) # Update the remainiing time
+    def warn_sale(self, sale):
+        self.notify_buyers(f"{sale.warning:g} seconds left for {sale.item}.")
 
-            if self.time_left % 5 == 0: 
-                print(f"Time left: {self.time_left}s") # For the seller, every 5 seconds the seller is alerted
+    # End an item's sale session early or when its time is up, returns False if it wasn't on sale
+    def end_sale(self, item):
+        with self.lock:
+            sale = self.sales.pop(item, None)
+            self.sales_version += 1
+        if sale is None:
+            return False
+        if self.replication:
+            self.replication.append("E", item)
+        if self.publisher:
+            self.publisher.changed((item,))
 
-            if self.time_left == 10 and not warned_10:
-                self.notify_buyers("10 seconds left for this item.") # If buyers are not notified yet and there is 10 seconds left, notify all buyers there is 10 seconds left
-                warned_10 = True
+        for timer in sale.timers:
+            timer.cancel()
+        if sale.book:
+            self.close_book(sale)
 
         # If item is sold out
-        if self.items[self.current_item] <= 0:
-            print(f"Item sold out.")
+        if self.items[item] <= 0:
+            self.log.info("Item sold out.")
         else:
-            self.notify_buyers("Sale session ended.")
+            self.notify_buyers(f"Sale session ended for {item}.")
+
+        self.log.info(f"Finished selling '{item}'.")
+        sale.done.set()
+        return True
+
+    # Close a sale's order book ("batch" clears it now), tell every bidder how it went and everyone the result
+    def close_book(self, sale):
+        item = sale.item
+        winners, losers, price = sale.book.clear(self.items[item])
+        for bid in winners:
+            self.tell(bid.owner, f"Bid {bid.id} won: bought {bid.filled} {item} at {bid.paid:g}.")
+        for bid in losers:
+            self.tell(bid.owner, f"Bid {bid.id} for {item} closed, {bid.filled} of {bid.quantity} bought.")
+
+        if sale.book.mode == "batch":
+            sold = sum(bid.filled for bid in winners)
+            if winners:
+                self.notify_buyers(f"Auction for {item} cleared: {sold} sold at {price:g} to {len(winners)} bids.")
+                self.notify_stock({item: self.items[item]})
+            else:
+                self.notify_buyers(f"Auction for {item} ended with no winning bids.")
+            self.log.info(f"Auction for {item}: {sale.book.placed} bids, {len(winners)} won, {sold} sold at {price}")
+
+    # Change the asking price of a "continuous" auction, waiting bids at or above it are filled best first
+    def set_ask(self, item, price):
+        sale = self.sales.get(item)
+        if sale is None or sale.book is None:
+            raise ValueError(f"{item} is not sold by auction")
+        filled = sale.book.set_ask(price)
+        for bid in filled:
+            self.tell(bid.owner, f"Bid {bid.id}: bought {bid.filled} {item} at {price:g}.")
+        if filled:
+            self.notify_stock({item: self.items[item]})
+        return filled
+
+    # Add stock while selling, order is {item: quantity}, returns {item: stock now}
+    # Buyers are told the new stock like after a purchase
+    def restock(self, order):
+        if self.follower:
+            raise ValueError("This seller is a read-only copy, restock the seller it follows")
+        for item, quantity in order.items():
+            if item not in self.items:
+                raise ValueError(f"Unknown item: {item}")
+            if quantity <= 0:
+                raise ValueError(f"Quantity for {item} must be positive")
+        self.items.add(order)
+        stock = {item: self.items[item] for item in order}
+        self.notify_stock(stock)
+        return stock
 
-        print(f"Finished selling '{self.current_item}'.")
-        self.selling = False
+    # Open the admin socket on (host, port) so the seller can be run without its terminal (see control.py)
+    # Returns the control.ControlServer, its address has the port the OS picked for port 0
+    def start_control(self, host="127.0.0.1", port=0):
+        self.control = control.ControlServer(self, host, port).start()
+        return self.control
 
+    # Keep the market's catalog of this seller's stock and sales up to date, so buyers find it with SEARCH
+    # Returns the market.CatalogPublisher
+    def publish_catalog(self, market_address=(market.MARKET_HOST, market.MARKET_PORT)):
+        self.publisher = market.CatalogPublisher(self.node_id, self.catalog_state, market_address=market_address).start()
+        return self.publisher
+
+    # {item: (stock, on sale)} of the given items, or of every item, for the market's catalog
+    def catalog_state(self, items=None):
+        stock = self.items.snapshot()
+        return {item: (stock[item], self.on_sale(item)) for item in (stock if items is None else items) if item in stock}
+
+    # Stream every change to followers on (host, port), see replication.py, returns the replication.Leader
+    # A follower taking over passes the socket it already bound
+    def start_replication(self, host="127.0.0.1", port=0, mode="async", sock=None):
+        self.replication = replication.Leader(self, host, port, mode, sock=sock)
+        self.items.replication = self.replication
+        return self.replication.start()
+
+    # Become a read-only copy of the seller replicating on leader (host, port), returns the replication.Follower
+    # It answers LIST and CURRENT until the leader dies, then one of the followers takes over the sale
+    def follow(self, leader, host="127.0.0.1", port=0, market_address=(market.MARKET_HOST, market.MARKET_PORT)):
+        self.follower = replication.Follower(self, leader, host, port, market_address=market_address)
+        return self.follower.start()
+
+    # The sales on, as sent to a new follower
+    def sales_state(self):
+        with self.lock:
+            return [[sale.item, sale.time_left(), sale.warning, sale.book.mode if sale.book else None, sale.book.ask if sale.book else 0]
+                    for sale in self.sales.values()]
+
+    # A sale started on the leader, a follower keeps it without timers (the leader ends it)
+    def replica_sale(self, item, seconds, warning, bidding, ask):
+        sale = SaleSession(item, seconds, warning)
+        if bidding:
+            sale.book = auction.OrderBook(item, lambda quantity: self.take_stock(item, quantity), bidding, ask, self.bid_ids)
+        with self.lock:
+            self.sales[item] = sale
+            self.sales_version += 1
+
+    def replica_end(self, item):
+        with self.lock:
+            sale = self.sales.pop(item, None)
+            self.sales_version += 1
+        if sale:
+            sale.done.set()
+
+    # The leader's whole stock and sales, for a follower starting out or too far behind
+    def replica_reset(self, state, sales):
+        self.items.restore(state)
+        self.items.time_locks(self.metrics) # Items this seller didn't have yet
+        with self.lock:
+            self.sales = {}
+        for sale in sales:
+            self.replica_sale(*sale)
+
+    # A follower whose leader is gone starts selling: it runs the sales' timers from now on
+    # and gives back reservations, the buyers that held them were connected to the old leader
+    # Bids in the old leader's order books are lost, bidders bid again
+    def take_over(self):
+        self.follower = None
+        for rid in list(self.items.reservations):
+            self.items.release(rid)
+        with self.lock:
+            sales = list(self.sales.values())
+        for sale in sales:
+            self.schedule(sale)
+        self.notify_buyers("This seller is now selling, purchases are open.")
+
+    # Take up to quantity of an item for bids, returns how many units it got
+    def take_stock(self, item, quantity):
+        while quantity > 0:
+            ok, left = self.items.buy(item, quantity)
+            if ok:
+                return quantity
+            quantity = left # Only this many left, take those
+        return 0
+
+    # Send a notification to one buyer, owner is the session of the buyer (bids keep it)
+    def tell(self, session, message):
+        tell = session.get("tell")
+        if tell:
+            tell(message)
+
+    # True while at least one item is on sale
+    @property
+    def selling(self):
+        return bool(self.sales)
+
+    # The most recently started sale, what "BUY <amount>" buys
+    @property
+    def current_item(self):
+        with self.lock:
+            sales = list(self.sales.values())
+        return max(sales, key=lambda sale: sale.started).item if sales else None
+
+    # Whole seconds left on the current item's sale
+    @property
+    def time_left(self):
+        sale = self.sales.get(self.current_item)
+        return int(sale.time_left()) if sale else 0
+
+
+    # Decode every complete command waiting in the session's buffer and handle them in order
+    # All the replies are sent back in one write, so pipelined commands get a batched reply
+    # Returns False when the connection should be closed
+    def handle_batch(self, session, send):
+        replies = []
+        keep_open = True
+        bucket = session.get("bucket") # Rate limit of a network connection
+        times, other = self.command_times, self.command_times["OTHER"]
+
+        # One reply function for the whole batch, it reads the codec and request id of the command being handled
+        def reply(payload):
+            replies.append(conn_codec.encode_reply(payload, rid))
+
+        try:
+            while keep_open:
+                if bucket and not bucket.ready():
+                    session["throttled"] = True # Out of tokens, the rest waits in the buffer until the buyer has some again
+                    self.rejected["rate_limited"].add()
+                    break
+
+                conn_codec = session["codec"] # May change if the buyer switches protocol
+                frame = conn_codec.next_command()
+                if frame is None:
+                    break # Wait for more data
+                if bucket:
+                    bucket.take()
+
+                rid, command = frame
+
+                start = time.perf_counter()
+                cached = self.cached_replies.get(command)
+                if cached:
+                    replies.append(cached.encoded(conn_codec, rid)) # Already encoded, at most a tag to add
+                    name = command
+                else:
+                    words = command.split()
+                    name = self.command_name(words[0]) if words else ""
+                    keep_open = self.run_command(session, name, words, reply)
+                times.get(name, other).record(time.perf_counter() - start)
+
+                # Flush straight away after a protocol switch, so the reply goes out before anything in the new framing
+                if session["codec"] is not conn_codec:
+                    send(b"".join(replies))
+                    replies = []
+        finally:
+            # Replies already built still go out if a command fails, the error then closes the connection
+            if replies:
+                send(b"".join(replies))
+        return keep_open
+
+    # Create the per-connection state for a new buyer
+    def new_session(self):
+        return {"buyer_id": None, "codec": codec.TextCodec(), "reservations": set(), "books": set()} # Every connection starts with the text protocol
+
+    # The item's sale if it is currently on, else None
+    # Checked against the deadline itself, so buying stops exactly when the sale ends
+    # Commands keep the Sale it returns instead of looking it up again, the sale can end in between
+    def live_sale(self, item):
+        sale = self.sales.get(item)
+        return sale if sale is not None and time.monotonic() < sale.deadline else None
+
+    # Is the item currently on sale
+    def on_sale(self, item):
+        return self.live_sale(item) is not None
+
+    # Parse "item:amount" tokens into {item: amount}
+    # Replies with the problem and returns None if the order is invalid or an item is not on sale
+    def parse_order(self, session, tokens, reply):
+        order = {}
+        for token in tokens:
+            item, _, amount = token.partition(":")
+            if item not in self.items:
+                reply(f"Unknown item: {item}.")
+                return None
+            try:
+                quantity = int(amount)
+            except ValueError:
+                reply(INVALID_AMOUNT)
+                return None
+            if quantity <= 0:
+                reply(INVALID_AMOUNT)
+                return None
+            sale = self.live_sale(item)
+            if sale is None:
+                reply(f"{item} is not on sale.")
+                return None
+            if sale.book:
+                reply(f"{item} is sold by auction, use BID {item} <amount> <price>.")
+                return None
+            order[item] = order.get(item, 0) + quantity
+
+        if not order:
+            reply("Usage: <item>:<amount> ...")
+            return None
+        return order
+
+    # Text of the LIST reply, only built when the stock changed
+    def format_list(self):
+        return "Items: " + ", ".join(f"{item}({stock})" for item, stock in self.items.items()), None
+
+    # Text of the CURRENT reply (newest sale first), only built when the stock or the sales changed
+    # It also goes out of date when a sale's whole seconds left tick down
+    def format_current(self):
+        with self.lock:
+            sales = sorted(self.sales.values(), key=lambda sale: sale.started, reverse=True)
+        if not sales:
+            return "No active sale.", None
+
+        now = time.monotonic()
+        parts, expires = [], None
+        for sale in sales:
+            left = max(0.0, sale.deadline - now)
+            parts.append(f"Current: {sale.item}, stock={self.items[sale.item]}, time={int(left)}s" + (f", bidding={sale.book.mode}" if sale.book else ""))
+            if left > 0:
+                tick = sale.deadline - int(left) # When the seconds left drop by one
+                expires = tick if expires is None else min(expires, tick)
+        return "; ".join(parts), expires
+
+    # Reply from a cache, "LIST <version>" or "CURRENT <version>" gets a short "Not modified" if the buyer has that version
+    def reply_cached(self, cached, command, reply):
+        _, _, version, text, _, _ = cached.get()
+        if len(command) < 2:
+            reply(text)
+        elif command[1] == str(version):
+            reply(f"Not modified. Version={version}")
+        else:
+            reply(f"Version={version} {text}")
+
+    # "sugar:2 oil:1" style text for replies
+    def format_order(self, order):
+        return " ".join(f"{item}:{quantity}" for item, quantity in order.items())
+
+    # Let every buyer know the new stock levels, keyed by item so slow buyers only get the latest level
+    # An item is only sold out when no reservation holds any of it either: a CANCEL, an expiry or a buyer leaving
+    # gives those units back, so the sale goes on at 0 until the last one is confirmed (its purchase ends it then)
+    def notify_stock(self, stock):
+        if self.publisher:
+            self.publisher.changed(stock)
+        for item, left in stock.items():
+            self.notify_buyers(f"Item: {item} now has {left} left.", key=f"stock:{item}")
+            if left <= 0 and not self.items.held(item):
+                self.notify_buyers(f"{item.upper()} has been sold out")
+                self.end_sale(item) # Nothing left to sell, don't wait for the timer
+
+    # Print messages for the seller and tell the buyers, called after the purchase so no lock is held
+    def announce_purchase(self, session, order, stock):
+        for item, quantity in order.items():
+            self.log.info(f"Buyer {session['buyer_id']} bought {quantity} of {item} from Seller {self.node_id}\nRemaining: {stock[item]}")
+        self.notify_stock(stock)
+
+    # Give back anything the buyer still had reserved when it disconnects
+    def end_session(self, session):
+        for rid in session["reservations"]:
+            order = self.items.release(rid)
+            if order:
+                self.notify_stock({item: self.items[item] for item in order})
+        session["reservations"].clear()
+
+        for book in session["books"]: # Bids can't be won by a buyer that isn't there to hear about it
+            book.cancel_all(session)
+        session["books"].clear()
+
+    # The name a command is known by in self.handlers, looked up as typed first so upper() only runs for lowercase commands
+    def command_name(self, word):
+        return word if word in self.handlers else word.upper()
+
+    # Process a single command from a buyer and build the reply
+    # session is a small dictionary holding per-connection state (e.g. the buyer_id)
+    # reply is the function used to answer this buyer, called with a str or with one of the constant bytes replies
+    # Returns False when the connection should be closed
+    def handle_command(self, session, text, reply):
+        command = text.split() # Split the command into parts
+        return self.run_command(session, self.command_name(command[0]) if command else "", command, reply)
+
+    # Run a command already split into words, name is its first word as command_name gives it
+    def run_command(self, session, name, command, reply):
+        # A follower only answers questions, buyers buy from the leader (the address the market gives out)
+        if self.follower and name in WRITES:
+            reply(READ_ONLY)
+            return True
+
+        handler = self.handlers.get(name)
+        if handler is None:
+            reply(UNKNOWN_COMMAND)
+            return True
+        return handler(session, command, reply)
+
+    # PROTO BIN / PROTO TEXT switches this connection's framing, the reply still uses the old one
+    def command_proto(self, session, command, reply):
+        if len(command) == 2 and command[1].upper() in codec.CODECS:
+            reply(f"PROTO {command[1].upper()}")
+            session["codec"] = codec.switch(session["codec"], command[1].upper())
+        else:
+            reply(b"Usage: PROTO BIN|TEXT")
+        return True
+
+    # Handle the ID command for registering buyer
+    def command_id(self, session, command, reply):
+        if len(command) < 2:
+            reply(b"Usage: ID <buyer id>")
+            return True
+        session["buyer_id"] = command[1] # Register buyer's ID
+        reply(REGISTERED)
+        return True
+
+    # If command is LIST, list the available items
+    # LIST <version> only sends them if they changed since the reply with that version
+    def command_list(self, session, command, reply):
+        self.reply_cached(self.list_reply, command, reply)
+        return True
+
+    # Info about the items on sale, newest first, CURRENT <version> works like LIST <version>
+    def command_current(self, session, command, reply):
+        self.reply_cached(self.current_reply, command, reply)
+        return True
+
+    # Buy command to allow buyer to purchase an item
+    # BUY <amount> buys the item on sale, BUY <item>:<amount> <item>:<amount> ... buys several items, all or nothing
+    def command_buy(self, session, command, reply):
+        # If the buyer doesnt have a buyer_id
+        if not session["buyer_id"]:
+            reply(NO_BUYER_ID)
+            return True
+
+        # A check to see if the item is being sold currently
+        if not self.selling:
+            reply(SALE_OVER)
+            return True
+
+        # Check to see if the command passed is of length less than 2 (provide a number after buy)
+        if len(command) < 2:
+            reply(b"Usage: BUY <amount> or BUY <item>:<amount> ...")
+            return True
+
+        if ":" in command[1]:
+            order = self.parse_order(session, command[1:], reply)
+            if order is None:
+                return True
+
+            ok, result = self.items.buy_many(order)
+            if not ok:
+                reply("Order failed, only " + ", ".join(f"{stock} {item}" for item, stock in result.items()) + " left.")
+                return True
+
+            reply(f"Purchase OK: bought {self.format_order(order)}.")
+            self.announce_purchase(session, order, result)
+            return True
+
+        try:
+            # Converts the above number into an integer, an places into quantity
+            quantity = int(command[1])
+        except:
+            reply(INVALID_AMOUNT)
+            return True
+
+        if quantity <= 0:
+            reply(INVALID_AMOUNT)
+            return True
+
+        item = self.current_item
+        sale = self.live_sale(item) if item is not None else None
+        if sale is None:
+            reply(SALE_OVER)
+            return True
+        if sale.book:
+            reply(f"{item} is sold by auction, use BID {item} <amount> <price>.")
+            return True
+
+        # The inventory locks only this item, and only for the stock update itself
+        ok, stock = self.items.buy(item, quantity)
+
+        # If buyer trying to buy more than the available
+        if not ok:
+            reply(f"Only {stock} left.")
+            return True
+
+        reply(f"Purchase OK: bought {quantity}.")
+        self.announce_purchase(session, {item: quantity}, {item: stock})
+        return True
+
+    # BID <item> <amount> <price> bids for an item sold by auction
+    def command_bid(self, session, command, reply):
+        if not session["buyer_id"]:
+            reply(NO_BUYER_ID)
+            return True
+        try:
+            item, quantity, price = command[1], int(command[2]), float(command[3])
+        except (IndexError, ValueError):
+            reply(b"Usage: BID <item> <amount> <price>")
+            return True
+        if quantity <= 0 or price <= 0:
+            reply(INVALID_AMOUNT)
+            return True
+
+        sale = self.live_sale(item)
+        if sale is None or sale.book is None:
+            reply(f"{item} is not sold by auction." if sale else f"{item} is not on sale.")
+            return True
+        try:
+            bid = sale.book.place(session, price, quantity)
+        except ValueError as e:
+            reply(str(e))
+            return True
+
+        session["books"].add(sale.book)
+        if not bid.filled:
+            reply(f"Bid {bid.id} placed: {quantity} {item} at {price:g}.")
+            return True
+        rest = f", {quantity - bid.filled} waiting at {price:g}" if bid.open else ""
+        reply(f"Bid {bid.id}: bought {bid.filled} {item} at {bid.paid:g}{rest}.")
+        self.announce_purchase(session, {item: bid.filled}, {item: self.items[item]})
+        return True
+
+    # WITHDRAW <bid id> takes an open bid back
+    def command_withdraw(self, session, command, reply):
+        try:
+            bid_id = int(command[1])
+        except (IndexError, ValueError):
+            reply(b"Usage: WITHDRAW <bid id>")
+            return True
+        for book in session["books"]:
+            bid = book.cancel(bid_id, session)
+            if bid:
+                reply(f"Bid {bid_id} withdrawn.")
+                return True
+        reply(b"Unknown bid.") # Not this buyer's, or already filled or closed
+        return True
+
+    # RESERVE <item>:<amount> ... holds stock for a while, CONFIRM <id> buys it, CANCEL <id> gives it back
+    def command_reserve(self, session, command, reply):
+        if not session["buyer_id"]:
+            reply(NO_BUYER_ID)
+            return True
+
+        order = self.parse_order(session, command[1:], reply)
+        if order is None:
+            return True
+
+        rid, result = self.items.reserve(order, self.reservation_ttl)
+        if rid is None:
+            reply("Reservation failed, only " + ", ".join(f"{stock} {item}" for item, stock in result.items()) + " left.")
+            return True
+
+        session["reservations"].add(rid)
+        reply(f"Reserved {rid}: {self.format_order(order)} for {self.reservation_ttl:g}s.")
+        self.notify_stock(result)
+        return True
+
+    # The buyer's own reservation named by CONFIRM <id> or CANCEL <id>, taken out of its session
+    # Replies and returns None if there is no such reservation
+    def take_reservation(self, session, command, reply):
+        try:
+            rid = int(command[1])
+        except (IndexError, ValueError):
+            reply(f"Usage: {command[0].upper()} <reservation id>")
+            return None
+
+        if rid not in session["reservations"]:
+            reply(b"Unknown reservation.") # Buyers can only use their own reservations
+            return None
+        session["reservations"].discard(rid)
+        return rid
+
+    def command_confirm(self, session, command, reply):
+        rid = self.take_reservation(session, command, reply)
+        if rid is None:
+            return True
+
+        order = self.items.commit(rid)
+        if order is None:
+            reply(EXPIRED)
+            return True
+
+        reply(f"Purchase OK: bought {self.format_order(order)}.")
+        self.announce_purchase(session, order, {item: self.items[item] for item in order})
+        return True
+
+    def command_cancel(self, session, command, reply):
+        rid = self.take_reservation(session, command, reply)
+        if rid is None:
+            return True
+
+        order = self.items.release(rid)
+        reply(b"Reservation cancelled." if order else EXPIRED)
+        if order:
+            self.notify_stock({item: self.items[item] for item in order})
+        return True
+
+    # Disconnect buyer
+    def command_quit(self, session, command, reply):
+        reply(b"You have left.")
+        return False # Close the connection after replying
+
+    # Health check from buyers that keep connections open (buyer.SellerPool)
+    def command_ping(self, session, command, reply):
+        reply(PONG)
+        return True
+
+    # Where read-only copies of this seller take buyers, to spread LIST and CURRENT over them
+    def command_replicas(self, session, command, reply):
+        if self.replication:
+            replicas = self.replication.replicas()
+        elif self.follower:
+            replicas = [(host, port) for host, _, port in self.follower.peers]
+        else:
+            replicas = []
+        reply("Replicas: " + " ".join(f"{host}:{port}" for host, port in replicas) if replicas else b"No replicas.")
+        return True
+
+    # Counters, gauges and latency percentiles of this seller as one line of JSON
+    def command_stats(self, session, command, reply):
+        reply(json.dumps(self.stats(), separators=(",", ":")))
+        return True
 
     def handle_buyer(self, sock):
-        # Initiailize buyer_id
-        buyer_id = None
+        # Per-connection state, starts with no buyer_id
+        session = self.new_session()
+        self.clients[sock] = session # Add the client socket to the connected clients
+
+        # From here on the socket is non-blocking and all writes go through the broadcaster
+        self.broadcaster.add(sock, session)
+        def send(data):
+            self.bytes_out.add(len(data))
+            self.broadcaster.send(sock, data)
+        session["tell"] = lambda message: send(session["codec"].encode_message(codec.NOTIFICATION, message))
+        session["bucket"] = self.limits.bucket()
+        reader = selectors.DefaultSelector() # Used to wait for the buyer's next command
+        reader.register(sock, selectors.EVENT_READ)
+        quitting = False
 
         try:
             # Confirmation message for buyer
-            sock.sendall(b"Connected|Connected to seller.\n")
+            send(session["codec"].encode_message(codec.CONNECTED, "Connected to seller."))
             
             while True:
-                try:
-                    data = sock.recv(1024) # Receive data from buyer, 1024 bytes in size
-                except ConnectionResetError:
-                    # Client disconnected abruptly
-                    break
+                if session.pop("throttled", False):
+                    time.sleep(session["bucket"].delay()) # Out of tokens, the socket isn't read meanwhile so TCP makes the buyer wait
+                else:
+                    if not reader.select(self.limits.idle_timeout):
+                        self.rejected["idle"].add()
+                        send(session["codec"].encode_message(codec.NOTIFICATION, admission.IDLE))
+                        quitting = True # Let the notice go out before closing
+                        break
+                    try:
+                        received = session["codec"].receive(sock) # Read straight into the connection's buffer, may hold several commands or part of one
+                    except (BlockingIOError, InterruptedError):
+                        continue # Nothing to read after all
+                    except ConnectionResetError:
+                        # Client disconnected abruptly
+                        break
 
-                if not data:
-                    break # Exit if no data is received
-
-                command = data.decode().strip().split() # Decode and split the command into parts
-
-                # Handle the ID command for registering buyer
-                if command[0].upper() == "ID":
-                    buyer_id = command[1] # Register buyer's ID
-                    sock.sendall(b"Reply|Buyer ID registered.\n")
-                    continue
-
-                # If command is LIST, list the available items
-                if command[0].upper() == "LIST":
-                    with self.lock:
-                        # Create an empty string to hold the message
-                        message = ""
-
-                        # Loop through each item and its stock
-                        for item, stock in self.items.items():
-                            # Add the item and stock to the message string, formatted as item(stock)
-                            message += f"{item}({stock}), "
-
-                        # Remove the last comma and space
-                        message = message.rstrip(", ")
-
-                    # Send the message to the buyer
-                    sock.sendall(f"Reply|Items: {message}\n".encode())
-
-                # Info about current  item
-                elif command[0].upper() == "CURRENT":
-                    if not self.selling:
-                        sock.sendall(b"Reply|No active sale.\n")
-                    else:
-                        with self.lock:
-                            stock = self.items[self.current_item]
-                            sock.sendall(f"Reply|Current: {self.current_item}, stock={stock}, time={self.time_left}s\n".encode())
-
-                # Buy command to allow buyer to purchase an item
-                elif command[0].upper() == "BUY":
-                    # If the buyer doesnt have a buyer_id 
-                    if not buyer_id:
-                        sock.sendall(b"Reply|Error: Buyer ID not set.\n")
-                        continue
-                    
-                    # A check to see if the item is being sold currently
-                    if not self.selling or self.time_left <= 0:
-                        sock.sendall(b"Reply|Sale is over. You cannot buy.\n")
-                        continue
-
-                    # Check to see if the command passed is of length less than 2 (provide a number after buy)
-                    if len(command) < 2:
-                        sock.sendall(b"Reply|Usage: BUY <amount>\n")
-                        continue
+                    if not received:
+                        break # Exit if no data is received
 
-                    try:
-                        # Converts the above number into an integer, an places into quantity
-                        quantity = int(command[1])
-                    except:
-                        sock.sendall(b"Reply|Invalid amount.\n")
-                        continue
-
-                    # Lock used to protect the shared item (prevent other threads from accessing)
-                    with self.lock:
-                        stock = self.items[self.current_item]
-
-                        # If buyer trying to buy more than the available
-                        if quantity > stock:
-                            sock.sendall(f"Reply|Only {stock} left.\n".encode())
-                        else:
-                            self.items[self.current_item] -= quantity # Reduce the stock if within amounts
-                            new_stock = self.items[self.current_item] # New stock used for display
-                            sock.sendall(f"Reply|Purchase OK: bought {quantity}.\n".encode())
-
-                            # Two print messages for seller
-                            print(f"Buyer {buyer_id} bought {quantity} of {self.current_item} from Seller {self.node_id}")
-                            print(f"Remaining: {new_stock}")
-
-                            # notify_buyers new stock
-                            self.notify_buyers(f"Item: {self.current_item} now has {new_stock} left.")
-
-                            if new_stock <= 0:
-                                self.notify_buyers(f"{self.current_item.upper()} has been sold out")
-
-                # Disconnect buyer
-                elif command[0].upper() == "QUIT":
-                    sock.sendall(b"Reply|You have left.\n")
+                    self.bytes_in.add(received)
+                if not self.handle_batch(session, send) or not self.input_ok(session, send):
+                    quitting = True
                     break # Exit loop if buyer quits
 
-                else:
-                    sock.sendall(b"Reply|Unknown command.\n")
-
         except Exception as e:
-            print(f"Error handling buyer: {e}") # Just print exceptions
+            self.log.error(f"Error handling buyer: {e}") # Just log exceptions, including codec.ProtocolError
 
         finally:
             # Clean up and close connection
+            self.leave()
+            reader.close()
+            self.clients.pop(sock, None) # Remove disconnected client (their socket) from the list
+            self.end_session(session)
+            self.broadcaster.remove(sock, wait=1.0 if quitting else 0) # Let the reply to QUIT go out first
             try:
                 sock.close()
             except:
                 pass
 
-            if sock in self.clients:
-                self.clients.remove(sock) # Remove disconnected client (their socket) from the list
-            print("\nBuyer disconnected.")
+            self.log.info("\nBuyer disconnected.")
+
+# Seller engine that serves every buyer from a single asyncio event loop instead of one thread per buyer
+# It keeps the same API and protocol as Seller, only the networking is different
+class AsyncSeller(Seller):
+    def __init__(self, node_id, host, port, items, backlog=1024, max_queue=256, broadcast_policy="coalesce", journal=None, reuse_port=False, limits=None):
+        super().__init__(node_id, host, port, items, backlog, max_queue, broadcast_policy, journal, reuse_port, limits)
+        self.loop = None # Event loop serving the buyers, set once the server is running
+        self.ready = threading.Event() # Set when the server is accepting connections
+
+        # asyncio already buffers writes without blocking, a buyer falls behind once its buffer passes this many bytes
+        self.max_buffer = max_queue * 256
+        self.broadcast_counts = {"published": 0, "coalesced": 0, "disconnected": 0, "fanout_total": 0.0, "fanout_max": 0.0}
+
+    # Run the event loop in its own thread so sell_item can still use the terminal
+    def start_server(self):
+        print(f"Seller {self.node_id} Listening on port {self.port} (asyncio)")
+        threading.Thread(target=asyncio.run, args=(self.serve(),), daemon=True).start()
+        self.ready.wait() # Wait until buyers can connect
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.sock.setblocking(False) # asyncio needs a non-blocking listening socket
+        server = await asyncio.start_server(self.handle_buyer_async, sock=self.sock, backlog=self.backlog)
+        self.ready.set()
+
+        async with server:
+            await server.serve_forever()
+
+    # Same job as handle_buyer, but as a coroutine (one per buyer, no thread)
+    async def handle_buyer_async(self, reader, writer):
+        if not self.admit():
+            self.rejected["busy"].add()
+            writer.write(codec.TextCodec().encode_message(codec.REPLY, admission.BUSY))
+            writer.close()
+            return
+
+        session = self.new_session()
+        self.log.info(f"Buyer connected: {writer.get_extra_info('peername')}")
+        self.clients[writer] = session # Writers take the place of sockets in the clients list
+
+        try:
+            send = self.counted(writer.write)
+            send(session["codec"].encode_message(codec.CONNECTED, "Connected to seller."))
+            # Writers may only be used from the loop thread, auctions are cleared on the scheduler's thread
+            session["tell"] = lambda message: self.loop.call_soon_threadsafe(
+                lambda: writer.is_closing() or send(session["codec"].encode_message(codec.NOTIFICATION, message)))
+            session["bucket"] = self.limits.bucket()
+
+            while True:
+                if session.pop("throttled", False):
+                    await asyncio.sleep(session["bucket"].delay()) # Out of tokens, once the reader's buffer is full TCP makes the buyer wait
+                else:
+                    try:
+                        data = await asyncio.wait_for(reader.read(4096), self.limits.idle_timeout) # Wait for data without blocking other buyers
+                    except asyncio.TimeoutError:
+                        self.rejected["idle"].add()
+                        send(session["codec"].encode_message(codec.NOTIFICATION, admission.IDLE))
+                        break
+                    except ConnectionResetError:
+                        break
+
+                    if not data:
+                        break
+
+                    self.bytes_in.add(len(data))
+                    session["codec"].feed(data)
+                if not self.handle_batch(session, send) or not self.input_ok(session, send):
+                    break # close() still sends what was written
+
+                pending = session.pop("coalesced", None) # Updates held back while this buyer was behind
+                if pending:
+                    writer.writelines(pending.values())
+
+                await writer.drain() # Slow down this buyer if its send buffer is full
+
+        except Exception as e:
+            self.log.error(f"Error handling buyer: {e}")
+
+        finally:
+            self.leave()
+            self.clients.pop(writer, None)
+            self.end_session(session)
+            writer.close()
+            self.log.info("\nBuyer disconnected.")
+
+    # Wrap a write function so the bytes it sends are counted
+    def counted(self, write):
+        def send(data):
+            self.bytes_out.add(len(data))
+            write(data)
+        return send
+
+    # Writers may only be used from the event loop thread, so hand the work over when called from sell_item
+    def notify_buyers(self, message, key=None):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self.loop:
+            self.write_to_all(message, key)
+        elif self.loop:
+            self.loop.call_soon_threadsafe(self.write_to_all, message, key)
+
+    # Same policies as broadcast.Broadcaster, applied to each writer's transport buffer
+    def write_to_all(self, message, key=None):
+        start = time.perf_counter()
+        encoded = {} # Notification bytes for each protocol
+        sent = 0
+
+        for writer, session in list(self.clients.items()):
+            if writer.is_closing():
+                self.clients.pop(writer, None) # Drop buyers that have gone away
+                continue
+
+            data = self.encode_notification(message, session, encoded)
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                if self.broadcast_policy == "coalesce" and key is not None:
+                    session.setdefault("coalesced", {})[key] = data # Keep only the latest, sent once the buyer catches up
+                    self.broadcast_counts["coalesced"] += 1
+                else:
+                    self.clients.pop(writer, None)
+                    writer.close()
+                    self.broadcast_counts["disconnected"] += 1
+                continue
+
+            pending = session.pop("coalesced", None)
+            if pending:
+                writer.writelines(pending.values())
+            writer.write(data)
+            sent += len(data)
+
+        fanout = time.perf_counter() - start
+        self.fanout_times.record(fanout)
+        self.bytes_out.add(sent)
+        self.broadcast_counts["published"] += 1
+        self.broadcast_counts["fanout_total"] += fanout
+        self.broadcast_counts["fanout_max"] = max(self.broadcast_counts["fanout_max"], fanout)
+
+    def broadcast_metrics(self):
+        depths = [writer.transport.get_write_buffer_size() for writer in list(self.clients)]
+        published = self.broadcast_counts["published"]
+        return {
+            "clients": len(depths),
+            "published": published,
+            "coalesced": self.broadcast_counts["coalesced"],
+            "disconnected": self.broadcast_counts["disconnected"],
+            "queue_bytes_max": max(depths, default=0),
+            "queue_bytes_total": sum(depths),
+            "fanout_avg_ms": self.broadcast_counts["fanout_total"] / published * 1000 if published else 0.0,
+            "fanout_max_ms": self.broadcast_counts["fanout_max"] * 1000,
+        }
 
 if __name__ == "__main__":
+    started = time.perf_counter()
     print("Seller terminal")
-    node_id = generate_node_id()  # Random node_id using random int
     host = "127.0.0.1"  # localhost
-    port = generate_port()  # Random port between 1024 and 65535
-
-    print(f"Generated Seller ID: {node_id}")
-    print(f"Generated Port: {port}")
-
-    print("\nEnter starting amount:")
-    items = {
-        "flower": int(input("Flower stock: ")),
-        "sugar": int(input("Sugar stock: ")),
-        "potato": int(input("Potato stock: ")),
-        "oil": int(input("Oil stock: "))
-    }
-
-    if save_seller(node_id, host, port, items):  # Save the seller if ID and port are unique
-        seller = Seller(node_id, host, port, items)
-        threading.Thread(target=seller.start_selling, daemon=False).start()
+    port = 0 # The OS picks a free port when the seller binds, the market then gives it an ID (JOIN)
+
+    # python seller.py --headless --stock stock.json [--sell sugar,oil] [--duration 60] [--control 9001] runs without prompts:
+    # the stock comes from the file, the listed items go on sale straight away, and the admin socket (control.py) does the rest
+    headless = "--headless" in sys.argv
+    stock_file = sys.argv[sys.argv.index("--stock") + 1] if "--stock" in sys.argv else None
+    control_port = int(sys.argv[sys.argv.index("--control") + 1]) if "--control" in sys.argv else None
+    if "--market" in sys.argv: # python seller.py --market 127.0.0.1:8888 uses another market
+        market_host, _, market_port = sys.argv[sys.argv.index("--market") + 1].rpartition(":")
+        market_address = (market_host or market.MARKET_HOST, int(market_port))
+    else:
+        market_address = (market.MARKET_HOST, market.MARKET_PORT)
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # Stopped by a script, deregister like Ctrl+C
+
+    # python seller.py --wal seller.wal [--durability sync|group|async] keeps the stock in a write-ahead log
+    journal = None
+    if "--wal" in sys.argv:
+        path = sys.argv[sys.argv.index("--wal") + 1]
+        mode = sys.argv[sys.argv.index("--durability") + 1] if "--durability" in sys.argv else "group"
+        journal = wal.WriteAheadLog(path, mode)
+
+    # Buyers are not limited unless asked for (see admission.Limits):
+    #   --rate-limit 100        lets each buyer send 100 commands a second
+    #   --max-connections 1000  serves 1000 buyers at once and turns away any more
+    #   --idle-timeout 600      closes connections that send nothing for 600 seconds
+    #   --max-input 16384       closes connections that leave a command longer than 16384 bytes unfinished
+    flags = {"--rate-limit": ("rate", float), "--max-connections": ("max_connections", int),
+             "--idle-timeout": ("idle_timeout", float), "--max-input": ("max_input", int)}
+    limits = admission.Limits(**{name: kind(sys.argv[sys.argv.index(flag) + 1])
+                                 for flag, (name, kind) in flags.items() if flag in sys.argv})
+
+    # python seller.py --replicate 7001 [--sync] lets followers copy the stock from port 7001 (see replication.py)
+    replicate_port = int(sys.argv[sys.argv.index("--replicate") + 1]) if "--replicate" in sys.argv else None
+    engine = AsyncSeller if "--async" in sys.argv else Seller # python seller.py --async uses the event loop engine
+
+    if "--follow" in sys.argv:
+        # python seller.py --follow 127.0.0.1:7001 [--replicate 7002] keeps a read-only copy of the seller replicating on 7001
+        # and takes over selling if it dies, then replicating to the other followers on 7002
+        leader_host, _, leader_port = sys.argv[sys.argv.index("--follow") + 1].partition(":")
+        seller = engine("follower", host, port, {}, limits=limits) # Sells under the ID of the seller it follows
+        seller.start_server()
+        follower = seller.follow((leader_host, int(leader_port)), host, replicate_port or 0, market_address)
+        print(f"Following {leader_host}:{leader_port}, serving LIST and CURRENT until it goes away")
+
+        def sell_after_take_over():
+            follower.promoted.wait()
+            print(f"\nTook over selling as Seller {seller.node_id}")
+            while not headless: # A headless seller keeps the sales it took over and waits for admin commands
+                seller.sell_item()
+        threading.Thread(target=sell_after_take_over, daemon=False).start()
+
     else:
-        print("Error: Seller ID or Port already exists.")
-    
-    while True:
-        time.sleep(1)
+        if journal and wal.exists(journal.path):
+            print(f"\nRecovering stock from {journal.path}")
+            items = control.load_stock(stock_file) if stock_file else {"flower": 0, "sugar": 0, "potato": 0, "oil": 0} # Replaced by the recovered stock
+        elif stock_file:
+            items = control.load_stock(stock_file)
+        elif headless:
+            print("Error: --headless needs --stock <file>")
+            sys.exit(1)
+        else:
+            print("\nEnter starting amount:")
+            items = {
+                "flower": int(input("Flower stock: ")),
+                "sugar": int(input("Sugar stock: ")),
+                "potato": int(input("Potato stock: ")),
+                "oil": int(input("Oil stock: "))
+            }
+
+        if "--workers" in sys.argv:
+            # python seller.py --workers 4 serves buyers from 4 processes sharing the port and the stock
+            import cluster # Imported here because cluster.py imports this module
+            workers = int(sys.argv[sys.argv.index("--workers") + 1])
+            seller = cluster.SellerCluster(None, host, port, items, workers, cluster.AsyncSeller if engine is AsyncSeller else cluster.Seller, limits=limits)
+        else:
+            seller = engine(None, host, port, items, journal=journal, limits=limits)
+            if "--auction" in sys.argv:
+                # python seller.py --auction batch|continuous sells every item by bidding (BID) instead of BUY
+                seller.bidding = sys.argv[sys.argv.index("--auction") + 1]
+
+        try:
+            node_id = seller.node_id = market.join(host, seller.port, items, market_address) # Register under a new ID from the market
+        except ConnectionError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        print(f"Seller ID: {node_id}")
+        print(f"Port: {seller.port}")
+
+        if replicate_port is not None:
+            leader = seller.start_replication(host, replicate_port, "sync" if "--sync" in sys.argv else "async")
+            print(f"Followers can copy this seller from {host}:{leader.address[1]}")
+        market.keep_alive(node_id, host, seller.port, items, market_address=market_address) # Heartbeats, the market drops sellers that stop sending them
+        seller.publish_catalog(market_address) # Stock and sales for the market's SEARCH
+        if headless:
+            seller.start_server()
+            for item in sys.argv[sys.argv.index("--sell") + 1].split(",") if "--sell" in sys.argv else []:
+                seller.start_sale(item, float(sys.argv[sys.argv.index("--duration") + 1]) if "--duration" in sys.argv else 60, bidding=seller.bidding)
+        else:
+            threading.Thread(target=seller.start_selling, daemon=False).start()
+
+    if control_port is not None:
+        print(f"Admin socket on {host}:{seller.start_control(host, control_port).address[1]}")
+    if headless:
+        # One line with everything a script starting sellers needs to know, it is printed once the seller is serving
+        print(f"Ready: id={seller.node_id} port={seller.port} control={seller.control.address[1] if seller.control else '-'} "
+              f"startup={(time.perf_counter() - started) * 1000:.1f}ms", flush=True)
+
+    if "--metrics" in sys.argv:
+        # python seller.py --metrics seller-stats.json writes every metric to the file every 10 seconds
+        seller.metrics.dump_every(sys.argv[sys.argv.index("--metrics") + 1])
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        if not seller.follower:
+            remove_seller(seller.node_id, market_address) # Let the market drop this seller straight away (a follower's may be another process)
+        metrics.flush_logs()
+        os._exit(0) # The selling thread is blocked on input(), so exit without waiting for it
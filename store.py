@@ -0,0 +1,159 @@
+import json
+import sqlite3 # Embedded database, ships with Python
+import sys
+import threading
+
+DB_FILE = "market.db" # Sellers and buyers, shared by the market and every buyer process on this machine
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sellers (
+    id TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    port INTEGER NOT NULL UNIQUE,
+    items TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS buyers (
+    id TEXT PRIMARY KEY,
+    connected INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS ids (
+    kind TEXT PRIMARY KEY,
+    next INTEGER NOT NULL
+);
+"""
+
+
+# Registry storage on sqlite, replacing the read-modify-write of sellers.json/buyers.json
+# Every registration is one indexed insert or update, so the cost doesn't grow with the number of sellers or buyers,
+# sqlite's own file locking keeps concurrent processes from losing each other's updates,
+# and its journal makes every change atomic, a crash never leaves half a file behind
+class Store:
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self.lock = threading.Lock() # One connection shared by the threads of a process
+        self.db = sqlite3.connect(path, timeout=10.0, isolation_level=None, check_same_thread=False) # Autocommit, waits up to 10s for other processes
+        self.db.execute("PRAGMA journal_mode=WAL") # Readers don't block the writer
+        self.db.execute("PRAGMA synchronous=NORMAL") # Still crash-safe in WAL mode, without an fsync per registration
+        self.db.executescript(SCHEMA)
+
+    # Add a seller, returns False if the ID or port is already taken
+    def add_seller(self, seller_id, host, port, items):
+        try:
+            with self.lock:
+                self.db.execute("INSERT INTO sellers VALUES (?, ?, ?, ?)", (seller_id, host, port, " ".join(items)))
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    # Change the items a seller has
+    def update_seller(self, seller_id, items):
+        with self.lock:
+            self.db.execute("UPDATE sellers SET items = ? WHERE id = ?", (" ".join(items), seller_id))
+
+    # Change where a seller is reached, returns False if the port is taken or the seller isn't registered
+    def move_seller(self, seller_id, host, port):
+        try:
+            with self.lock:
+                return self.db.execute("UPDATE sellers SET host = ?, port = ? WHERE id = ?", (host, port, seller_id)).rowcount > 0
+        except sqlite3.IntegrityError:
+            return False
+
+    # Remove a seller, returns False if it wasn't registered
+    def remove_seller(self, seller_id):
+        with self.lock:
+            return self.db.execute("DELETE FROM sellers WHERE id = ?", (seller_id,)).rowcount > 0
+
+    # {"host": .., "port": .., "items": [..]} for one seller, or None
+    def seller(self, seller_id):
+        with self.lock:
+            row = self.db.execute("SELECT host, port, items FROM sellers WHERE id = ?", (seller_id,)).fetchone()
+        return {"host": row[0], "port": row[1], "items": row[2].split()} if row else None
+
+    # Every seller as {seller id: {"host": .., "port": .., "items": [..]}}, used when the market starts
+    def sellers(self):
+        with self.lock:
+            rows = self.db.execute("SELECT id, host, port, items FROM sellers").fetchall()
+        return {sid: {"host": host, "port": port, "items": items.split()} for sid, host, port, items in rows}
+
+    # Add a buyer, returns False if the ID is already taken
+    def add_buyer(self, buyer_id, connected=False):
+        try:
+            with self.lock:
+                self.db.execute("INSERT INTO buyers VALUES (?, ?)", (buyer_id, int(connected)))
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def set_connected(self, buyer_id, connected):
+        with self.lock:
+            self.db.execute("UPDATE buyers SET connected = ? WHERE id = ?", (int(connected), buyer_id))
+
+    # {"connected": ..} for one buyer, or None
+    def buyer(self, buyer_id):
+        with self.lock:
+            row = self.db.execute("SELECT connected FROM buyers WHERE id = ?", (buyer_id,)).fetchone()
+        return {"connected": bool(row[0])} if row else None
+
+    # Reserve count new numeric IDs for "seller" or "buyer", returns the range of them
+    # The counter only goes up and the reservation is one transaction, so markets sharing the file never get the same IDs
+    # The first reservation starts after the highest numeric ID already in the table (e.g. ones given out at random before)
+    def reserve_ids(self, kind, count):
+        table = {"seller": "sellers", "buyer": "buyers"}[kind]
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE") # Takes the write lock before reading, so two processes can't read the same value
+            try:
+                row = self.db.execute("SELECT next FROM ids WHERE kind = ?", (kind,)).fetchone()
+                if row:
+                    first = row[0]
+                else:
+                    highest = self.db.execute(f"SELECT MAX(CAST(id AS INTEGER)) FROM {table} WHERE id NOT GLOB '*[^0-9]*'").fetchone()[0]
+                    first = (highest or 0) + 1
+                self.db.execute("INSERT OR REPLACE INTO ids VALUES (?, ?)", (kind, first + count))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return range(first, first + count)
+
+    # Import the old sellers.json and buyers.json files, entries that already exist are kept
+    # Returns (sellers imported, buyers imported)
+    def migrate(self, sellers_path="sellers.json", buyers_path="buyers.json"):
+        sellers = read_json(sellers_path)
+        buyers = read_json(buyers_path)
+        with self.lock:
+            self.db.execute("BEGIN") # One transaction, so a failed migration imports nothing
+            try:
+                added_sellers = sum(self.db.execute("INSERT OR IGNORE INTO sellers VALUES (?, ?, ?, ?)",
+                                                    (sid, info["host"], int(info["port"]), " ".join(info.get("items", [])))).rowcount
+                                    for sid, info in sellers.items())
+                added_buyers = sum(self.db.execute("INSERT OR IGNORE INTO buyers VALUES (?, ?)",
+                                                   (bid, int(bool(info.get("connected"))))).rowcount
+                                   for bid, info in buyers.items())
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return added_sellers, added_buyers
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+# python store.py migrate [sellers.json] [buyers.json] [market.db] imports the old JSON files
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["migrate"]:
+        print("Usage: python store.py migrate [sellers.json] [buyers.json] [market.db]")
+        sys.exit(1)
+
+    paths = sys.argv[2:] + ["sellers.json", "buyers.json", DB_FILE][len(sys.argv[2:]):]
+    store = Store(paths[2])
+    sellers, buyers = store.migrate(paths[0], paths[1])
+    print(f"Imported {sellers} sellers and {buyers} buyers into {paths[2]}")
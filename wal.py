@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+import time
+import zlib # crc32, to spot a record that was only half written when the process died
+
+# How long append() waits before a purchase counts as saved
+#   "sync"  - every record is written and fsynced before append returns (safest, slowest)
+#   "group" - a background thread fsyncs batches of records, wait() blocks until the caller's record is on disk
+#   "async" - the background thread writes every interval seconds, nothing waits (a crash can lose the last interval)
+MODES = ("sync", "group", "async")
+
+
+# Append-only log of stock changes with periodic snapshots, so a seller can rebuild its stock after a crash
+# path is the log file, the snapshot lives next to it in path + ".snapshot"
+# Every record is one line: crc32 of the payload, then the payload as JSON [sequence number, operation, arguments...]
+class WriteAheadLog:
+    def __init__(self, path, mode="group", interval=0.01, checkpoint_every=10000):
+        if mode not in MODES:
+            raise ValueError(f"Unknown durability mode: {mode}")
+
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.old_path = path + ".old" # The log being replaced while a snapshot is written
+        self.mode = mode
+        self.interval = interval # Seconds between writes in "async" mode
+        self.checkpoint_every = checkpoint_every # Records between snapshots
+
+        self.lock = threading.Lock() # Protects the sequence numbers and the pending records
+        self.flushed_changed = threading.Condition(self.lock)
+        self.io_lock = threading.Lock() # Held while writing to the file, never taken by append()
+        self.pending = [] # Encoded records not written yet ("group" and "async")
+        self.sequence = 0 # Sequence number of the last record appended
+        self.flushed = 0 # Sequence number of the last record on disk
+        self.since_checkpoint = 0
+
+        self.file = None
+        self.flusher = None
+
+    # Read the snapshot and every record after it, returns (snapshot state or None, list of records)
+    # A torn record at the end of the log (crash in the middle of a write) is cut off
+    # Must be called before the first append
+    def recover(self):
+        state, start = None, 0
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            state, start = snapshot["state"], snapshot["sequence"]
+        except FileNotFoundError:
+            pass
+
+        records = []
+        for path in (self.old_path, self.path):
+            for record in self.read(path):
+                if record[0] > start:
+                    records.append(record)
+
+        self.sequence = self.flushed = max([start] + [record[0] for record in records])
+        return state, records
+
+    # Records in one log file, stopping (and truncating) at the first damaged line
+    def read(self, path):
+        records = []
+        try:
+            f = open(path, "rb+")
+        except FileNotFoundError:
+            return records
+
+        with f:
+            good = 0 # Bytes of the file that hold whole, valid records
+            for line in f:
+                crc, _, payload = line.rstrip(b"\n").partition(b" ")
+                if not line.endswith(b"\n") or crc != b"%08x" % zlib.crc32(payload):
+                    break
+                records.append(json.loads(payload))
+                good += len(line)
+            f.truncate(good)
+        return records
+
+    # Start logging, state is written as the first snapshot so the log starts out empty
+    def open(self, state):
+        self.file = open(self.path, "ab")
+        self.checkpoint(state)
+
+        if self.mode != "sync" and self.flusher is None:
+            self.flusher = threading.Thread(target=self.flush_forever, daemon=True)
+            self.flusher.start()
+
+    def encode(self, record):
+        payload = json.dumps(record, separators=(",", ":")).encode()
+        return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+    # Add a record, returns its sequence number for wait()
+    # The caller holds the locks of whatever the record changes, so records are in the same order as the changes
+    def append(self, operation, *arguments):
+        with self.lock:
+            self.sequence += 1
+            data = self.encode([self.sequence, operation, *arguments])
+            self.since_checkpoint += 1
+
+            if self.mode == "sync":
+                self.file.write(data)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.flushed = self.sequence
+            else:
+                self.pending.append(data)
+                if len(self.pending) == 1:
+                    self.flushed_changed.notify_all() # Wake the flusher
+            return self.sequence
+
+    # Block until the record with this sequence number is on disk, only "group" mode waits
+    def wait(self, sequence):
+        if self.mode != "group":
+            return
+        with self.lock:
+            while self.flushed < sequence:
+                self.flushed_changed.wait()
+
+    # Background thread for "group" and "async": write and fsync whatever has been appended since the last batch
+    # In "group" mode records appended while one fsync runs all go into the next one (group commit)
+    def flush_forever(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.flushed_changed.wait()
+            if self.mode == "async":
+                time.sleep(self.interval) # Let records pile up for a whole interval
+            self.flush()
+
+    # Write and fsync the pending records
+    def flush(self):
+        with self.io_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+                sequence = self.sequence
+            if batch:
+                self.file.write(b"".join(batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            with self.lock:
+                self.flushed = max(self.flushed, sequence)
+                self.flushed_changed.notify_all()
+
+    def needs_checkpoint(self):
+        return self.since_checkpoint >= self.checkpoint_every
+
+    # Start a new log file, the caller holds every lock so state matches the records appended so far exactly
+    # Returns the sequence number state belongs to, pass both to save_snapshot() once the locks are released
+    def rotate(self):
+        self.flush()
+        with self.io_lock, self.lock:
+            self.file.close()
+            os.replace(self.path, self.old_path)
+            self.file = open(self.path, "ab")
+            self.since_checkpoint = 0
+            return self.sequence
+
+    # Write the snapshot, then drop the old log it replaces
+    def save_snapshot(self, state, sequence):
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"sequence": sequence, "state": state}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path) # Atomic, a crash leaves either the old or the new snapshot
+        try:
+            os.remove(self.old_path)
+        except FileNotFoundError:
+            pass
+
+    # Snapshot when nothing else is using the log (recovery, tests)
+    def checkpoint(self, state):
+        self.save_snapshot(state, self.rotate())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+# True if there is a log or snapshot to recover from
+def exists(path):
+    return any(os.path.exists(p) for p in (path, path + ".snapshot", path + ".old"))